@@ -2,38 +2,81 @@ import os
 import sys
 import argparse
 import traceback
-from gccd.utils import copy_input_files, generate_jpgs_from_geotiffs
-from gccd.calculate_bbox import get_bounding_box
-from gccd.generate_maps import generate_html_map, generate_overlay_map
-from gccd.generate_tiles import (
-    generate_pmtiles_from_geotiff,
-    generate_vector_mbtiles,
-    generate_raster_tiles,
-    convert_raster_tiles,
-)
-from gccd.generate_style import generate_style_with_mbtiles
+import gccd
+from gccd import metrics
+from gccd.batch import BatchResults, find_alerts, get_batch_workers
 from gccd.generate_fonts_sprites import copy_fonts_and_sprites
-from gccd.serve_maps import generate_tileserver_config
+from gccd.serve_maps import BATCH_SHARED_DIRECTORY, generate_batch_tileserver_config, generate_tileserver_config
 
 
 # Get environment variables
-map_zoom = float(os.getenv('MAP_ZOOM'))
-map_center_longitude = float(os.getenv('MAP_CENTER_LONGITUDE'))
-map_center_latitude = float(os.getenv('MAP_CENTER_LATITUDE'))
-raster_imagery_url = os.getenv('RASTER_IMAGERY_URL')
-raster_imagery_attribution = os.getenv('RASTER_IMAGERY_ATTRIBUTION')
-raster_max_zoom = os.getenv('RASTER_MBTILES_MAX_ZOOM')
-raster_buffer_size = os.getenv('RASTER_BUFFER_SIZE')
+batch_workers = os.getenv('BATCH_WORKERS')
+
+
+def run_batch(pattern, output, workers):
+    """Generate the map assets of every alert GeoJSON in a directory or
+    matching a glob, into outputs/[output/]<alert name>, with a tileserver-gl
+    config.json serving all of them from the batch directory"""
+    try:
+        alerts = find_alerts(pattern)
+    except ValueError as e:
+        sys.exit(f"\033[1m\033[31mError: {e}\033[0m")
+    if not alerts:
+        sys.exit(f"\033[1m\033[31mError: no GeoJSON files found for {pattern}\033[0m")
+
+    batch_directory = os.path.abspath(os.path.join('outputs', output) if output else 'outputs')
+    shared_directory = os.path.join(batch_directory, BATCH_SHARED_DIRECTORY)
+    os.makedirs(shared_directory, exist_ok=True)
+
+    workers = get_batch_workers(workers)
+    results = BatchResults(alerts, batch_directory, workers)
+    print(f"\033[95mStarting batch of {len(alerts)} alerts, {workers} at a time...\033[0m")
+
+    try:
+        # Fonts and sprites are downloaded into the asset store once, and linked into each output
+        copy_fonts_and_sprites(shared_directory)
+
+        def generate_assets(alert):
+            output_directory = os.path.join(batch_directory, alert.name)
+            os.makedirs(output_directory, exist_ok=True)
+            # STEPS 1-9: Generate the map assets (see gccd.flow)
+            gccd.flow(alert.geojson_path, alert.t0_path, alert.t1_path, output_directory, alert.name)
+            # STEP 10: Generate Tileserver-GL config for the alert on its own
+            generate_tileserver_config(output_directory, alert.name)
+
+        results.run_stage("flow", alerts, generate_assets)
+
+        # STEP 10: ... and for the whole batch, to serve it with one tileserver-gl
+        succeeded = results.succeeded(alerts)
+        if succeeded:
+            generate_batch_tileserver_config(batch_directory, [alert.name for alert in succeeded])
+    finally:
+        # The alerts run in this one process, so their stages are reported together
+        metrics.write_run_report(os.path.join(batch_directory, "batch-run-metrics.json"))
+        summary = results.write_summary(os.path.join(batch_directory, "batch-summary.json"))
+
+    if summary["failed"]:
+        sys.exit(1)
+
 
 def main():
     # Get arguments from command line
     parser = argparse.ArgumentParser(description='Generate HTML and MBTiles files with GeoJSON and GeoTIFF data.')
-    parser.add_argument('--geojson', required=True, help='Path to the input GeoJSON file')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--geojson', help='Path to the input GeoJSON file')
+    inputs.add_argument('--batch', help='Directory of input GeoJSON files, or a glob matching them, to process in one run. GeoTIFFs named <name>_t0.tif and <name>_t1.tif next to a GeoJSON file are used as its T0 and T1 files')
     parser.add_argument('--t0', help='Path to the input T0 (before) GeoTIFF file')
     parser.add_argument('--t1', help='Path to the input T1 (after) GeoTIFF file')
-    parser.add_argument('--output', help='Path to the output files')
+    parser.add_argument('--output', help='Path to the output files (with --batch, of the directory of the outputs of each alert)')
+    parser.add_argument('--batch-workers', default=batch_workers, help='Number of alerts processed at once with --batch')
     args = parser.parse_args()
 
+    if args.batch:
+        if args.t0 or args.t1:
+            sys.exit("\033[1m\033[31mError: --t0 and --t1 cannot be used with --batch\033[0m")
+        run_batch(args.batch, args.output, args.batch_workers)
+        return
+
     input_geojson_path = args.geojson
     input_t0_path = args.t0
     input_t1_path = args.t1
@@ -65,57 +108,10 @@ def main():
         if os.path.exists(f"{output_directory}\mapgl-map\config.json"):
             os.remove(f"{output_directory}\config.json")    
 
-        # STEP 1: Copy input files to resources, and generate a JPG version of the GeoTIFFs (if provided)
-        copy_input_files(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename)
-        if input_t0_path is not None and input_t1_path is not None:
-            generate_jpgs_from_geotiffs(input_t0_path, input_t1_path, output_directory, output_filename)
-
-        # STEP 2: Get bounding box for GeoJSON
-        bounding_box = get_bounding_box(input_geojson_path, raster_buffer_size)
-
-        # STEP 3: Generate PMTiles for GeoTIFFS (if provided)
-        if input_t0_path is not None and input_t1_path is not None:
-            generate_pmtiles_from_geotiff(raster_max_zoom, "t0", output_directory, output_filename)
-            generate_pmtiles_from_geotiff(raster_max_zoom, "t1", output_directory, output_filename)
-
-        # STEP 4: Generate HTML map for previewing change detection alert
-        generate_html_map(
-            map_center_longitude, 
-            map_center_latitude, 
-            map_zoom, 
-            input_geojson_path, 
-            input_t0_path,
-            input_t1_path,
-            output_directory, 
-            output_filename
-        )
-
-        # STEP 5: Generate vector MBTiles from GeoJSON
-        generate_vector_mbtiles(output_directory, output_filename)
-
-        # STEP 6: Generate raster XYZ tiles from satellite imagery and bbox
-        generate_raster_tiles(
-            raster_imagery_url, 
-            raster_imagery_attribution, 
-            raster_max_zoom, 
-            bounding_box['geometry']['coordinates'][0], 
-            output_directory, 
-            output_filename
-        )
-        
-        # STEP 7: Convert raster XYZ directory to MBTiles
-        convert_raster_tiles(output_directory, output_filename + "-raster")
-
-        # STEP 8: Generate stylesheet with MBTiles included
-        generate_style_with_mbtiles(raster_max_zoom, output_directory, output_filename)
-
-        # STEP 9: Download and copy over fonts and glyphs
-        copy_fonts_and_sprites(output_directory)
-
-        # STEP 10: Generate overlay HTML map
-        generate_overlay_map(output_directory, output_filename)
+        # STEPS 1-9: Generate the map assets (see gccd.flow)
+        gccd.flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename)
 
-        # STEP 11: Generate Tileserver-GL config and other necessary files
+        # STEP 10: Generate Tileserver-GL config and other necessary files
         generate_tileserver_config(output_directory, output_filename)
         
         print("\033[95mAll map assets generated! You may now proceed to serve the map (using tileserver-gl) if needed.\033[0m")
@@ -126,6 +122,8 @@ def main():
         traceback_message = traceback.format_exc()
         print(f"\033[1m\033[31m{error_message}\n{traceback_message}\033[0m")
         sys.exit(1)
+    finally:
+        metrics.write_run_report(os.path.join(output_directory, "run-metrics.json"))
 
 if __name__ == "__main__":
     main()
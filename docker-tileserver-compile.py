@@ -2,14 +2,23 @@ import os
 import sys
 import argparse
 import traceback
-from gccd.calculate_bbox import get_bounding_box
+import gccd
+from gccd import metrics
+from gccd.calculate_bbox import get_extents
+from gccd.manifest import BuildManifest
 from gccd.generate_tiles import generate_mbtiles_from_tileserver
+from gccd.render_composite import generate_mbtiles_in_process
 
 
 # Get environment variables
 raster_max_zoom = os.getenv('RASTER_MBTILES_MAX_ZOOM')
 raster_imagery_attribution = os.getenv('RASTER_IMAGERY_ATTRIBUTION')
 raster_buffer_size = os.getenv('RASTER_BUFFER_SIZE')
+raster_tile_cover = os.getenv('RASTER_TILE_COVER', 'bbox')
+raster_footprint_min_zoom = os.getenv('RASTER_FOOTPRINT_MIN_ZOOM', 0)
+tileserver_render_workers = os.getenv('TILESERVER_RENDER_WORKERS')
+composite_mbtiles_resume = os.getenv('COMPOSITE_MBTILES_RESUME', 'false').lower() in ('1', 'true', 'yes')
+composite_renderer = os.getenv('COMPOSITE_RENDERER', 'tileserver')
 port = '8080'
 
 def main():
@@ -37,9 +46,17 @@ def main():
         print("\033[95mStarting script to generate composite MBTiles (raster and vector baked into raster) from tileserver-gl...\033[0m")
                         
         # STEP 11: Generate composite MBTiles from tileserver-gl map
-        bounding_box = get_bounding_box(input_geojson_path, raster_buffer_size)
+        # Reuse the bounding box and footprint computed by docker-generate.py if the GeoJSON and settings are unchanged
+        extents = BuildManifest(output_directory).cached_result(gccd.extents_step(input_geojson_path))
+        if extents is None:
+            extents = get_extents(input_geojson_path, raster_buffer_size, raster_tile_cover == 'footprint')
+        bbox = extents['bounding_box']['geometry']['coordinates'][0]
+        footprint = extents['footprint']
         
-        generate_mbtiles_from_tileserver(bounding_box['geometry']['coordinates'][0], raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, port)
+        if composite_renderer == 'inprocess':
+            generate_mbtiles_in_process(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
+        else:
+            generate_mbtiles_from_tileserver(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, port, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
 
         print("\033[95mComposite raster MBTiles from tileserver-gl map successfully generated!\033[0m")
     except Exception as e:
@@ -49,6 +66,8 @@ def main():
         traceback_message = traceback.format_exc()
         print(f"\033[1m\033[31m{error_message}\n{traceback_message}\033[0m")
         sys.exit(1)
+    finally:
+        metrics.write_run_report(os.path.join(output_directory, "composite-run-metrics.json"))
 
 if __name__ == "__main__":
     main()
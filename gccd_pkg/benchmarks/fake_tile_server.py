@@ -0,0 +1,142 @@
+"""Local stand-in for the imagery and tileserver-gl tile endpoints.
+
+Serves a JPEG for Bing-style quadkey URLs (/{quadkey}), tileserver-gl style
+render URLs (/styles/{name}/{z}/{x}/{y}.jpg) and the /health check, with a
+configurable latency and per-connection bandwidth, so the download and
+render stages can be benchmarked without network access.
+"""
+
+import io
+import re
+import sys
+import time
+import zlib
+import random
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to generate the tile images
+    Image = None
+
+TILE_SIZE = 256
+# Number of distinct tile images served; each response is still made unique (see tile_body)
+TILE_VARIANTS = 16
+JPEG_QUALITY = 85
+
+QUADKEY_PATH = re.compile(r"^/([0-3]+)$")
+STYLE_TILE_PATH = re.compile(r"^/styles/[^/]+/(\d+)/(\d+)/(\d+)\.jpg$")
+
+
+def make_tile_images(variants=TILE_VARIANTS, seed=0):
+    """Return JPEG tiles of random noise, which compress about as badly as
+    satellite imagery does."""
+    if Image is None:
+        print("\033[1m\033[31mThe fake tile server requires Pillow:\033[0m pip install 'gccd[render]'")
+        sys.exit(1)
+    rng = random.Random(seed)
+    images = []
+    for _ in range(variants):
+        size = TILE_SIZE * TILE_SIZE * 3
+        image = Image.frombytes("RGB", (TILE_SIZE, TILE_SIZE), rng.getrandbits(size * 8).to_bytes(size, "little"))
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=JPEG_QUALITY)
+        images.append(output.getvalue())
+    return images
+
+def tile_body(images, key):
+    # A JPEG comment naming the tile keeps every response distinct, so that
+    # deduplicating writers store as many bytes as they would for real imagery
+    comment = key.encode("ascii")
+    image = images[zlib.crc32(comment) % len(images)]
+    return image[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + image[2:]
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Set TCP_NODELAY on accepted connections
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path.split("?", 1)[0]
+        if path == "/health":
+            self.send_body(200, "text/plain", b"OK")
+        elif QUADKEY_PATH.match(path) or STYLE_TILE_PATH.match(path):
+            self.send_body(200, "image/jpeg", tile_body(server.images, path))
+        else:
+            self.send_body(404, "text/plain", b"Not found")
+
+    def send_body(self, status, content_type, body):
+        # Headers and body go out in a single write (or in the first of the
+        # throttled chunks): writing the headers on their own leaves the body
+        # waiting on the client's delayed ACK, adding ~40 ms to every tile
+        head = (
+            f"HTTP/1.1 {status} {self.responses[status][0]}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "\r\n"
+        ).encode("latin-1")
+        response = head + body
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(response)
+            return
+        # Send 20 chunks a second to approximate a link of the given bandwidth
+        chunk_size = max(1024, bandwidth // 20)
+        for start in range(0, len(response), chunk_size):
+            chunk = response[start:start + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTileServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, bandwidth=None):
+        """latency is in seconds per request, bandwidth in bytes per second
+        per connection (None for unlimited). Port 0 picks a free port."""
+        super().__init__(("127.0.0.1", port), TileRequestHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.images = make_tile_images()
+        self.requests = 0
+        self._requests_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    @property
+    def imagery_url(self):
+        return f"http://127.0.0.1:{self.port}/{{q}}"
+
+    def count_request(self):
+        with self._requests_lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-tile-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
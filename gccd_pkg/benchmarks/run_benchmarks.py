@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""End-to-end throughput benchmarks for the tile download, conversion and
+render stages, run against a local fake tile server (see fake_tile_server.py).
+
+Each synthetic alert is run in a fresh worker process so that its peak RSS
+is measured on its own. Results are printed as a table and can be written
+as JSON to compare runs across versions.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# gccd reads the map settings from the environment when it is imported
+for name, value in (("MAP_ZOOM", "10"), ("MAP_CENTER_LONGITUDE", "0"), ("MAP_CENTER_LATITUDE", "0")):
+    os.environ.setdefault(name, value)
+
+from fake_tile_server import FakeTileServer
+from gccd import metrics
+from gccd.calculate_bbox import get_bounding_box
+from gccd.generate_tiles import generate_raster_tiles, convert_raster_tiles, generate_mbtiles_from_tileserver
+from gccd.mbtiles import flip_y
+
+# Synthetic alerts are grids of points this many degrees apart, near the example alert
+ORIGIN_LONGITUDE = -54.1
+ORIGIN_LATITUDE = 3.3
+POINT_SPACING = 0.01
+OUTPUT_FILENAME = "benchmark"
+
+
+def write_synthetic_alert(geojson_path, feature_count):
+    side = math.ceil(math.sqrt(feature_count))
+    features = []
+    for i in range(feature_count):
+        row, col = divmod(i, side)
+        features.append({
+            "type": "Feature",
+            "properties": {"id": str(i), "alert_type": "benchmark"},
+            "geometry": {
+                "type": "Point",
+                "coordinates": [ORIGIN_LONGITUDE + col * POINT_SPACING, ORIGIN_LATITUDE + row * POINT_SPACING],
+            },
+        })
+    with open(geojson_path, "w") as geojson_file:
+        json.dump({"type": "FeatureCollection", "features": features}, geojson_file)
+
+def export_xyz_directory(mbtiles_file, xyz_dir):
+    """Write the tiles of an MBTiles file out as {z}/{x}/{y}.jpg files"""
+    count = 0
+    with contextlib.closing(sqlite3.connect(mbtiles_file)) as conn:
+        for zoom, x, tms_y, tile_data in conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+            tile_dir = os.path.join(xyz_dir, str(zoom), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(os.path.join(tile_dir, f"{flip_y(zoom, tms_y)}.jpg"), "wb") as tile_file:
+                tile_file.write(tile_data)
+            count += 1
+    return count
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+def counter_value(report, name, **labels):
+    return sum(
+        value["value"]
+        for value in report["counters"].get(name, [])
+        if all(value["labels"].get(label) == str(label_value) for label, label_value in labels.items())
+    )
+
+def throughput(tiles, report, stage_name):
+    seconds = sum(stage["wall_seconds"] for stage in report["stages"] if stage["name"] == stage_name)
+    return {"tiles": tiles, "seconds": seconds, "tiles_per_second": tiles / seconds if seconds > 0 else 0.0}
+
+def run_case(feature_count, settings):
+    """Run the benchmarked stages for a synthetic alert of feature_count points"""
+    metrics.finish_run()
+    work_directory = tempfile.mkdtemp(prefix="gccd-benchmark-")
+    output_directory = os.path.join(work_directory, OUTPUT_FILENAME)
+    os.makedirs(os.path.join(output_directory, "resources"))
+    geojson_path = os.path.join(output_directory, "resources", f"{OUTPUT_FILENAME}.geojson")
+    write_synthetic_alert(geojson_path, feature_count)
+
+    output = sys.stdout if settings["verbose"] else open(os.devnull, "w")
+    try:
+        with contextlib.redirect_stdout(output):
+            bbox = get_bounding_box(geojson_path, settings["buffer_size"])["geometry"]["coordinates"][0]
+
+            with metrics.stage("raster_tiles"):
+                failed_tiles = generate_raster_tiles(
+                    settings["imagery_url"], "Benchmark imagery", settings["max_zoom"], bbox,
+                    output_directory, OUTPUT_FILENAME, settings["download_workers"],
+                )
+
+            # convert_raster_tiles imports an XYZ directory, so lay one out from the downloaded tiles
+            raster_mbtiles = os.path.join(output_directory, "mapgl-map", "tiles", f"{OUTPUT_FILENAME}-raster.mbtiles")
+            converted_tiles = export_xyz_directory(raster_mbtiles, os.path.join(output_directory, "mapgl-map", "tiles", "xyz"))
+            with metrics.stage("convert_raster_tiles"):
+                convert_raster_tiles(output_directory, OUTPUT_FILENAME)
+
+            generate_mbtiles_from_tileserver(
+                bbox, settings["max_zoom"], "Benchmark imagery", output_directory, OUTPUT_FILENAME,
+                settings["port"], render_workers=settings["render_workers"],
+            )
+
+        report = metrics.finish_run()
+        return {
+            "features": feature_count,
+            "raster_tiles": {
+                **throughput(counter_value(report, "tiles_total", source="downloaded"), report, "raster_tiles"),
+                "failed": failed_tiles,
+            },
+            "convert_raster_tiles": throughput(converted_tiles, report, "convert_raster_tiles"),
+            "tileserver_render": throughput(counter_value(report, "tiles_total", source="rendered"), report, "tileserver_render"),
+            "bytes_downloaded": counter_value(report, "bytes_downloaded_total"),
+            "disk_bytes": metrics.path_size(output_directory),
+            "peak_rss_bytes": peak_rss_bytes(),
+        }
+    finally:
+        if output is not sys.stdout:
+            output.close()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+def get_gccd_version():
+    try:
+        from importlib.metadata import version
+        return version("gccd")
+    except Exception:
+        return "unknown"
+
+def print_results(results):
+    stages = ("raster_tiles", "convert_raster_tiles", "tileserver_render")
+    print(f"{'features':>8}  " + "  ".join(f"{stage + ' tiles/sec':>30}" for stage in stages) + f"  {'peak RSS MB':>11}  {'disk MB':>8}")
+    for result in results:
+        rates = "  ".join(f"{result[stage]['tiles_per_second']:>20.1f} ({result[stage]['tiles']:>6})" for stage in stages)
+        peak_rss = result["peak_rss_bytes"] / 1024 / 1024 if result["peak_rss_bytes"] is not None else float("nan")
+        print(f"{result['features']:>8}  {rates}  {peak_rss:>11.1f}  {result['disk_bytes'] / 1024 / 1024:>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark tile download, conversion and rendering against a local fake tile server.')
+    parser.add_argument('--features', default="1,16,64,256", help='Comma-separated numbers of points in the synthetic alerts')
+    parser.add_argument('--max-zoom', type=int, default=15, help='Maximum zoom level of the raster and composite tiles')
+    parser.add_argument('--buffer-size', default="1", help='Buffer around the alert features, in km')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='Latency the fake tile server adds to each request')
+    parser.add_argument('--bandwidth-kbps', type=float, help='Bandwidth of each connection to the fake tile server, in KB/s (default unlimited)')
+    parser.add_argument('--download-workers', type=int, help='Number of imagery tiles downloaded concurrently')
+    parser.add_argument('--render-workers', type=int, help='Number of composite tiles rendered concurrently')
+    parser.add_argument('--output', help='Path of a JSON file to write the results to')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the benchmarked stages')
+    args = parser.parse_args()
+
+    bandwidth = int(args.bandwidth_kbps * 1024) if args.bandwidth_kbps else None
+    feature_counts = [int(count) for count in args.features.split(",")]
+
+    results = []
+    with FakeTileServer(latency=args.latency_ms / 1000, bandwidth=bandwidth) as server:
+        settings = {
+            "imagery_url": server.imagery_url,
+            "port": server.port,
+            "max_zoom": args.max_zoom,
+            "buffer_size": args.buffer_size,
+            "download_workers": args.download_workers,
+            "render_workers": args.render_workers,
+            "verbose": args.verbose,
+        }
+        for feature_count in feature_counts:
+            print(f"Benchmarking a synthetic alert of {feature_count} features...")
+            # A fresh process per alert, so peak RSS is not carried over between them
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results.append(executor.submit(run_case, feature_count, settings).result())
+
+    print_results(results)
+    if args.output:
+        report = {
+            "gccd_version": get_gccd_version(),
+            "python_version": platform.python_version(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "settings": {
+                "max_zoom": args.max_zoom,
+                "buffer_size": args.buffer_size,
+                "latency_ms": args.latency_ms,
+                "bandwidth_kbps": args.bandwidth_kbps,
+                "download_workers": args.download_workers,
+                "render_workers": args.render_workers,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"\033[1m\033[32mBenchmark results written to:\033[0m {args.output}")
+
+
+if __name__ == "__main__":
+    main()
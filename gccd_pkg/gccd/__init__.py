@@ -1,6 +1,6 @@
 import os
 
-from gccd.calculate_bbox import get_bounding_box
+from gccd.calculate_bbox import get_extents
 from gccd.generate_maps import generate_html_map, generate_overlay_map
 from gccd.generate_tiles import (
     generate_pmtiles_from_geotiff,
@@ -9,8 +9,12 @@ from gccd.generate_tiles import (
     convert_raster_tiles,
 )
 from gccd.generate_style import generate_style_with_mbtiles
+from gccd.asset_store import ASSETS_VERSION
 from gccd.generate_fonts_sprites import copy_fonts_and_sprites
-from gccd.utils import copy_input_files, generate_jpgs_from_geotiffs
+from gccd.manifest import BuildManifest
+from gccd.scheduler import Step, StepResult, run_steps
+from gccd.tile_cache import get_tile_cache
+from gccd.utils import copy_input_files, generate_jpgs_from_geotiffs, get_cpu_budget
 
 
 # Get environment variables
@@ -21,58 +25,188 @@ raster_imagery_url = os.getenv("RASTER_IMAGERY_URL")
 raster_imagery_attribution = os.getenv("RASTER_IMAGERY_ATTRIBUTION")
 raster_max_zoom = os.getenv("RASTER_MBTILES_MAX_ZOOM")
 raster_buffer_size = os.getenv("RASTER_BUFFER_SIZE")
+raster_download_workers = os.getenv("RASTER_DOWNLOAD_WORKERS")
+raster_download_retries = os.getenv("RASTER_DOWNLOAD_RETRIES")
+raster_download_rate_limit = os.getenv("RASTER_DOWNLOAD_RATE_LIMIT")
+tile_cache_path = os.getenv("TILE_CACHE_PATH")
+tile_cache_max_size_mb = os.getenv("TILE_CACHE_MAX_SIZE_MB")
+tile_cache_ttl_hours = os.getenv("TILE_CACHE_TTL_HOURS")
+raster_tile_cover = os.getenv("RASTER_TILE_COVER", "bbox")
+raster_footprint_min_zoom = os.getenv("RASTER_FOOTPRINT_MIN_ZOOM", 0)
+raster_download_zoom_levels = os.getenv("RASTER_DOWNLOAD_ZOOM_LEVELS")
+max_cpu_jobs = os.getenv("MAX_CPU_JOBS")
+force_rebuild = os.getenv("FORCE_REBUILD", "false").lower() in ("1", "true", "yes")
+
+
+def extents_step(input_geojson_path):
+    return Step(
+        "extents",
+        get_extents,
+        (input_geojson_path, raster_buffer_size, raster_tile_cover == "footprint"),
+        inputs=[input_geojson_path],
+        fingerprint={"raster_buffer_size": raster_buffer_size, "raster_tile_cover": raster_tile_cover},
+    )
 
 
-def flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename):
-
-    # STEP 1: Copy input files to resources, and generate a JPG version of the GeoTIFFs (if provided)
-    copy_input_files(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename)
-    if input_t0_path is not None and input_t1_path is not None:
-        generate_jpgs_from_geotiffs(input_t0_path, input_t1_path, output_directory, output_filename)
+def flow_settings():
+    """Return the settings, besides its inputs, that the outputs of flow depend on"""
+    return {
+        "map": [map_center_longitude, map_center_latitude, map_zoom],
+        "raster_imagery_url": raster_imagery_url,
+        "raster_imagery_attribution": raster_imagery_attribution,
+        "raster_max_zoom": raster_max_zoom,
+        "raster_buffer_size": raster_buffer_size,
+        "raster_tile_cover": raster_tile_cover,
+        "raster_footprint_min_zoom": raster_footprint_min_zoom,
+        "raster_download_zoom_levels": raster_download_zoom_levels,
+    }
 
-    # STEP 2: Get bounding box for GeoJSON
-    bounding_box = get_bounding_box(input_geojson_path, raster_buffer_size)
 
-    # STEP 3: Generate PMTiles for GeoTIFFS (if provided)
-    if input_t0_path is not None and input_t1_path is not None:
-        generate_pmtiles_from_geotiff(raster_max_zoom, "t0", output_directory, output_filename)
-        generate_pmtiles_from_geotiff(raster_max_zoom, "t1", output_directory, output_filename)
-
-    # STEP 4: Generate HTML map for previewing change detection alert
-    generate_html_map(
-        map_center_longitude,
-        map_center_latitude,
-        map_zoom,
-        input_geojson_path,
-        input_t0_path,
-        input_t1_path,
-        output_directory,
-        output_filename,
-    )
+def flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename):
+    has_geotiffs = input_t0_path is not None and input_t1_path is not None
+    resources_dir = os.path.join(output_directory, "resources")
+    mapgl_dir = os.path.join(output_directory, "mapgl-map")
+    tiles_dir = os.path.join(mapgl_dir, "tiles")
 
-    # STEP 5: Generate vector MBTiles from GeoJSON
-    generate_vector_mbtiles(output_directory, output_filename)
-
-    # STEP 6: Generate raster XYZ tiles from satellite imagery and bbox
-    generate_raster_tiles(
-        raster_imagery_url,
-        raster_imagery_attribution,
-        raster_max_zoom,
-        bounding_box["geometry"]["coordinates"][0],
-        output_directory,
-        output_filename,
-    )
+    # Create the output directories up front, so steps writing into them don't depend on each other
+    os.makedirs(resources_dir, exist_ok=True)
+    os.makedirs(tiles_dir, exist_ok=True)
 
-    # STEP 7: Convert raster XYZ directory to MBTiles
-    convert_raster_tiles(output_directory, output_filename + "-raster")
+    geojson_path = os.path.join(resources_dir, f"{output_filename}.geojson")
+    tif_paths = {t_number: os.path.join(resources_dir, f"{output_filename}_{t_number}.tif") for t_number in ("t0", "t1")}
 
-    # STEP 8: Generate stylesheet with MBTiles included
-    generate_style_with_mbtiles(raster_max_zoom, output_directory, output_filename)
+    # Steps declare the files they read and write, and run concurrently wherever they don't depend on each other.
+    # Steps whose inputs and settings are unchanged since the last run (see build-manifest.json) are skipped.
+    steps = []
 
-    # STEP 9: Download and copy over fonts and glyphs
-    copy_fonts_and_sprites(output_directory)
+    # STEP 1: Copy input files to resources, and generate a JPG version of the GeoTIFFs (if provided)
+    steps.append(Step(
+        "copy_input_files",
+        copy_input_files,
+        (input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename),
+        inputs=[input_geojson_path] + ([input_t0_path, input_t1_path] if has_geotiffs else []),
+        outputs=[geojson_path] + (list(tif_paths.values()) if has_geotiffs else []),
+        fingerprint={},
+    ))
+    if has_geotiffs:
+        steps.append(Step(
+            "generate_jpgs",
+            generate_jpgs_from_geotiffs,
+            (input_t0_path, input_t1_path, output_directory, output_filename),
+            inputs=[input_t0_path, input_t1_path],
+            outputs=[os.path.join(resources_dir, f"{output_filename}_{t_number}.jpg") for t_number in ("t0", "t1")],
+            fingerprint={},
+        ))
+
+    # STEP 2: Get bounding box for GeoJSON (and the buffered feature footprint, if only tiles intersecting it are fetched)
+    steps.append(extents_step(input_geojson_path))
+
+    # STEP 3: Generate PMTiles for GeoTIFFS (if provided), each in its own process with half of the CPU job budget.
+    # The original GeoTIFFs are read in place, so tiling starts without waiting for them to be staged.
+    if has_geotiffs:
+        processes = max(1, get_cpu_budget().jobs // 2)
+        input_tif_paths = {"t0": input_t0_path, "t1": input_t1_path}
+        for t_number in ("t0", "t1"):
+            steps.append(Step(
+                f"pmtiles_{t_number}",
+                generate_pmtiles_from_geotiff,
+                (raster_max_zoom, t_number, output_directory, output_filename, processes, input_tif_paths[t_number]),
+                inputs=[input_tif_paths[t_number]],
+                outputs=[os.path.join(resources_dir, f"{output_filename}_{t_number}.pmtiles")],
+                kind="cpu",
+                cpu_jobs=processes,
+                fingerprint={"raster_max_zoom": raster_max_zoom},
+            ))
 
-    # STEP 10: Generate overlay HTML map
-    generate_overlay_map(output_directory, output_filename)
+    # STEP 4: Generate HTML map for previewing change detection alert
+    steps.append(Step(
+        "html_map",
+        generate_html_map,
+        (
+            map_center_longitude,
+            map_center_latitude,
+            map_zoom,
+            input_geojson_path,
+            input_t0_path,
+            input_t1_path,
+            output_directory,
+            output_filename,
+        ),
+        outputs=[os.path.join(output_directory, f"{output_filename}.html")],
+        fingerprint={"map": [map_center_longitude, map_center_latitude, map_zoom], "swipe_map": has_geotiffs},
+    ))
 
-    return bounding_box
+    # STEP 5: Generate vector MBTiles from GeoJSON
+    steps.append(Step(
+        "vector_mbtiles",
+        generate_vector_mbtiles,
+        (output_directory, output_filename),
+        inputs=[geojson_path],
+        outputs=[os.path.join(tiles_dir, f"{output_filename}-vector.mbtiles")],
+        fingerprint={},
+    ))
+
+    # STEP 6: Download raster tiles from satellite imagery and bbox straight into MBTiles
+    steps.append(Step(
+        "raster_mbtiles",
+        generate_raster_tiles,
+        (
+            raster_imagery_url,
+            raster_imagery_attribution,
+            raster_max_zoom,
+            StepResult("extents", "bounding_box", "geometry", "coordinates", 0),
+            output_directory,
+            output_filename,
+            raster_download_workers,
+            get_tile_cache(tile_cache_path, tile_cache_max_size_mb, tile_cache_ttl_hours),
+            StepResult("extents", "footprint"),
+            raster_footprint_min_zoom,
+            raster_download_zoom_levels,
+            max_cpu_jobs,
+            raster_download_retries,
+            raster_download_rate_limit,
+        ),
+        outputs=[os.path.join(tiles_dir, f"{output_filename}-raster.mbtiles")],
+        fingerprint={
+            "raster_imagery_url": raster_imagery_url,
+            "raster_imagery_attribution": raster_imagery_attribution,
+            "raster_max_zoom": raster_max_zoom,
+            "raster_tile_cover": raster_tile_cover,
+            "raster_footprint_min_zoom": raster_footprint_min_zoom,
+            "raster_download_zoom_levels": raster_download_zoom_levels,
+        },
+        # A download with failed tiles is retried on the next run
+        cache_if=lambda failed_tiles: failed_tiles == 0,
+    ))
+
+    # STEP 7: Generate stylesheet with MBTiles included
+    steps.append(Step(
+        "style",
+        generate_style_with_mbtiles,
+        (raster_max_zoom, output_directory, output_filename),
+        outputs=[os.path.join(mapgl_dir, "style.json")],
+        fingerprint={"raster_max_zoom": raster_max_zoom},
+    ))
+
+    # STEP 8: Download and copy over fonts and glyphs
+    steps.append(Step(
+        "fonts_sprites",
+        copy_fonts_and_sprites,
+        (output_directory,),
+        outputs=[os.path.join(mapgl_dir, "fonts"), os.path.join(mapgl_dir, "sprites")],
+        fingerprint={"assets_version": ASSETS_VERSION},
+        # Linked again on the next run if the assets could not be downloaded
+        cache_if=lambda linked: linked is not False,
+    ))
+
+    # STEP 9: Generate overlay HTML map
+    steps.append(Step(
+        "overlay_map",
+        generate_overlay_map,
+        (output_directory, output_filename),
+        outputs=[os.path.join(mapgl_dir, "index.html")],
+        fingerprint={},
+    ))
+
+    # The results of the steps (e.g. the extents) are returned for the composite MBTiles
+    return run_steps(steps, manifest=BuildManifest(output_directory, force_rebuild))
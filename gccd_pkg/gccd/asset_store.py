@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tarfile
+import tempfile
+import threading
+
+from gccd import metrics
+from gccd.download_tiles import get_http_session, REQUEST_TIMEOUT
+from gccd.utils import link_file
+
+FONTS_ARCHIVE_URL = 'https://cmi4earth.blob.core.windows.net/public-map-tiles/change_detection/fonts.tar.gz'
+SPRITES_URL = 'https://cmi4earth.blob.core.windows.net/public-map-tiles/change_detection/sprites/'
+SPRITE_FILES = [
+    "sprite.json",
+    "sprite.png",
+    "sprite@2x.json",
+    "sprite@2x.png",
+]
+
+# Assets downloaded from other sources are stored as another version
+ASSETS_VERSION = hashlib.sha256(json.dumps([FONTS_ARCHIVE_URL, SPRITES_URL, SPRITE_FILES]).encode("utf-8")).hexdigest()[:16]
+DEFAULT_ASSET_STORE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "gccd", "assets")
+MANIFEST_FILENAME = "manifest.json"
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class AssetStoreError(Exception):
+    pass
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def extract_fonts(archive_path, fonts_dir):
+    # Extract fonts directly into fonts_dir (without creating a subdirectory)
+    with tarfile.open(archive_path, 'r:gz') as archive:
+        members = [m for m in archive.getmembers() if m.name.startswith('fonts/') and (m.isfile() or m.isdir())]
+        for member in members:
+            member.name = member.name.replace('fonts/', '', 1)
+        archive.extractall(fonts_dir, members=members)
+
+def download_file(url, path, source):
+    response = get_http_session().get(url, timeout=REQUEST_TIMEOUT)
+    if response.status_code != 200:
+        raise AssetStoreError(f"Failed to download {url}. Status code: {response.status_code}")
+    metrics.add("bytes_downloaded_total", len(response.content), source=source)
+    with open(path, "wb") as output_file:
+        output_file.write(response.content)
+
+
+class AssetStore:
+    """The fonts and sprites of the map style, downloaded (or seeded) once per
+    version into directory/<version> and shared by every output.
+
+    A version is installed by renaming a complete temporary directory into
+    place, so concurrent processes never see a partial one. Its manifest
+    records the size and SHA-256 of every file, checked once per process.
+    """
+
+    def __init__(self, directory=DEFAULT_ASSET_STORE_DIRECTORY, version=ASSETS_VERSION):
+        self.directory = directory
+        self.path = os.path.join(directory, version)
+        self.lock = threading.Lock()
+        self.verified = False
+        # A failed download is not retried by the same process, so that
+        # every output of an offline batch doesn't wait on it again
+        self.error = None
+
+    @property
+    def fonts_path(self):
+        return os.path.join(self.path, "fonts")
+
+    @property
+    def sprites_path(self):
+        return os.path.join(self.path, "sprites")
+
+    def manifest(self):
+        """Return the {relative path: {size, sha256}} of the installed files, or None"""
+        try:
+            with open(os.path.join(self.path, MANIFEST_FILENAME)) as manifest_file:
+                return json.load(manifest_file)["files"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def verify(self):
+        """Check every installed file against the manifest"""
+        manifest = self.manifest()
+        if not manifest:
+            return False
+        for relative_path, entry in manifest.items():
+            path = os.path.join(self.path, relative_path)
+            try:
+                if os.path.getsize(path) != entry["size"] or hash_file(path) != entry["sha256"]:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def ensure(self):
+        """Return the path of the installed assets, downloading them first if
+        needed. Raises AssetStoreError if they can't be downloaded."""
+        with self.lock:
+            if self.verified:
+                return self.path
+            if self.error is not None:
+                raise self.error
+            if os.path.isdir(self.path):
+                if self.verify():
+                    self.verified = True
+                    return self.path
+                print(f"\033[1m\033[31mFonts and sprites in {self.path} are incomplete or corrupt, downloading them again\033[0m")
+                shutil.rmtree(self.path, ignore_errors=True)
+            try:
+                self._install(self._download)
+            except AssetStoreError as e:
+                self.error = e
+                raise
+            self.verified = True
+            return self.path
+
+    def seed(self, fonts_archive_path, sprites_directory):
+        """Install the assets from a local copy of the fonts archive and sprite
+        files, e.g. to prepare a store for offline use"""
+        def copy_local(staging_directory):
+            shutil.copyfile(fonts_archive_path, os.path.join(staging_directory, "fonts.tar.gz"))
+            for sprite_file in SPRITE_FILES:
+                shutil.copyfile(os.path.join(sprites_directory, sprite_file), os.path.join(staging_directory, "sprites", sprite_file))
+
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._install(copy_local)
+            self.verified = True
+            self.error = None
+            return self.path
+
+    def _download(self, staging_directory):
+        print("Downloading fonts and sprites...")
+        download_file(FONTS_ARCHIVE_URL, os.path.join(staging_directory, "fonts.tar.gz"), "fonts")
+        for sprite_file in SPRITE_FILES:
+            download_file(SPRITES_URL + sprite_file, os.path.join(staging_directory, "sprites", sprite_file), "sprites")
+
+    def _install(self, fetch):
+        os.makedirs(self.directory, exist_ok=True)
+        staging_directory = tempfile.mkdtemp(prefix=".staging-", dir=self.directory)
+        try:
+            os.makedirs(os.path.join(staging_directory, "fonts"))
+            os.makedirs(os.path.join(staging_directory, "sprites"))
+            fetch(staging_directory)
+            archive_path = os.path.join(staging_directory, "fonts.tar.gz")
+            extract_fonts(archive_path, os.path.join(staging_directory, "fonts"))
+            os.remove(archive_path)
+
+            files = {}
+            for root, _, filenames in os.walk(staging_directory):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    files[os.path.relpath(path, staging_directory)] = {"size": os.path.getsize(path), "sha256": hash_file(path)}
+            with open(os.path.join(staging_directory, MANIFEST_FILENAME), "w") as manifest_file:
+                json.dump({"version": os.path.basename(self.path), "files": files}, manifest_file, indent=2)
+
+            try:
+                os.rename(staging_directory, self.path)
+            except OSError:
+                # Another process installed the same version first
+                if self.manifest() is None:
+                    raise
+        except Exception as e:
+            if isinstance(e, AssetStoreError):
+                raise
+            raise AssetStoreError(f"{type(e).__name__}: {e}")
+        finally:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+
+    def installed(self):
+        return self.manifest() is not None
+
+    def link_into(self, mapgl_dir, allow_symlinks=True):
+        """Link the fonts and sprites into mapgl_dir/fonts and mapgl_dir/sprites
+        (see link_file), returning how many files were linked each way. Files
+        already there are left as they are."""
+        methods = {}
+        for relative_path in self.manifest() or {}:
+            destination_path = os.path.join(mapgl_dir, relative_path)
+            if relative_path == MANIFEST_FILENAME or os.path.lexists(destination_path):
+                continue
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            method = link_file(os.path.join(self.path, relative_path), destination_path, allow_symlinks)
+            methods[method] = methods.get(method, 0) + 1
+        return methods
+
+
+def get_asset_store(directory=None):
+    """Return the process-wide AssetStore in directory (ASSET_STORE_DIRECTORY by default)"""
+    directory = directory or os.getenv("ASSET_STORE_DIRECTORY") or DEFAULT_ASSET_STORE_DIRECTORY
+    with _stores_lock:
+        store = _stores.get(directory)
+        if store is None:
+            store = _stores[directory] = AssetStore(directory)
+        return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the fonts and sprites into the shared asset store, or seed it from local copies of them.')
+    parser.add_argument('--fonts-archive', help='Path to a copy of the fonts archive (fonts.tar.gz)')
+    parser.add_argument('--sprites', help='Path to a directory with copies of the sprite files')
+    parser.add_argument('--directory', help='Asset store directory (defaults to ASSET_STORE_DIRECTORY)')
+    args = parser.parse_args()
+
+    if bool(args.fonts_archive) != bool(args.sprites):
+        sys.exit("\033[1m\033[31mError: both --fonts-archive and --sprites must be provided, or neither should be provided\033[0m")
+
+    store = get_asset_store(args.directory)
+    try:
+        if args.fonts_archive:
+            store.seed(args.fonts_archive, args.sprites)
+        else:
+            store.ensure()
+    except AssetStoreError as e:
+        sys.exit(f"\033[1m\033[31mError: {e}\033[0m")
+    print(f"\033[1m\033[32mFonts and sprites stored in:\033[0m {store.path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import os
+import glob
+import json
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_BATCH_WORKERS = 2
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# An alert GeoJSON, with its T0 and T1 GeoTIFFs if it has them
+Alert = namedtuple("Alert", ["name", "geojson_path", "t0_path", "t1_path"])
+
+
+def get_batch_workers(batch_workers=None):
+    try:
+        return max(1, int(batch_workers))
+    except (TypeError, ValueError):
+        return DEFAULT_BATCH_WORKERS
+
+def find_alerts(pattern):
+    """Return the alerts in a directory of GeoJSON files, or matching a glob.
+
+    Each alert is named after its GeoJSON file. GeoTIFFs next to it named
+    <name>_t0.tif and <name>_t1.tif are used as its T0 and T1 images.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.geojson")
+    alerts = []
+    for geojson_path in sorted(glob.glob(pattern)):
+        if not os.path.isfile(geojson_path):
+            continue
+        name = os.path.splitext(os.path.basename(geojson_path))[0]
+        prefix = os.path.join(os.path.dirname(geojson_path), name)
+        t0_path, t1_path = f"{prefix}_t0.tif", f"{prefix}_t1.tif"
+        if not (os.path.isfile(t0_path) and os.path.isfile(t1_path)):
+            t0_path = t1_path = None
+        alerts.append(Alert(name, geojson_path, t0_path, t1_path))
+
+    names = [alert.name for alert in alerts]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Alerts would share output directories: {', '.join(duplicates)}")
+    return alerts
+
+
+class BatchResults:
+    """Timings and failures of each alert of a batch, stage by stage."""
+
+    def __init__(self, alerts, batch_directory, workers):
+        self.started_at = time.time()
+        self.start_time = time.perf_counter()
+        self.workers = workers
+        self.alerts = {
+            alert.name: {
+                "name": alert.name,
+                "geojson": alert.geojson_path,
+                "t0": alert.t0_path,
+                "t1": alert.t1_path,
+                "output_directory": os.path.join(batch_directory, alert.name),
+                "status": SUCCEEDED,
+                "stages": {},
+                "error": None,
+            }
+            for alert in alerts
+        }
+
+    def succeeded(self, alerts):
+        return [alert for alert in alerts if self.alerts[alert.name]["status"] == SUCCEEDED]
+
+    def run_stage(self, stage_name, alerts, process_alert):
+        """Call process_alert(alert) for each alert that has not failed yet,
+        at most `workers` at a time. An alert failing does not stop the others."""
+
+        def run(alert):
+            start_time = time.perf_counter()
+            error = None
+            try:
+                process_alert(alert)
+            except (Exception, SystemExit) as e:
+                # Most gccd errors are printed, then exit
+                error = f"{type(e).__name__}: {e}"
+                print(f"\033[1m\033[31mAlert {alert.name} failed in {stage_name}:\033[0m {error}\n{traceback.format_exc()}")
+            return alert, time.perf_counter() - start_time, error
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as executor:
+            for alert, wall_seconds, error in executor.map(run, self.succeeded(alerts)):
+                result = self.alerts[alert.name]
+                result["stages"][stage_name] = wall_seconds
+                if error is not None:
+                    result["status"] = FAILED
+                    result["error"] = f"{stage_name}: {error}"
+
+    def to_dict(self):
+        alerts = list(self.alerts.values())
+        for alert in alerts:
+            alert["wall_seconds"] = sum(alert["stages"].values())
+        return {
+            "started_at": self.started_at,
+            "wall_seconds": time.perf_counter() - self.start_time,
+            "workers": self.workers,
+            "succeeded": sum(1 for alert in alerts if alert["status"] == SUCCEEDED),
+            "failed": sum(1 for alert in alerts if alert["status"] == FAILED),
+            "alerts": alerts,
+        }
+
+    def write_summary(self, path):
+        summary = self.to_dict()
+        with open(path, "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        print(f"\033[1m\033[32mBatch summary written to:\033[0m {path}")
+        for alert in summary["alerts"]:
+            if alert["status"] == FAILED:
+                print(f"\033[1m\033[31m{alert['name']} failed:\033[0m {alert['error']}")
+        print(f"\033[95m{summary['succeeded']} of {len(summary['alerts'])} alerts succeeded in {summary['wall_seconds']:.1f}s\033[0m")
+        return summary
@@ -1,23 +1,31 @@
-import json
+import functools
+import threading
+from collections import namedtuple
+
+import numpy as np
 import pyproj
-from shapely.geometry import Polygon
-from shapely.ops import transform
-from gccd.utils import read_geojson_file
+import shapely
+from shapely.geometry import GeometryCollection, Polygon, mapping, shape
+from shapely.ops import transform, unary_union
+from gccd.geojson_reader import feature_bounds, iter_features, total_bounds
+
+# The bounds of each geometry or feature, as an (n, 4) array of
+# [min_lon, min_lat, max_lon, max_lat], and of all of them together
+Extents = namedtuple("Extents", ["features", "bounds"])
 
 def get_bounding_box(input_geojson_path, raster_buffer_size=None):
+    # The bounds of the features are computed as the file is parsed, without holding on to the features
+    return bounding_box_from_bounds(total_bounds(feature_bounds(iter_features(input_geojson_path))), raster_buffer_size)
+
+def bounding_box_from_bounds(bounds, raster_buffer_size=None):
     try:
         raster_buffer_size = float(raster_buffer_size)
-    except ValueError:
+    except (TypeError, ValueError):
         raster_buffer_size = None
 
-    geojson_data = read_geojson_file(input_geojson_path)
-    geojson_dict = json.loads(geojson_data)
-    features = geojson_dict["features"]
-
-    if raster_buffer_size is None:
-        min_lon, min_lat, max_lon, max_lat = calculate_bounding_box(features)
-    else:
-        min_lon, min_lat, max_lon, max_lat = calculate_buffered_bbox(features, raster_buffer_size)
+    min_lon, min_lat, max_lon, max_lat = bounds
+    if raster_buffer_size is not None:
+        min_lon, min_lat, max_lon, max_lat = buffer_bbox(min_lon, min_lat, max_lon, max_lat, raster_buffer_size)
 
     bounding_box = format_bbox_as_geojson(min_lon, min_lat, max_lon, max_lat)
     print(f"\033[1m\033[32mGeoJSON Bounding Box:\033[0m", bounding_box)
@@ -36,45 +44,146 @@ def format_bbox_as_geojson(min_lon, min_lat, max_lon, max_lat):
     }
 
 def calculate_bounding_box(features):
-    min_x, min_y, max_x, max_y = float('inf'), float('inf'), float('-inf'), float('-inf')
-    for feature in features:
-        geometry_type = feature['geometry']['type']
-        coordinates = feature['geometry']['coordinates']
-
-        def traverse_coords(coords):
-            nonlocal min_x, min_y, max_x, max_y
-            if type(coords[0]) == list:
-                for coord in coords:
-                    traverse_coords(coord)
-            else:
-                x, y = coords
-                min_x = min(min_x, x)
-                min_y = min(min_y, y)
-                max_x = max(max_x, x)
-                max_y = max(max_y, y)
-
-        traverse_coords(coordinates)
-
-    return min_x, min_y, max_x, max_y
+    return total_bounds(feature_bounds(features))
 
 def calculate_buffered_bbox(features, raster_buffer_size):
-    min_lon, min_lat, max_lon, max_lat = calculate_bounding_box(features)
+    return buffer_bbox(*calculate_bounding_box(features), raster_buffer_size)
+
+def buffer_bbox(min_lon, min_lat, max_lon, max_lat, raster_buffer_size):
+    """Return the bounds of the rectangle buffered by raster_buffer_size (in km)"""
     bbox_polygon = Polygon([(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat)])
     
     average_lat = (min_lat + max_lat) / 2
-
-    wgs84 = pyproj.CRS('EPSG:4326')
-    zone_number = int((min_lon + 180) / 6) + 1
-    if average_lat < 0:  # Southern hemisphere
-        zone_code = f"327{zone_number:02}"  # UTM zone with '32' for southern hemisphere and padded zone number
-    else:  # Northern hemisphere
-        zone_code = f"326{zone_number:02}"  # UTM zone with '32' for northern hemisphere and padded zone number
-    utm_zone = pyproj.CRS(f"EPSG:{zone_code}")
-    project = pyproj.Transformer.from_crs(wgs84, utm_zone, always_xy=True).transform
-    inverse = pyproj.Transformer.from_crs(utm_zone, wgs84, always_xy=True).transform
+    project, inverse = get_utm_transformers(min_lon, average_lat)
 
     buffered_polygon = transform(project, bbox_polygon).buffer(float(raster_buffer_size) * 1000)  # Convert km to meters
     buffered_polygon_wgs84 = transform(inverse, buffered_polygon)
 
     min_lon, min_lat, max_lon, max_lat = buffered_polygon_wgs84.bounds
-    return min_lon, min_lat, max_lon, max_lat
\ No newline at end of file
+    return min_lon, min_lat, max_lon, max_lat
+
+def utm_zone_codes(lons, lats):
+    """Return the EPSG codes of the UTM zones containing arrays of lon/lat"""
+    zone_numbers = np.clip(((np.asarray(lons, dtype=float) + 180) // 6).astype(int) + 1, 1, 60)
+    # 326xx for the northern hemisphere, 327xx for the southern
+    return np.where(np.asarray(lats, dtype=float) < 0, 32700, 32600) + zone_numbers
+
+@functools.lru_cache(maxsize=256)
+def _utm_transformers(zone_code, thread_id):
+    # Transformers are not safe to share between threads, so each thread has its own
+    wgs84 = pyproj.CRS('EPSG:4326')
+    utm_zone = pyproj.CRS(f"EPSG:{zone_code}")
+    return (
+        pyproj.Transformer.from_crs(wgs84, utm_zone, always_xy=True),
+        pyproj.Transformer.from_crs(utm_zone, wgs84, always_xy=True),
+    )
+
+def get_utm_transformer_pair(zone_code):
+    """Return (project, inverse) pyproj Transformers between WGS84 and a UTM
+    zone, created once per zone (and thread)"""
+    return _utm_transformers(int(zone_code), threading.get_ident())
+
+def get_utm_transformers(lon, lat):
+    """Return (project, inverse) functions between WGS84 and the UTM zone containing lon/lat"""
+    project, inverse = get_utm_transformer_pair(utm_zone_codes(lon, lat))
+    return project.transform, inverse.transform
+
+def _transform_coordinates(transformer):
+    def transform_coordinates(coordinates):
+        x, y = transformer.transform(coordinates[:, 0], coordinates[:, 1])
+        return np.column_stack([x, y])
+    return transform_coordinates
+
+def as_geometries(geometries):
+    """Return an array of shapely geometries from GeoJSON features or
+    geometries, or shapely geometries. Missing geometries are empty."""
+    converted = []
+    for geometry in geometries:
+        if isinstance(geometry, dict) and geometry.get("type") == "Feature":
+            geometry = geometry.get("geometry")
+        if geometry is None:
+            geometry = GeometryCollection()
+        elif isinstance(geometry, dict):
+            geometry = shape(geometry)
+        converted.append(geometry)
+    array = np.empty(len(converted), dtype=object)
+    array[:] = converted
+    return array
+
+def buffer_geometries(geometries, buffer_size):
+    """Buffer each geometry by buffer_size (in km) in the UTM zone of its
+    centroid. The geometries in each zone are projected, buffered and
+    projected back together, with shapely's vectorized functions."""
+    geometries = as_geometries(geometries)
+    buffered = geometries.copy()
+    # Empty geometries have no centroid, and are left as they are
+    has_centroid = ~shapely.is_empty(geometries)
+    centroids = shapely.get_coordinates(shapely.centroid(geometries[has_centroid]))
+    zone_codes = np.zeros(len(geometries), dtype=int)
+    zone_codes[has_centroid] = utm_zone_codes(centroids[:, 0], centroids[:, 1])
+
+    for zone_code in np.unique(zone_codes[has_centroid]):
+        in_zone = has_centroid & (zone_codes == zone_code)
+        project, inverse = get_utm_transformer_pair(zone_code)
+        projected = shapely.transform(geometries[in_zone], _transform_coordinates(project))
+        # The same number of segments per quarter circle as Geometry.buffer
+        projected = shapely.buffer(projected, float(buffer_size) * 1000, quad_segs=16)  # Convert km to meters
+        buffered[in_zone] = shapely.transform(projected, _transform_coordinates(inverse))
+    return buffered
+
+def calculate_extents(geometries, buffer_size=None):
+    """Return the Extents of many GeoJSON features or geometries (or shapely
+    geometries) at once, each buffered by buffer_size (in km) if given"""
+    geometries = as_geometries(geometries)
+    if buffer_size:
+        # Only the extents are needed, so the convex hulls are buffered: their
+        # buffers are simpler to compute, and reach just as far
+        geometries = buffer_geometries(shapely.convex_hull(geometries), buffer_size)
+    bounds = shapely.bounds(geometries).reshape(-1, 4)
+    return Extents(bounds, total_bounds(bounds))
+
+def calculate_alert_extents(input_geojson_paths, buffer_size=None):
+    """Return the Extents of the features of each of many alert GeoJSON
+    files, buffered together (see calculate_extents)"""
+    geometries = []
+    offsets = [0]
+    for input_geojson_path in input_geojson_paths:
+        # Only the geometries are kept, not the rest of each feature
+        geometries.extend(feature.get("geometry") for feature in iter_features(input_geojson_path))
+        offsets.append(len(geometries))
+
+    bounds = calculate_extents(geometries, buffer_size).features
+    return [
+        Extents(bounds[start:end], total_bounds(bounds[start:end]))
+        for start, end in zip(offsets, offsets[1:])
+    ]
+
+def get_footprint(input_geojson_path, raster_buffer_size=None):
+    """Return the union of every feature geometry, each buffered by raster_buffer_size (in km)"""
+    return footprint_from_geometries(as_geometries(iter_features(input_geojson_path)), raster_buffer_size)
+
+def footprint_from_geometries(geometries, raster_buffer_size=None):
+    try:
+        raster_buffer_size = float(raster_buffer_size)
+    except (TypeError, ValueError):
+        raster_buffer_size = None
+
+    if raster_buffer_size:
+        geometries = buffer_geometries(geometries, raster_buffer_size)
+
+    return unary_union(geometries)
+
+def get_extents(input_geojson_path, raster_buffer_size=None, footprint=False):
+    """Return {"bounding_box", "footprint"} of the GeoJSON (see get_bounding_box
+    and get_footprint) from a single parse of it. The footprint, only computed
+    if asked for, is a GeoJSON geometry so that the result can be recorded in
+    the build manifest."""
+    if not footprint:
+        return {"bounding_box": get_bounding_box(input_geojson_path, raster_buffer_size), "footprint": None}
+
+    geometries = as_geometries(iter_features(input_geojson_path))
+    bounds = total_bounds(shapely.bounds(geometries).reshape(-1, 4))
+    return {
+        "bounding_box": bounding_box_from_bounds(bounds, raster_buffer_size),
+        "footprint": mapping(footprint_from_geometries(geometries, raster_buffer_size)),
+    }
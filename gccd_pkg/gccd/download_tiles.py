@@ -0,0 +1,300 @@
+import time
+import heapq
+import random
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from gccd import metrics
+
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_DOWNLOAD_RETRIES = 5
+# (connect, read) timeouts in seconds for a single tile request
+REQUEST_TIMEOUT = (10, 60)
+
+# Retries wait a random time of up to BACKOFF_BASE * 2 ** attempt seconds, capped at BACKOFF_CAP
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# Longest Retry-After honoured, so that a misconfigured provider can't stall a run
+MAX_RETRY_AFTER = 300.0
+
+# The concurrency limit is halved at most once per cooldown, so a burst of
+# errors from the same overload only halves it once
+DECREASE_COOLDOWN = 2.0
+# Requests are slow when the smoothed latency is LATENCY_FACTOR times the
+# lowest seen, and at least LATENCY_SLACK seconds above it
+LATENCY_FACTOR = 3.0
+LATENCY_SLACK = 0.5
+LATENCY_SMOOTHING = 0.2
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+def get_download_workers(download_workers=None):
+    try:
+        download_workers = int(download_workers)
+    except (TypeError, ValueError):
+        download_workers = DEFAULT_DOWNLOAD_WORKERS
+    return max(1, download_workers)
+
+def get_download_retries(download_retries=None):
+    try:
+        return max(0, int(download_retries))
+    except (TypeError, ValueError):
+        return DEFAULT_DOWNLOAD_RETRIES
+
+
+def get_http_session(pool_size=DEFAULT_DOWNLOAD_WORKERS):
+    """Return the process-wide requests Session, sized so that each worker
+    thread can hold a keep-alive connection to the tile host."""
+    global _session, _session_pool_size
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        if pool_size > _session_pool_size:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+            _session_pool_size = pool_size
+        return _session
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait given by a Retry-After header (a number of
+    seconds or an HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+def backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retry number attempt (from 0): the server's
+    Retry-After if it sent one, else exponential backoff with full jitter"""
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class TileFetchError(Exception):
+    """A tile that could not be fetched, and whether it is worth retrying"""
+
+    def __init__(self, reason, url=None, status=None, retryable=True, throttled=False, retry_after=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.url = url
+        self.status = status
+        self.retryable = retryable
+        self.throttled = throttled
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response, url):
+        status = response.status_code
+        # Too Many Requests and Service Unavailable ask us to slow down
+        throttled = status in (429, 503)
+        return cls(
+            f"Status code: {status}",
+            url,
+            status,
+            retryable=throttled or status == 408 or status >= 500,
+            throttled=throttled,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+
+class HostLimiter:
+    """Limits the requests to one host: to `rate` per second with bursts of
+    up to `burst` (a token bucket), if a rate is given, and not at all while
+    the host has asked us to wait with Retry-After"""
+
+    def __init__(self, rate=None, burst=None):
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate=None, burst=None):
+        try:
+            rate = float(rate) if rate else None
+        except ValueError:
+            rate = None
+        with self.lock:
+            self.rate = rate if rate and rate > 0 else None
+            self.capacity = float(burst) if burst else max(1.0, self.rate or 1.0)
+            self.tokens = self.capacity
+            self.updated = time.monotonic()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait_time = self.paused_until - now
+                if wait_time <= 0:
+                    if self.rate is None:
+                        return
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_host_limiter(host, rate=None, burst=None):
+    """Return the process-wide HostLimiter of a host, so that concurrent
+    downloads from the same provider share its limits"""
+    with _host_limiters_lock:
+        limiter = _host_limiters.get(host)
+        if limiter is None:
+            limiter = _host_limiters[host] = HostLimiter(rate, burst)
+        elif rate:
+            limiter.set_rate(rate, burst)
+        return limiter
+
+
+class AdaptiveConcurrency:
+    """Additive increase, multiplicative decrease (AIMD) limit on the number
+    of requests in flight: halved on throttling, errors or a latency spike,
+    and raised by one after `limit` requests in a row succeed"""
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(1, int(max_limit))
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.limit = self.max_limit
+        self.successes = 0
+        self.last_decrease = float("-inf")
+        self.latency = None
+        self.min_latency = None
+
+    def _is_slow(self, latency):
+        if latency is None:
+            return False
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        self.min_latency = self.latency if self.min_latency is None else min(self.min_latency, self.latency)
+        return self.latency > LATENCY_FACTOR * self.min_latency and self.latency - self.min_latency > LATENCY_SLACK
+
+    def record_success(self, latency=None):
+        if self._is_slow(latency):
+            self._decrease()
+            return
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.max_limit:
+            self.limit += 1
+            self.successes = 0
+
+    def record_failure(self):
+        self._decrease()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease >= DECREASE_COOLDOWN:
+            self.limit = max(self.min_limit, self.limit // 2)
+            self.last_decrease = now
+        self.successes = 0
+
+
+def fetch_tiles(tiles, fetch_tile, workers=DEFAULT_DOWNLOAD_WORKERS, retries=0, host_limiter=None, concurrency=None, failures=None):
+    """Call fetch_tile(tile) for every tile using a pool of worker threads.
+
+    Yields (tile, result) pairs in completion order. At most a few tiles per
+    worker are queued at once, so very large tile lists are not materialized
+    as futures up front.
+
+    A tile whose fetch_tile raises a retryable TileFetchError is retried up
+    to `retries` times, after a backoff (see backoff_delay) during which the
+    other tiles carry on. Tiles that still fail are yielded with a None
+    result and appended to `failures` as dicts. Requests wait on the
+    host_limiter, if given, and at most concurrency.limit (an
+    AdaptiveConcurrency) tiles are fetched at once. Other exceptions raised
+    by fetch_tile propagate to the caller.
+    """
+    tiles = iter(tiles)
+    exhausted = False
+    # Tiles waiting to be retried: (time to retry at, sequence, tile, attempt)
+    delayed = []
+    sequence = 0
+
+    def timed_fetch(tile):
+        if host_limiter is not None:
+            host_limiter.acquire()
+        start_time = time.perf_counter()
+        result = fetch_tile(tile)
+        return result, time.perf_counter() - start_time
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def current_limit():
+            return min(workers, concurrency.limit) if concurrency is not None else workers * 4
+
+        def submit_next():
+            nonlocal exhausted
+            now = time.monotonic()
+            while len(pending) < current_limit():
+                if delayed and delayed[0][0] <= now:
+                    _, _, tile, attempt = heapq.heappop(delayed)
+                elif not exhausted:
+                    tile = next(tiles, None)
+                    if tile is None:
+                        exhausted = True
+                        continue
+                    attempt = 0
+                else:
+                    break
+                pending[executor.submit(timed_fetch, tile)] = (tile, attempt)
+
+        submit_next()
+        while pending or delayed:
+            # Wake up for the next delayed retry if there is room to start it
+            timeout = None
+            if delayed and len(pending) < current_limit():
+                timeout = max(0.0, delayed[0][0] - time.monotonic())
+            if pending:
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+                done = ()
+            for future in done:
+                tile, attempt = pending.pop(future)
+                try:
+                    result, latency = future.result()
+                except TileFetchError as e:
+                    if concurrency is not None and (e.throttled or e.retryable):
+                        concurrency.record_failure()
+                    if e.throttled and e.retry_after and host_limiter is not None:
+                        host_limiter.pause(e.retry_after)
+                    if e.retryable and attempt < retries:
+                        metrics.add("tile_retries_total", status=e.status or "error")
+                        sequence += 1
+                        heapq.heappush(delayed, (time.monotonic() + backoff_delay(attempt, e.retry_after), sequence, tile, attempt + 1))
+                        continue
+                    if failures is not None:
+                        failures.append({"tile": list(tile), "url": e.url, "reason": e.reason, "attempts": attempt + 1})
+                    yield tile, None
+                    continue
+                if concurrency is not None:
+                    concurrency.record_success(latency)
+                yield tile, result
+            submit_next()
@@ -1,34 +1,59 @@
 import os
-import subprocess
+import shlex
 import sys
 import shutil
 import json
+import hashlib
 import requests
-import socket
 import time
-import math
 import mercantile
-import sqlite3
-
-def generate_pmtiles_from_geotiff(raster_max_zoom, t_number, output_directory, output_filename):
+import queue
+import threading
+from collections import Counter
+from urllib.parse import urlparse
+
+from gccd import metrics
+from gccd.download_tiles import (
+    AdaptiveConcurrency,
+    TileFetchError,
+    fetch_tiles,
+    get_download_retries,
+    get_download_workers,
+    get_host_limiter,
+    get_http_session,
+    REQUEST_TIMEOUT,
+)
+from gccd.mbtiles import MBTilesWriter, import_xyz_directory, read_metadata
+from gccd.overviews import build_overviews
+from gccd.pmtiles import PMTilesWriter
+from gccd.tile_cover import as_footprint, get_tile_cover
+
+RENDER_RETRIES = 3
+# Maximum number of seconds rendered tiles are held before being committed
+CHECKPOINT_INTERVAL = 30
+
+def generate_pmtiles_from_geotiff(raster_max_zoom, t_number, output_directory, output_filename, processes=1, input_tif_path=None):
+    """Tile the t0 or t1 GeoTIFF into resources/<output_filename>_<t_number>.pmtiles.
+
+    The original GeoTIFF is read in place from input_tif_path if given and
+    readable, so tiling does not wait for it to be staged into resources/.
+    """
     resources_dir = os.path.join(output_directory, "resources")
     os.makedirs(resources_dir, exist_ok=True)
 
     tif_filename = f"{output_filename}_{t_number}"
-    tif_filepath = os.path.join(resources_dir, os.path.basename(tif_filename)) 
+    tif_filepath = os.path.join(resources_dir, f"{os.path.basename(tif_filename)}.tif")
+    if input_tif_path is not None and os.access(input_tif_path, os.R_OK):
+        tif_filepath = input_tif_path
     xyz_dir = f"{resources_dir}/{tif_filename}/"
-    mbtiles_file = f"{resources_dir}/{tif_filename}.mbtiles"
     pmtiles_file = f"{resources_dir}/{tif_filename}.pmtiles"
 
     try:
         # Convert GeoTIFF to XYZ
-        geotiff_to_xyz(raster_max_zoom, tif_filepath, xyz_dir)
-
-        # Convert XYZ to MBTiles
-        xyz_to_mbtiles(xyz_dir, "png", mbtiles_file)
+        geotiff_to_xyz(raster_max_zoom, tif_filepath, xyz_dir, processes)
 
-        # Convert MBTiles to PMTiles
-        mbtiles_to_pmtiles(mbtiles_file, pmtiles_file)
+        # Convert XYZ to PMTiles
+        xyz_to_pmtiles(xyz_dir, "png", pmtiles_file)
 
         print(f"\033[1m\033[32mPMTiles file generated:\033[0m {pmtiles_file}")
 
@@ -51,7 +76,7 @@ def generate_vector_mbtiles(output_directory, output_filename):
     command = f"tippecanoe -o {vector_mbtiles_output_path} --force {output_directory}/resources/{output_filename}.geojson"
 
     try:
-        ret = os.system(command)
+        ret = metrics.run_command("tippecanoe", command)
         if ret == 0:
             print(f"\033[1m\033[32mVector MBTiles file generated:\033[0m {vector_mbtiles_output_path}")
         else:
@@ -61,61 +86,30 @@ def generate_vector_mbtiles(output_directory, output_filename):
         print(f"\033[1m\033[31mError generating Vector MBTiles:\033[0m {e}")
         sys.exit(1)
 
-def generate_raster_tiles(raster_imagery_url, raster_imagery_attribution, raster_max_zoom, bbox, output_directory, output_filename):
-    xyz_output_dir = os.path.join(output_directory, "mapgl-map/tiles/xyz")
-    os.makedirs(xyz_output_dir, exist_ok=True)
-
-    bbox_top_left = bbox[0]
-    bbox_bottom_right = bbox[2]
-
-    # Convert lat/long to Bing XYZ style spherical mercator tiles using Mercanetile
-    def latlon_to_tilexy(lat, lon, zoom):
-        tile = mercantile.tile(lon, lat, zoom)
-        return tile.x, tile.y
-
-    def download_xyz_tile(xyz_url, filename):
-        if os.path.exists(filename):
-            return
-
-        # Download the tile and save it to the specified location
-        response = requests.get(xyz_url)
-        if response.status_code == 200:
-            with open(filename, "wb") as f:
-                f.write(response.content)
-            # Uncomment the following line if you want to see each file download printed
-            # print(f"Downloaded at zoom level {zoom_level}: {xyz_url} -> {filename}")
-        else:
-            print(f"Failed to download: {xyz_url} (Status code: {response.status_code})")
-            print(response.text)
-
-    print("Downloading satellite imagery raster XYZ tiles...")
-    
-    # Much of the below code is adapted from Microsoft's Bing Maps Tile System documentation:
-    # https://learn.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
-    for zoom_level in range(1, int(raster_max_zoom) + 1):
-        col_start, row_end = latlon_to_tilexy(bbox_top_left[1], bbox_top_left[0], zoom_level)
-        col_end, row_start = latlon_to_tilexy(bbox_bottom_right[1], bbox_bottom_right[0], zoom_level)
-
-        # Calciulate quadkey for Bing maps API download
-        for col in range(col_start, col_end + 1):
-            for row in range(row_start, row_end + 1):
-                quadkey = ""
-                for i in range(zoom_level, 0, -1):
-                    digit = 0
-                    mask = 1 << (i - 1)
-                    if (col & mask) != 0:
-                        digit += 1
-                    if (row & mask) != 0:
-                        digit += 2
-                    quadkey += str(digit)
-
-                xyz_url = raster_imagery_url.format(q=quadkey)
-
-                filename = f"{xyz_output_dir}/{zoom_level}/{col}/{row}.jpg"
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-
-                download_xyz_tile(xyz_url, filename)
-        print(f"Zoom level {zoom_level} downloaded")
+def generate_raster_tiles(raster_imagery_url, raster_imagery_attribution, raster_max_zoom, bbox, output_directory, output_filename, download_workers=None, tile_cache=None, footprint=None, footprint_min_zoom=0, download_zoom_levels=None, max_cpu_jobs=None, download_retries=None, download_rate_limit=None):
+    tiles_dir = os.path.join(output_directory, "mapgl-map", "tiles")
+    os.makedirs(tiles_dir, exist_ok=True)
+    mbtiles_output_path = os.path.join(tiles_dir, f"{output_filename}-raster.mbtiles")
+
+    workers = get_download_workers(download_workers)
+    session = get_http_session(workers)
+    retries = get_download_retries(download_retries)
+    # Requests to the imagery host are rate limited across all downloads in
+    # this process, and the number in flight adapts to how the host copes
+    host_limiter = get_host_limiter(urlparse(raster_imagery_url).netloc, download_rate_limit)
+    concurrency = AdaptiveConcurrency(workers)
+    failures = []
+    failures_report_path = os.path.join(output_directory, "failed-tiles.json")
+
+    # Only the highest download_zoom_levels zoom levels are downloaded; the
+    # levels below them are built by downsampling (see gccd.overviews)
+    max_zoom = int(raster_max_zoom)
+    download_min_zoom = 1
+    try:
+        if int(download_zoom_levels) > 0:
+            download_min_zoom = max(1, max_zoom - int(download_zoom_levels) + 1)
+    except (TypeError, ValueError):
+        pass
 
     metadata = {
         "name": output_filename,
@@ -123,74 +117,207 @@ def generate_raster_tiles(raster_imagery_url, raster_imagery_attribution, raster
         "version": "1.0.0",
         "attribution": raster_imagery_attribution,
         "format": "jpg",
-        "type": "overlay"
+        "type": "overlay",
+        # Tiles of an earlier run are only reused if they were fetched from the
+        # same imagery, zoom levels and tile cover
+        "tile_source": json.dumps({
+            "url": raster_imagery_url,
+            "zoom": [download_min_zoom, max_zoom],
+            "bbox": bbox,
+            "footprint": hashlib.sha256(as_footprint(footprint).wkb).hexdigest() if footprint is not None else None,
+            "footprint_min_zoom": footprint_min_zoom,
+        }, sort_keys=True),
     }
+    resume = read_metadata(mbtiles_output_path).get("tile_source") == metadata["tile_source"]
 
-    metadata_file_path = os.path.join(xyz_output_dir, "metadata.json")
+    def download_xyz_tile(tile):
+        zoom_level, col, row = tile
 
-    with open(metadata_file_path, "w") as metadata_file:
-        json.dump(metadata, metadata_file, indent=4)
+        # Serve the tile from the shared cache if it holds a fresh copy
+        cached = tile_cache.get(raster_imagery_url, zoom_level, col, row) if tile_cache else None
+        if cached is not None and cached.fresh:
+            writer.add_tile(zoom_level, col, row, cached.data)
+            return "cached"
 
-    print(f"XYZ tiles metadata.json saved to {metadata_file_path}")
+        # Calculate quadkey for Bing maps API download
+        quadkey = mercantile.quadkey(col, row, zoom_level)
+        xyz_url = raster_imagery_url.format(q=quadkey)
+
+        # Revalidate a stale cached tile rather than downloading it again
+        headers = {}
+        if cached is not None and cached.etag:
+            headers["If-None-Match"] = cached.etag
+
+        # Download the tile and hand it to the MBTiles writer. Failures are
+        # retried by fetch_tiles
+        try:
+            response = session.get(xyz_url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            raise TileFetchError(f"{type(e).__name__}: {e}", xyz_url)
+        if response.status_code == 304 and cached is not None:
+            tile_cache.mark_revalidated(raster_imagery_url, zoom_level, col, row)
+            writer.add_tile(zoom_level, col, row, cached.data)
+            return "cached"
+        elif response.status_code == 200:
+            metrics.add("bytes_downloaded_total", len(response.content), source="imagery")
+            writer.add_tile(zoom_level, col, row, response.content)
+            if tile_cache:
+                tile_cache.put(raster_imagery_url, zoom_level, col, row, response.content, response.headers.get("ETag"))
+            # Uncomment the following line if you want to see each file download printed
+            # print(f"Downloaded at zoom level {zoom_level}: {xyz_url}")
+            return "downloaded"
+        else:
+            raise TileFetchError.from_response(response, xyz_url)
+
+    print(f"Downloading satellite imagery raster tiles with {workers} workers...")
+
+    failed_tiles = 0
+    with MBTilesWriter(mbtiles_output_path, metadata, overwrite=not resume) as writer:
+        # Tiles already present from an interrupted run are not downloaded again
+        existing_tiles = writer.existing_tiles() if resume else set()
+        if existing_tiles:
+            print(f"Resuming raster MBTiles download: {len(existing_tiles)} tiles already downloaded")
+
+        # Much of the below code is adapted from Microsoft's Bing Maps Tile System documentation:
+        # https://learn.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+        # Tiles are Bing XYZ style spherical mercator tiles, either covering the whole bbox
+        # or only the (buffered) feature footprint
+        for zoom_level, zoom_tiles in get_tile_cover(bbox, download_min_zoom, max_zoom, footprint, footprint_min_zoom):
+            tiles = (
+                (zoom_level, col, row)
+                for col, row in zoom_tiles
+                if (zoom_level, col, row) not in existing_tiles
+            )
+
+            start_time = time.perf_counter()
+            results = Counter(
+                result
+                for _, result in fetch_tiles(tiles, download_xyz_tile, workers, retries, host_limiter, concurrency, failures)
+            )
+            writer.flush()
+            failed_tiles += results[None]
+            for result in ("downloaded", "cached"):
+                metrics.add("tiles_total", results[result], source=result)
+            metrics.add("tiles_total", results[None], source="failed")
+            elapsed = time.perf_counter() - start_time
+            fetched = results["downloaded"] + results["cached"]
+            tiles_per_second = fetched / elapsed if elapsed > 0 else 0.0
+            print(
+                f"Zoom level {zoom_level}: {results['downloaded']} tiles downloaded, "
+                f"{results['cached']} from cache in {elapsed:.1f}s ({tiles_per_second:.1f} tiles/sec, "
+                f"{concurrency.limit} concurrent requests)"
+            )
+
+        if download_min_zoom > 1:
+            print(f"Building zoom levels 1 to {download_min_zoom - 1} from the downloaded tiles...")
+            build_overviews(writer, download_min_zoom, 1, max_cpu_jobs, existing_tiles)
+
+    if tile_cache:
+        cache_stats = tile_cache.stats()
+        print(f"Tile cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['stale']} stale, {cache_stats['bytes'] / 1024 / 1024:.1f} MB in {tile_cache.cache_path}")
+
+    write_failed_tiles_report(failures_report_path, failures)
+    print("\033[1m\033[32mRaster MBTiles file generated:\033[0m", f"{mbtiles_output_path}")
+    # Returned so that callers can tell an incomplete download apart
+    return failed_tiles
+
+def write_failed_tiles_report(report_path, failures):
+    """List the tiles that could not be downloaded, after all retries, in
+    report_path; or remove the report of an earlier run if none failed"""
+    if not failures:
+        if os.path.exists(report_path):
+            os.remove(report_path)
+        return
+    for failure in failures:
+        print(f"\033[1m\033[31mFailed to download:\033[0m {failure['url']} ({failure['reason']}, {failure['attempts']} attempts)")
+    with open(report_path, "w") as report_file:
+        json.dump({"failed_tiles": len(failures), "tiles": failures}, report_file, indent=2)
+    print(f"\033[1m\033[31m{len(failures)} tiles failed to download, see:\033[0m {report_path}")
 
 def convert_raster_tiles(output_directory, output_filename):
+    # generate_raster_tiles writes straight into MBTiles; this only converts an
+    # XYZ directory left behind by older versions or produced by other tooling
     mapgl_dir = os.path.join(output_directory, 'mapgl-map')
     xyz_output_dir = os.path.join(mapgl_dir, 'tiles', 'xyz')
     mbtiles_output_path = os.path.join(mapgl_dir, 'tiles', f"{output_filename}.mbtiles")
-    xyz_to_mbtiles(xyz_output_dir, "jpg", mbtiles_output_path)
-
-def geotiff_to_xyz(raster_max_zoom, tif_filepath, xyz_dir):
-    command = f"gdal2tiles.py -p mercator -z 0-{raster_max_zoom} -w none -r bilinear --xyz {tif_filepath}.tif {xyz_dir}"
-    ret = os.system(command)
+    if not os.path.isdir(xyz_output_dir):
+        return
+    with MBTilesWriter(mbtiles_output_path) as writer:
+        tile_count = import_xyz_directory(xyz_output_dir, "jpg", writer)
+    print("\033[1m\033[32mMBTiles file updated:\033[0m", f"{mbtiles_output_path} ({tile_count} tiles)")
+
+    shutil.rmtree(xyz_output_dir)
+    print(f"Deleted XYZ directory: {xyz_output_dir}")
+
+def geotiff_to_xyz(raster_max_zoom, tif_filepath, xyz_dir, processes=1):
+    command = f"gdal2tiles.py -p mercator -z 0-{raster_max_zoom} -w none -r bilinear --xyz --processes={processes} {shlex.quote(tif_filepath)} {shlex.quote(xyz_dir)}"
+    ret = metrics.run_command("gdal2tiles", command)
     if ret != 0:
         raise Exception(f"gdal2tiles.py exit code {ret}")
-        sys.exit(1)
 
-def xyz_to_mbtiles(xyz_dir, image_format, mbtiles_file):
-    if os.path.exists(mbtiles_file):
-        os.remove(mbtiles_file)
-        print(f"Deleted existing MBTiles file: {mbtiles_file}")
+def xyz_to_pmtiles(xyz_dir, image_format, pmtiles_file):
+    # Convert XYZ to PMTiles by reading the tiles straight into the archive
+    print("Creating PMTiles...")
+    with PMTilesWriter(pmtiles_file, {"format": image_format}) as writer:
+        tile_count = import_xyz_directory(xyz_dir, image_format, writer)
+    print(f"PMTiles archive written with {tile_count} tiles")
 
-    # Convert XYZ to MBTiles using mb-util
-    command = f"mb-util --image_format={image_format} --silent {xyz_dir} {mbtiles_file}"
+    shutil.rmtree(xyz_dir)
+    print(f"Deleted XYZ directory: {xyz_dir}")
 
-    print("Creating MBTiles...")
+def download_tile(zoom, x, y, url_template, session=None):
+    """Fetch a rendered tile once, raising a TileFetchError that fetch_tiles
+    retries (with backoff) if it failed"""
+    tile_url = url_template.format(z=zoom, x=x, y=y)
+    session = session or get_http_session()
     try:
-        subprocess.call(command, shell=True)
-        print()
-        print("\033[1m\033[32mMBTiles file generated:\033[0m", f"{mbtiles_file}")
+        response = session.get(tile_url, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        raise TileFetchError(f"{type(e).__name__}: {e}", tile_url)
+    if response.status_code != 200:
+        raise TileFetchError.from_response(response, tile_url)
+    return response.content
 
-        shutil.rmtree(xyz_dir)
-        print(f"Deleted XYZ directory: {xyz_dir}")
-    except subprocess.CalledProcessError:
-        raise RuntimeError(f"\033[1m\033[31mFailed to generate MBTiles using command:\033[0m {command}")
-    
-def mbtiles_to_pmtiles(mbtiles_file, pmtiles_file):
-    if os.path.exists(pmtiles_file):
-        os.remove(pmtiles_file)
-        print(f"Deleted existing PMTiles file: {pmtiles_file}")
+def get_render_workers(render_workers=None):
+    try:
+        render_workers = int(render_workers)
+    except (TypeError, ValueError):
+        render_workers = os.cpu_count() or 1
+    return max(1, render_workers)
 
-    # Convert MBTiles to PMTiles using go-pmtiles
-    command = f"pmtiles convert {mbtiles_file} {pmtiles_file}"
+def start_tile_writer(writer, tile_queue, checkpoint_interval=CHECKPOINT_INTERVAL):
+    """Start the single thread that drains (zoom, x, y, tile_data) items from
+    tile_queue into the MBTiles writer, until it receives None.
 
-    print("Creating PMTiles...")
-    ret = os.system(command)
-    os.remove(mbtiles_file)
-    if ret != 0:
-        raise Exception(f"pmtiles convert exit code {ret}")
-        sys.exit(1)
-
-def download_tile(zoom, x, y, url_template):
-    tile_url = url_template.format(z=zoom, x=x, y=y)
-    response = requests.get(tile_url)
-    response.raise_for_status()
-    return response.content
+    Besides the writer's own batched commits, pending tiles are committed at
+    least every checkpoint_interval seconds so a crash loses little work."""
+    state = {"error": None}
 
-def latlon_to_tile(lat, lon, zoom):
-    n = 2.0 ** zoom
-    xtile = int((lon + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(math.radians(lat)) + (1 / math.cos(math.radians(lat)))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
+    def write_tiles():
+        last_checkpoint = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = tile_queue.get(timeout=checkpoint_interval)
+                except queue.Empty:
+                    item = False
+                if item is None:
+                    break
+                if item:
+                    writer.add_tile(*item)
+                if time.monotonic() - last_checkpoint >= checkpoint_interval:
+                    writer.flush()
+                    last_checkpoint = time.monotonic()
+            writer.flush()
+        except Exception as e:
+            state["error"] = e
+            # Keep draining so the render workers never block on a full queue
+            while tile_queue.get() is not None:
+                pass
+
+    thread = threading.Thread(target=write_tiles, name="mbtiles-writer", daemon=True)
+    thread.start()
+    return thread, state
 
 def wait_for_tileserver_gl(address, port):
     while True:
@@ -203,7 +330,11 @@ def wait_for_tileserver_gl(address, port):
             pass
         time.sleep(2)
 
-def generate_mbtiles_from_tileserver(bbox, maxzoom, raster_imagery_attribution, output_directory, output_filename, env_port):
+def generate_mbtiles_from_tileserver(bbox, maxzoom, raster_imagery_attribution, output_directory, output_filename, env_port, footprint=None, footprint_min_zoom=0, render_workers=None, resume=False):
+    with metrics.stage("tileserver_render"):
+        render_mbtiles_from_tileserver(bbox, maxzoom, raster_imagery_attribution, output_directory, output_filename, env_port, footprint, footprint_min_zoom, render_workers, resume)
+
+def render_mbtiles_from_tileserver(bbox, maxzoom, raster_imagery_attribution, output_directory, output_filename, env_port, footprint=None, footprint_min_zoom=0, render_workers=None, resume=False):
     try:
         minzoom = 0
         maxzoom = int(maxzoom)
@@ -219,66 +350,74 @@ def generate_mbtiles_from_tileserver(bbox, maxzoom, raster_imagery_attribution,
 
         url_template = f"http://{address}:{port}/styles/{output_filename}/{{z}}/{{x}}/{{y}}.jpg"
 
-        longitudes = [coord[0] for coord in bbox]
-        latitudes = [coord[1] for coord in bbox]
-
-        bbox = [min(longitudes), min(latitudes), max(longitudes), max(latitudes)]
-        west, south, east, north = bbox
-
         output_file = os.path.join(output_directory, f"{output_filename}.mbtiles")
 
-        if os.path.exists(output_file):
-            os.remove(output_file)
-
         # Wait until Tileserver-GL has fully started
         wait_for_tileserver_gl(address, port)
         
-        print("Downloading composite raster tiles from Tileserver-GL...")
-        conn = sqlite3.connect(output_file)
-        cursor = conn.cursor()
-
-        # Create the tiles table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tiles (
-            zoom_level integer,
-            tile_column integer,
-            tile_row integer,
-            tile_data blob
-        )
-        ''')
-
-        # Create metadata table and insert basic values
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS metadata (
-            name text,
-            value text
-        )
-        ''')
-        
-        cursor.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', [
-            ('name', 'Composite change detection raster map'),
-            ('type', 'baselayer'),
-            ('version', '1.1'),
-            ('description', raster_imagery_attribution),
-            ('format', 'jpg'),
-        ])
-
-        for zoom in range(minzoom, maxzoom+1):
-            start_x, start_y = latlon_to_tile(north, west, zoom)
-            end_x, end_y = latlon_to_tile(south, east, zoom)
-
-            for x in range(start_x, end_x + 1):
-                for y in range(start_y, end_y + 1):
-                    tile_data = download_tile(zoom, x, y, url_template)
-                    # Note: The TMS y value needs to be flipped for the SQLite database.
-                    flipped_y = (2**zoom - 1) - y
-                    cursor.execute("INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)", 
-                                (zoom, x, flipped_y, tile_data))
-
-        conn.commit()
-        conn.close()
-
+        workers = get_render_workers(render_workers)
+        session = get_http_session(workers)
+        # Tiles the tileserver fails to render are retried like imagery tiles (see fetch_tiles)
+        host_limiter = get_host_limiter(f"{address}:{port}")
+        concurrency = AdaptiveConcurrency(workers)
+        failures = []
+        failures_report_path = os.path.join(output_directory, "failed-composite-tiles.json")
+
+        metadata = {
+            'name': 'Composite change detection raster map',
+            'type': 'baselayer',
+            'version': '1.1',
+            'description': raster_imagery_attribution,
+            'format': 'jpg',
+        }
+
+        # When resuming, the partial MBTiles from an interrupted run is kept and
+        # only the tiles missing from it are rendered
+        writer = MBTilesWriter(output_file, metadata, overwrite=not resume)
+        completed_tiles = writer.existing_tiles() if resume else set()
+        if completed_tiles:
+            print(f"Resuming composite MBTiles build: {len(completed_tiles)} tiles already rendered")
+
+        print(f"Downloading composite raster tiles from Tileserver-GL with {workers} workers...")
+
+        def render_tile(tile):
+            zoom, x, y = tile
+            tile_data = download_tile(zoom, x, y, url_template, session)
+            metrics.add("bytes_downloaded_total", len(tile_data), source="tileserver")
+            tile_queue.put((zoom, x, y, tile_data))
+            return True
+
+        # Tiles are rendered concurrently, while a single writer thread owns the SQLite connection
+        tile_queue = queue.Queue(maxsize=workers * 4)
+        writer_thread, writer_state = start_tile_writer(writer, tile_queue)
+        try:
+            for zoom, zoom_tiles in get_tile_cover(bbox, minzoom, maxzoom, footprint, footprint_min_zoom):
+                start_time = time.perf_counter()
+                tiles = ((zoom, x, y) for x, y in zoom_tiles if (zoom, x, y) not in completed_tiles)
+                rendered = sum(1 for _, result in fetch_tiles(tiles, render_tile, workers, RENDER_RETRIES, host_limiter, concurrency, failures) if result)
+                metrics.add("tiles_total", rendered, source="rendered")
+                elapsed = time.perf_counter() - start_time
+                tiles_per_second = rendered / elapsed if elapsed > 0 else 0.0
+                print(f"Zoom level {zoom}: {rendered} tiles rendered in {elapsed:.1f}s ({tiles_per_second:.1f} tiles/sec)")
+                if writer_state["error"] is not None:
+                    raise writer_state["error"]
+        finally:
+            tile_queue.put(None)
+            writer_thread.join()
+            writer.close()
+
+        if writer_state["error"] is not None:
+            raise writer_state["error"]
+        write_failed_tiles_report(failures_report_path, failures)
+        if failures:
+            metrics.add("tiles_total", len(failures), source="failed")
+            raise TileFetchError(f"{len(failures)} composite tiles could not be rendered")
+
+        metrics.add("bytes_written_total", metrics.path_size(output_file), stage="tileserver_render")
         print("\033[1m\033[32mComposite raster MBTiles file generated:\033[0m", f"{output_file}")
     except Exception as e:
         print()
         print("\033[1m\033[31mError occurred:\033[0m", str(e))
+        print("Rendered tiles were kept; set COMPOSITE_MBTILES_RESUME=true to render only the missing tiles on the next run.")
+        # The build did not finish, so the caller (and a batch) must not carry on as if it had
+        raise
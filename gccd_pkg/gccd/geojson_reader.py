@@ -0,0 +1,201 @@
+import re
+import json
+from itertools import chain
+
+import numpy as np
+
+# Characters read from the file at a time
+CHUNK_SIZE = 1024 * 1024
+# Vertices gathered before their bounds are computed with NumPy
+BOUNDS_BATCH_SIZE = 100_000
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+class _JSONStream:
+    """Reads JSON values one at a time from a text file, holding no more of
+    the file in memory than the value being read (and a chunk after it)"""
+
+    def __init__(self, text_file):
+        self.file = text_file
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=CHUNK_SIZE):
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, or '' at the end"""
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, characters):
+        """Consume the next non-whitespace character, which must be one of characters"""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Invalid GeoJSON: expected one of {characters!r}, found {character or 'the end of the file'!r}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        self.peek()
+        size = CHUNK_SIZE
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as e:
+                # Most likely the value continues past the end of the buffer.
+                # Reading twice as much each time keeps large values linear.
+                if not self._fill(size):
+                    raise ValueError(f"Invalid GeoJSON: {e}")
+                size *= 2
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill(size):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(input_geojson_path):
+    """Yield the features of a GeoJSON FeatureCollection one at a time, as
+    they are parsed, rather than parsing the whole file at once.
+
+    Raises ValueError if the file is not valid JSON or has no features.
+    """
+    with open(input_geojson_path, "r", encoding="utf-8-sig") as geojson_file:
+        stream = _JSONStream(geojson_file)
+        has_features = False
+        stream.expect("{")
+        if stream.peek() == "}":
+            stream.pos += 1
+        else:
+            while True:
+                key = stream.value()
+                stream.expect(":")
+                if key == "features":
+                    has_features = True
+                    stream.expect("[")
+                    if stream.peek() == "]":
+                        stream.pos += 1
+                    else:
+                        while True:
+                            yield stream.value()
+                            if stream.expect(",]") == "]":
+                                break
+                else:
+                    stream.value()
+                if stream.expect(",}") == "}":
+                    break
+        if not has_features:
+            raise ValueError(f"Invalid GeoJSON: {input_geojson_path} has no features")
+
+def geometry_positions(geometry):
+    """Return the positions ([lon, lat, ...]) of a GeoJSON geometry as a flat list"""
+    if not geometry:
+        return []
+    if geometry.get("type") == "GeometryCollection":
+        return [position for part in geometry.get("geometries", []) for position in geometry_positions(part)]
+    coordinates = geometry.get("coordinates")
+    if not coordinates:
+        return []
+
+    # Points are positions, LineStrings lists of them, Polygons lists of lists, etc.
+    depth = 0
+    nested = coordinates
+    while isinstance(nested[0], list):
+        depth += 1
+        nested = nested[0]
+        if not nested:
+            return []
+    positions = [coordinates] if depth == 0 else coordinates
+    for _ in range(depth - 1):
+        positions = list(chain.from_iterable(positions))
+    return positions
+
+def positions_array(positions):
+    """Return the lon/lat of the positions as an (n, 2) float array"""
+    try:
+        array = np.array(positions, dtype=float)
+        if array.ndim == 2 and array.shape[1] >= 2:
+            return array[:, :2]
+    except ValueError:
+        pass
+    # Positions with and without elevation, or malformed ones
+    return np.array([position[:2] for position in positions if len(position) >= 2], dtype=float).reshape(-1, 2)
+
+
+class _BoundsAccumulator:
+    """Computes the bounds of each of a series of features, vectorized over
+    batches of their vertices"""
+
+    def __init__(self):
+        self.bounds = []
+        self.positions = []
+        self.counts = []
+
+    def add(self, feature):
+        positions = geometry_positions(feature.get("geometry"))
+        self.positions.extend(positions)
+        self.counts.append(len(positions))
+        if len(self.positions) >= BOUNDS_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.counts:
+            return
+        bounds = np.full((len(self.counts), 4), np.nan)
+        coords = positions_array(self.positions)
+        counts = np.array(self.counts)
+        if len(coords) == counts.sum():
+            has_coords = counts > 0
+            if has_coords.any():
+                starts = (np.cumsum(counts) - counts)[has_coords]
+                bounds[has_coords, :2] = np.minimum.reduceat(coords, starts, axis=0)
+                bounds[has_coords, 2:] = np.maximum.reduceat(coords, starts, axis=0)
+        else:
+            # Some positions were malformed, so the offsets don't line up: go feature by feature
+            offset = 0
+            for i, count in enumerate(self.counts):
+                feature_coords = positions_array(self.positions[offset:offset + count])
+                offset += count
+                if len(feature_coords):
+                    bounds[i] = [*feature_coords.min(axis=0), *feature_coords.max(axis=0)]
+        self.bounds.append(bounds)
+        self.positions = []
+        self.counts = []
+
+    def result(self):
+        self.flush()
+        return np.concatenate(self.bounds) if self.bounds else np.empty((0, 4))
+
+
+def feature_bounds(features):
+    """Return an (n, 4) array of the [min_lon, min_lat, max_lon, max_lat]
+    bounds of each feature, NaN for features without coordinates"""
+    accumulator = _BoundsAccumulator()
+    for feature in features:
+        accumulator.add(feature)
+    return accumulator.result()
+
+def total_bounds(bounds):
+    """Return (min_lon, min_lat, max_lon, max_lat) of an array of feature bounds"""
+    bounds = bounds[~np.isnan(bounds).any(axis=1)]
+    if not len(bounds):
+        return float("inf"), float("inf"), float("-inf"), float("-inf")
+    min_lon, min_lat = bounds[:, :2].min(axis=0)
+    max_lon, max_lat = bounds[:, 2:].max(axis=0)
+    return float(min_lon), float(min_lat), float(max_lon), float(max_lat)
+
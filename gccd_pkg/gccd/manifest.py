@@ -0,0 +1,130 @@
+import os
+import json
+import hashlib
+
+MANIFEST_FILENAME = "build-manifest.json"
+MANIFEST_VERSION = 2
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Record of the steps built into an output directory, used to skip
+    steps whose inputs and settings have not changed since the last run.
+
+    A step's fingerprint hashes its settings, the identity of its input files
+    and the fingerprints of the steps it depends on. For each completed step
+    the manifest stores that fingerprint, the size and modification time of
+    its outputs and its (JSON) return value. A step is up to date if its
+    fingerprint matches and its outputs have not been touched since.
+
+    An input file is identified by its size and modification time the first
+    time it is seen, so a new output directory does not read its (possibly
+    multi-GB) inputs just to fingerprint them. Only an input that has changed
+    since the last run is hashed, so that later runs can tell a file that was
+    merely touched from one whose contents changed.
+    """
+
+    def __init__(self, output_directory, force_rebuild=False):
+        self.output_directory = output_directory
+        self.path = os.path.join(output_directory, MANIFEST_FILENAME)
+        self.data = {"version": MANIFEST_VERSION, "files": {}, "steps": {}}
+        if not force_rebuild and os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as manifest_file:
+                    data = json.load(manifest_file)
+                if data.get("version") == MANIFEST_VERSION:
+                    self.data = data
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable build manifest {self.path}: {e}")
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.output_directory))
+
+    def file_hash(self, path):
+        """Return the identity of an input file's contents: the SHA-256 of
+        its contents, or its size and modification time if it has not been
+        seen to change"""
+        stat = os.stat(path)
+        key = self._key(path)
+        cached = self.data["files"].get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["digest"]
+        if cached is None:
+            digest = f"stat:{stat.st_size}:{stat.st_mtime_ns}"
+        else:
+            digest = f"sha256:{hash_file(path)}"
+        self.data["files"][key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "digest": digest}
+        return digest
+
+    def fingerprint(self, step, dependency_fingerprints):
+        """Return the step's fingerprint, or None if it must always run."""
+        if step.fingerprint is None or None in dependency_fingerprints:
+            return None
+        inputs = {}
+        for path in step.inputs:
+            inputs[self._key(path)] = self.file_hash(path) if os.path.isfile(path) else None
+        parts = {
+            "step": step.name,
+            "settings": step.fingerprint,
+            "inputs": inputs,
+            "dependencies": sorted(dependency_fingerprints),
+        }
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _output_state(self, step):
+        state = {}
+        for path in step.outputs:
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                state[self._key(path)] = [stat.st_size, stat.st_mtime_ns]
+            elif os.path.isdir(path):
+                state[self._key(path)] = len(os.listdir(path))
+            else:
+                state[self._key(path)] = None
+        return state
+
+    def is_up_to_date(self, step, fingerprint):
+        entry = self.data["steps"].get(step.name)
+        return (
+            fingerprint is not None
+            and entry is not None
+            and entry["fingerprint"] == fingerprint
+            and entry["outputs"] == self._output_state(step)
+        )
+
+    def result(self, step_name):
+        return self.data["steps"][step_name]["result"]
+
+    def cached_result(self, step, dependency_fingerprints=()):
+        """Return the recorded result of step if it is up to date, otherwise None."""
+        if self.is_up_to_date(step, self.fingerprint(step, list(dependency_fingerprints))):
+            return self.result(step.name)
+        return None
+
+    def record(self, step, fingerprint, result):
+        """Record a completed step, unless it cannot be skipped next time."""
+        self.data["steps"].pop(step.name, None)
+        outputs = self._output_state(step)
+        # Missing or empty outputs mean the step did not complete its work
+        complete = all(outputs.values()) and (step.cache_if is None or step.cache_if(result))
+        if fingerprint is not None and complete:
+            try:
+                json.dumps(result)
+            except (TypeError, ValueError):
+                pass
+            else:
+                self.data["steps"][step.name] = {"fingerprint": fingerprint, "outputs": outputs, "result": result}
+        self.save()
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as manifest_file:
+            json.dump(self.data, manifest_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,221 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+import mercantile
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def flip_y(zoom, y):
+    # MBTiles stores rows in TMS order, so XYZ rows need to be flipped
+    return (2**zoom - 1) - y
+
+
+class MBTilesWriter:
+    """Write tiles into an MBTiles file in batched transactions.
+
+    Tiles are added with XYZ coordinates and buffered in memory until
+    `batch_size` tiles are pending, at which point they are written with
+    `executemany` in a single transaction. `add_tile` may be called from
+    several threads.
+
+    New files use the deduplicated MBTiles schema: a `map` table pointing
+    (zoom_level, tile_column, tile_row) at a hash-keyed blob in `images`, with
+    a `tiles` view on top, so byte-identical tiles (water, clouds, blank
+    areas) are stored only once. Files created with a plain `tiles` table are
+    still appended to as such. The file is written in WAL mode and switched
+    back to a rollback journal on close, so it can be copied as a single file.
+    On close, the bounds/minzoom/maxzoom/center metadata are filled in from
+    the stored tiles unless they were given explicitly.
+    """
+
+    def __init__(self, mbtiles_file, metadata=None, batch_size=DEFAULT_BATCH_SIZE, overwrite=False):
+        if overwrite and os.path.exists(mbtiles_file):
+            os.remove(mbtiles_file)
+            print(f"Deleted existing MBTiles file: {mbtiles_file}")
+
+        self.mbtiles_file = mbtiles_file
+        self.batch_size = batch_size
+        self._pending = []
+        self._explicit_metadata = set()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(mbtiles_file, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+        if metadata:
+            self.set_metadata(metadata)
+
+    def _create_schema(self):
+        legacy_tiles = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tiles'"
+        ).fetchone()
+        self.deduplicate = legacy_tiles is None
+
+        with self._conn:
+            if self.deduplicate:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS map (zoom_level integer, tile_column integer, tile_row integer, tile_id text)"
+                )
+                self._conn.execute("CREATE TABLE IF NOT EXISTS images (tile_data blob, tile_id text)")
+                self._conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)"
+                )
+                self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)")
+                self._conn.execute(
+                    "CREATE VIEW IF NOT EXISTS tiles AS "
+                    "SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, "
+                    "map.tile_row AS tile_row, images.tile_data AS tile_data "
+                    "FROM map JOIN images ON images.tile_id = map.tile_id"
+                )
+            else:
+                self._conn.execute(
+                    "CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)"
+                )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+            self._conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)")
+
+    def set_metadata(self, metadata):
+        self._explicit_metadata.update(metadata)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                [(name, str(value)) for name, value in metadata.items()],
+            )
+
+    def existing_tiles(self):
+        """Return the set of (zoom, x, y) XYZ tiles already stored in the file."""
+        table = "map" if self.deduplicate else "tiles"
+        with self._lock:
+            self._write_pending()
+            rows = self._conn.execute(f"SELECT zoom_level, tile_column, tile_row FROM {table}").fetchall()
+        return {(zoom, x, flip_y(zoom, row)) for zoom, x, row in rows}
+
+    def add_tile(self, zoom, x, y, tile_data):
+        with self._lock:
+            self._pending.append((zoom, x, flip_y(zoom, y), tile_data))
+            if len(self._pending) >= self.batch_size:
+                self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        with self._conn:
+            if self.deduplicate:
+                images = {}
+                rows = []
+                for zoom, x, row, tile_data in self._pending:
+                    tile_id = hashlib.md5(tile_data).hexdigest()
+                    images[tile_id] = tile_data
+                    rows.append((zoom, x, row, tile_id))
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO images (tile_data, tile_id) VALUES (?, ?)",
+                    [(sqlite3.Binary(tile_data), tile_id) for tile_id, tile_data in images.items()],
+                )
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                    rows,
+                )
+            else:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                    [(zoom, x, row, sqlite3.Binary(tile_data)) for zoom, x, row, tile_data in self._pending],
+                )
+        self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def _complete_metadata(self):
+        """Derive bounds, minzoom, maxzoom and center from the stored tiles."""
+        table = "map" if self.deduplicate else "tiles"
+        minzoom, maxzoom = self._conn.execute(f"SELECT MIN(zoom_level), MAX(zoom_level) FROM {table}").fetchone()
+        if maxzoom is None:
+            return
+
+        min_x, max_x, min_row, max_row = self._conn.execute(
+            f"SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row) FROM {table} WHERE zoom_level = ?",
+            (maxzoom,),
+        ).fetchone()
+        west, _, _, north = mercantile.bounds(min_x, flip_y(maxzoom, max_row), maxzoom)
+        _, south, east, _ = mercantile.bounds(max_x, flip_y(maxzoom, min_row), maxzoom)
+        center_zoom = max(minzoom, maxzoom - 2)
+
+        derived = {
+            "minzoom": minzoom,
+            "maxzoom": maxzoom,
+            "bounds": f"{west:.6f},{south:.6f},{east:.6f},{north:.6f}",
+            "center": f"{(west + east) / 2:.6f},{(south + north) / 2:.6f},{center_zoom}",
+        }
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                [(name, str(value)) for name, value in derived.items() if name not in self._explicit_metadata],
+            )
+
+    def close(self):
+        with self._lock:
+            self._write_pending()
+            if self.deduplicate:
+                # Drop images no longer referenced after tiles were replaced
+                with self._conn:
+                    self._conn.execute("DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)")
+            self._complete_metadata()
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_metadata(mbtiles_file):
+    """Return the metadata of an existing MBTiles file, or {} if there is none"""
+    if not os.path.exists(mbtiles_file):
+        return {}
+    try:
+        conn = sqlite3.connect(mbtiles_file)
+        try:
+            return dict(conn.execute("SELECT name, value FROM metadata").fetchall())
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return {}
+
+
+def import_xyz_directory(xyz_dir, image_format, writer):
+    """Add every {z}/{x}/{y}.{image_format} tile found in xyz_dir to writer.
+
+    A metadata.json file in the directory is copied into the MBTiles metadata.
+    Returns the number of tiles imported.
+    """
+    metadata_path = os.path.join(xyz_dir, "metadata.json")
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r") as metadata_file:
+            writer.set_metadata(json.load(metadata_file))
+
+    count = 0
+    extension = f".{image_format}"
+    for zoom_name in os.listdir(xyz_dir):
+        zoom_dir = os.path.join(xyz_dir, zoom_name)
+        if not zoom_name.isdigit() or not os.path.isdir(zoom_dir):
+            continue
+        for x_name in os.listdir(zoom_dir):
+            x_dir = os.path.join(zoom_dir, x_name)
+            if not x_name.isdigit() or not os.path.isdir(x_dir):
+                continue
+            for tile_name in os.listdir(x_dir):
+                y_name, ext = os.path.splitext(tile_name)
+                if ext != extension or not y_name.isdigit():
+                    continue
+                with open(os.path.join(x_dir, tile_name), "rb") as tile_file:
+                    writer.add_tile(int(zoom_name), int(x_name), int(y_name), tile_file.read())
+                count += 1
+    return count
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+METRIC_PREFIX = "gccd_"
+
+# Descriptions of the counters, used as the Prometheus HELP text
+METRICS = {
+    "stage_runs_total": "Number of times a pipeline stage ran",
+    "stage_skipped_total": "Number of times a pipeline stage was skipped as up to date",
+    "stage_wall_seconds_total": "Wall time spent in a pipeline stage",
+    "stage_cpu_seconds_total": "CPU time (process and children) used while a pipeline stage ran",
+    "bytes_downloaded_total": "Bytes downloaded over HTTP",
+    "bytes_written_total": "Bytes of output files written by a pipeline stage",
+    "bytes_staged_total": "Bytes of input files staged into an output, by method (hardlink, reflink, copy_file_range, copy)",
+    "tiles_total": "Tiles handled, by source (downloaded, cached, failed, rendered, built)",
+    "subprocess_runs_total": "Number of external commands run",
+    "subprocess_seconds_total": "Wall time spent waiting on external commands",
+    "tile_retries_total": "Tile downloads retried, by the HTTP status (or error) of the failed attempt",
+    "jobs_total": "Change map jobs finished by the HTTP service, by status",
+}
+
+_lock = threading.Lock()
+# Counters since the process started, keyed by (name, sorted label items)
+_totals = {}
+_run = None
+
+
+def cpu_seconds():
+    """CPU time used by this process and its finished child processes"""
+    if resource is None:
+        return time.process_time()
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+class RunMetrics:
+    """The stages and counters recorded during one pipeline run."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.start_time = time.perf_counter()
+        self.stages = []
+        self.counters = {}
+
+    def to_dict(self):
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return {
+            "started_at": self.started_at,
+            "wall_seconds": time.perf_counter() - self.start_time,
+            "stages": self.stages,
+            "counters": counters,
+        }
+
+
+def current_run():
+    """Return the metrics of the current run, starting one if needed"""
+    global _run
+    with _lock:
+        if _run is None:
+            _run = RunMetrics()
+        return _run
+
+def add(name, value=1, **labels):
+    """Add value to the counter name (see METRICS) with the given labels"""
+    key = (name, tuple(sorted((label, str(label_value)) for label, label_value in labels.items())))
+    run = current_run()
+    with _lock:
+        _totals[key] = _totals.get(key, 0) + value
+        run.counters[key] = run.counters.get(key, 0) + value
+
+def record_stage(name, wall_seconds, cpu_seconds_used, **details):
+    current_run().stages.append({"name": name, "wall_seconds": wall_seconds, "cpu_seconds": cpu_seconds_used, **details})
+    add("stage_runs_total", stage=name)
+    add("stage_wall_seconds_total", wall_seconds, stage=name)
+    add("stage_cpu_seconds_total", cpu_seconds_used, stage=name)
+
+@contextmanager
+def stage(name):
+    """Record the wall and CPU time of the enclosed block as a pipeline stage.
+
+    CPU time is measured for the whole process, so stages running
+    concurrently in threads each include the others' CPU time.
+    """
+    start_time = time.perf_counter()
+    start_cpu = cpu_seconds()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start_time, cpu_seconds() - start_cpu)
+
+@contextmanager
+def subprocess_timer(name):
+    """Record the time spent in the enclosed block as a run of the external command name"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add("subprocess_runs_total", command=name)
+        add("subprocess_seconds_total", time.perf_counter() - start_time, command=name)
+
+def run_command(name, command):
+    """Run a shell command with os.system, recording how long it took"""
+    with subprocess_timer(name):
+        return os.system(command)
+
+def path_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            total += os.path.getsize(os.path.join(root, file))
+    return total
+
+def finish_run():
+    """Return the current run's metrics as a dict, and start afresh for the next run"""
+    global _run
+    with _lock:
+        run, _run = _run, None
+    return (run or RunMetrics()).to_dict()
+
+def merge_run(report):
+    """Merge a run recorded in another process (see finish_run) into the current run"""
+    current_run().stages.extend(report["stages"])
+    for name, values in report["counters"].items():
+        for value in values:
+            add(name, value["value"], **value["labels"])
+
+def write_run_report(path):
+    report = finish_run()
+    with open(path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"\033[1m\033[32mRun metrics written to:\033[0m {path}")
+    return report
+
+def escape_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text():
+    """Return the counters since the process started in the Prometheus text format"""
+    with _lock:
+        totals = sorted(_totals.items())
+    lines = []
+    described = set()
+    for (name, labels), value in totals:
+        metric = METRIC_PREFIX + name
+        if name not in described:
+            lines.append(f"# HELP {metric} {METRICS.get(name, name)}")
+            lines.append(f"# TYPE {metric} counter")
+            described.add(name)
+        label_text = ",".join(f'{label}="{escape_label_value(label_value)}"' for label, label_value in labels)
+        lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,103 @@
+import io
+import sys
+import sqlite3
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from gccd import metrics
+from gccd.mbtiles import flip_y
+from gccd.utils import chunked, get_cpu_budget
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to build overview zoom levels
+    Image = None
+
+TILE_SIZE = 256
+# Number of parent tiles sent to a worker process at once
+OVERVIEW_CHUNK_SIZE = 64
+JPEG_QUALITY = 90
+# Fill for quadrants of a parent tile with no downloaded child tile
+OVERVIEW_FILL_COLOR = (0, 0, 0)
+
+# Per-process read connection to the MBTiles, set up by init_overview_worker
+_source = None
+
+
+def init_overview_worker(mbtiles_file):
+    global _source
+    _source = sqlite3.connect(f"file:{mbtiles_file}?mode=ro", uri=True)
+
+def read_tile_array(zoom, x, y):
+    row = _source.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+        (zoom, x, flip_y(zoom, y)),
+    ).fetchone()
+    if row is None:
+        return None
+    image = Image.open(io.BytesIO(row[0])).convert("RGB")
+    if image.size != (TILE_SIZE, TILE_SIZE):
+        image = image.resize((TILE_SIZE, TILE_SIZE), Image.BILINEAR)
+    return np.asarray(image)
+
+def build_parent_tile(zoom, x, y):
+    """Return JPEG bytes for tile zoom/x/y built from its four children at zoom + 1"""
+    mosaic = np.empty((TILE_SIZE * 2, TILE_SIZE * 2, 3), dtype=np.uint8)
+    mosaic[:] = OVERVIEW_FILL_COLOR
+    found = False
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = read_tile_array(zoom + 1, x * 2 + dx, y * 2 + dy)
+            if child is not None:
+                mosaic[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child
+                found = True
+    if not found:
+        return None
+
+    # Average each 2x2 block of pixels down to one
+    parent = mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 3).mean(axis=(1, 3))
+    output = io.BytesIO()
+    Image.fromarray(np.round(parent).astype(np.uint8)).save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue()
+
+def build_parent_tiles(tiles):
+    return [(zoom, x, y, build_parent_tile(zoom, x, y)) for zoom, x, y in tiles]
+
+def build_overviews(writer, base_zoom, min_zoom, overview_workers=None, existing_tiles=frozenset()):
+    """Build zoom levels base_zoom - 1 down to min_zoom from the tiles stored at base_zoom.
+
+    Each parent tile is the four child tiles below it merged and downsampled
+    by half, rendered in a pool of worker processes that read the children
+    straight from the MBTiles file being written. Tiles in existing_tiles are
+    not rebuilt.
+    """
+    if Image is None:
+        print("\033[1m\033[31mBuilding overview zoom levels requires Pillow:\033[0m pip install 'gccd[render]'")
+        sys.exit(1)
+
+    # The workers read the children through their own connections
+    writer.flush()
+    children = {(x, y) for zoom, x, y in writer.existing_tiles() if zoom == base_zoom}
+
+    # The workers come out of the process-wide CPU budget, shared with the other steps and flows.
+    # They are spawned rather than forked, as this runs on a step thread while other steps' threads are running.
+    with get_cpu_budget().reserve(overview_workers) as workers, ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_overview_worker, initargs=(writer.mbtiles_file,)) as executor:
+        for zoom in range(base_zoom - 1, min_zoom - 1, -1):
+            start_time = time.perf_counter()
+            parents = sorted({(x // 2, y // 2) for x, y in children})
+            tiles = [(zoom, x, y) for x, y in parents if (zoom, x, y) not in existing_tiles]
+            built = 0
+            for results in executor.map(build_parent_tiles, chunked(tiles, OVERVIEW_CHUNK_SIZE)):
+                for tile_zoom, x, y, tile_data in results:
+                    if tile_data is not None:
+                        writer.add_tile(tile_zoom, x, y, tile_data)
+                        built += 1
+            # Commit this level before its tiles are read to build the next one
+            writer.flush()
+            metrics.add("tiles_total", built, source="built")
+            elapsed = time.perf_counter() - start_time
+            print(f"Zoom level {zoom}: {built} tiles built from zoom level {zoom + 1} in {elapsed:.1f}s")
+            children = parents
@@ -0,0 +1,375 @@
+import os
+import gzip
+import json
+import struct
+import hashlib
+import tempfile
+import threading
+
+import mercantile
+
+HEADER_SIZE = 127
+# The header and root directory must fit in the first 16 KiB of the file
+ROOT_DIRECTORY_MAX_SIZE = 16384 - HEADER_SIZE
+LEAF_DIRECTORY_MIN_ENTRIES = 4096
+# magic, version, 11 offsets/lengths/counts, clustered, compressions, tile
+# type, min/max zoom, bounds, center zoom and center position
+HEADER_FORMAT = "<7sB11Q6B4iB2i"
+
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+
+TILE_TYPES = {
+    "pbf": 1,
+    "mvt": 1,
+    "png": 2,
+    "jpg": 3,
+    "jpeg": 3,
+    "webp": 4,
+    "avif": 5,
+}
+
+
+def zxy_to_tileid(zoom, x, y):
+    """Return the PMTiles tile ID: tiles are numbered zoom by zoom along a Hilbert curve"""
+    tile_id = ((1 << (zoom * 2)) - 1) // 3
+    n = 1 << zoom
+    s = n >> 1
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        tile_id += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = n - 1 - x
+                y = n - 1 - y
+            x, y = y, x
+        s >>= 1
+    return tile_id
+
+def tileid_to_zxy(tile_id):
+    zoom = 0
+    acc = 0
+    while acc + (1 << (zoom * 2)) <= tile_id:
+        acc += 1 << (zoom * 2)
+        zoom += 1
+    n = 1 << zoom
+    t = tile_id - acc
+    x = y = 0
+    s = 1
+    while s < n:
+        rx = 1 & (t // 2)
+        ry = 1 & (t ^ rx)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        x += s * rx
+        y += s * ry
+        t //= 4
+        s <<= 1
+    return zoom, x, y
+
+def write_varint(buffer, value):
+    while value >= 0x80:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+def serialize_directory(entries):
+    """Encode (tile_id, offset, length, run_length) entries sorted by tile ID, gzipped"""
+    buffer = bytearray()
+    write_varint(buffer, len(entries))
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        write_varint(buffer, tile_id - last_id)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        write_varint(buffer, run_length)
+    for _, _, length, _ in entries:
+        write_varint(buffer, length)
+    for i, (_, offset, _, _) in enumerate(entries):
+        # 0 means the data follows straight after the previous entry's
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, offset + 1)
+    return gzip.compress(bytes(buffer), mtime=0)
+
+def deserialize_directory(data):
+    data = gzip.decompress(data)
+    count, position = read_varint(data, 0)
+    tile_ids, run_lengths, lengths, offsets = [], [], [], []
+    last_id = 0
+    for _ in range(count):
+        delta, position = read_varint(data, position)
+        last_id += delta
+        tile_ids.append(last_id)
+    for _ in range(count):
+        run_length, position = read_varint(data, position)
+        run_lengths.append(run_length)
+    for _ in range(count):
+        length, position = read_varint(data, position)
+        lengths.append(length)
+    for i in range(count):
+        offset, position = read_varint(data, position)
+        offsets.append(offsets[i - 1] + lengths[i - 1] if offset == 0 and i > 0 else offset - 1)
+    return list(zip(tile_ids, offsets, lengths, run_lengths))
+
+def build_directories(entries):
+    """Return (root_directory, leaf_directories) bytes for the tile entries.
+
+    All entries go in the root directory if it fits in the first 16 KiB of
+    the file; otherwise they are split into leaf directories, with the root
+    pointing at each leaf (a run length of 0).
+    """
+    root = serialize_directory(entries)
+    if len(root) <= ROOT_DIRECTORY_MAX_SIZE:
+        return root, b""
+
+    leaf_size = max(LEAF_DIRECTORY_MIN_ENTRIES, len(entries) // 3500)
+    while True:
+        leaves = bytearray()
+        root_entries = []
+        for start in range(0, len(entries), leaf_size):
+            leaf = serialize_directory(entries[start:start + leaf_size])
+            root_entries.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = serialize_directory(root_entries)
+        if len(root) <= ROOT_DIRECTORY_MAX_SIZE:
+            return root, bytes(leaves)
+        leaf_size = int(leaf_size * 1.2)
+
+def write_header(header):
+    return struct.pack(
+        HEADER_FORMAT,
+        b"PMTiles",
+        3,
+        header["root_offset"],
+        header["root_length"],
+        header["metadata_offset"],
+        header["metadata_length"],
+        header["leaf_directory_offset"],
+        header["leaf_directory_length"],
+        header["tile_data_offset"],
+        header["tile_data_length"],
+        header["addressed_tiles_count"],
+        header["tile_entries_count"],
+        header["tile_contents_count"],
+        1,  # clustered
+        COMPRESSION_GZIP,  # internal (directory and metadata) compression
+        header["tile_compression"],
+        header["tile_type"],
+        header["min_zoom"],
+        header["max_zoom"],
+        header["min_lon_e7"],
+        header["min_lat_e7"],
+        header["max_lon_e7"],
+        header["max_lat_e7"],
+        header["center_zoom"],
+        header["center_lon_e7"],
+        header["center_lat_e7"],
+    )
+
+
+class PMTilesWriter:
+    """Write tiles into a PMTiles v3 archive.
+
+    Tiles can be added with XYZ coordinates in any order. Their contents are
+    streamed to a temporary file next to the archive as they arrive, with
+    byte-identical tiles stored once. On close, the entries are sorted by
+    tile ID (zoom level, then Hilbert curve order) and the archive is written
+    clustered: the tile data is laid out in tile ID order, and consecutive
+    tiles with the same contents collapse into a single run-length entry.
+    Directories spill into leaf directories when the root directory does not
+    fit in the first 16 KiB. `add_tile` may be called from several threads.
+    """
+
+    def __init__(self, pmtiles_file, metadata=None, tile_compression=None):
+        self.pmtiles_file = pmtiles_file
+        self.metadata = {}
+        self.tile_compression = tile_compression
+        self._entries = []
+        self._contents = {}
+        self._lock = threading.Lock()
+        self._data = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(pmtiles_file)), prefix=".pmtiles-", suffix=".tmp"
+        )
+        self._data_length = 0
+        if metadata:
+            self.set_metadata(metadata)
+
+    def set_metadata(self, metadata):
+        with self._lock:
+            self.metadata.update(metadata)
+
+    def add_tile(self, zoom, x, y, tile_data):
+        tile_id = zxy_to_tileid(zoom, x, y)
+        digest = hashlib.md5(tile_data).digest()
+        with self._lock:
+            offset = self._contents.get(digest)
+            if offset is None:
+                offset = self._data_length
+                self._data.write(tile_data)
+                self._data_length += len(tile_data)
+                self._contents[digest] = offset
+            self._entries.append((tile_id, offset, len(tile_data)))
+
+    def _header_fields(self, tile_ids):
+        min_zoom = tileid_to_zxy(tile_ids[0])[0]
+        max_zoom = tileid_to_zxy(tile_ids[-1])[0]
+        if "bounds" in self.metadata:
+            west, south, east, north = (float(value) for value in str(self.metadata["bounds"]).split(","))
+        else:
+            # Derive the bounds from the tiles at the highest zoom level
+            max_zoom_tiles = [tileid_to_zxy(tile_id) for tile_id in tile_ids if tile_id >= zxy_to_tileid(max_zoom, 0, 0)]
+            xs = [x for _, x, _ in max_zoom_tiles]
+            ys = [y for _, _, y in max_zoom_tiles]
+            west, _, _, north = mercantile.bounds(min(xs), min(ys), max_zoom)
+            _, south, east, _ = mercantile.bounds(max(xs), max(ys), max_zoom)
+        if "center" in self.metadata:
+            center_lon, center_lat, center_zoom = (float(value) for value in str(self.metadata["center"]).split(","))
+        else:
+            center_lon, center_lat, center_zoom = (west + east) / 2, (south + north) / 2, max(min_zoom, max_zoom - 2)
+
+        image_format = str(self.metadata.get("format", "")).lower()
+        tile_type = TILE_TYPES.get(image_format, 0)
+        tile_compression = self.tile_compression
+        if tile_compression is None:
+            # Vector tiles are conventionally gzipped; image formats are already compressed
+            tile_compression = COMPRESSION_GZIP if tile_type == 1 else COMPRESSION_NONE
+
+        return {
+            "tile_type": tile_type,
+            "tile_compression": tile_compression,
+            "min_zoom": min_zoom,
+            "max_zoom": max_zoom,
+            "min_lon_e7": int(west * 1e7),
+            "min_lat_e7": int(south * 1e7),
+            "max_lon_e7": int(east * 1e7),
+            "max_lat_e7": int(north * 1e7),
+            "center_zoom": int(center_zoom),
+            "center_lon_e7": int(center_lon * 1e7),
+            "center_lat_e7": int(center_lat * 1e7),
+        }
+
+    def close(self):
+        with self._lock:
+            try:
+                self._write_archive()
+            finally:
+                self._data.close()
+
+    def _write_archive(self):
+        if not self._entries:
+            raise ValueError(f"No tiles were added to {self.pmtiles_file}")
+
+        # Later additions of the same tile replace earlier ones
+        entries = sorted({tile_id: (tile_id, offset, length) for tile_id, offset, length in self._entries}.values())
+
+        # Lay out the tile contents in the order they are first referenced
+        # by tile ID, and collapse runs of identical consecutive tiles
+        layout = {}
+        ordered_contents = []
+        directory = []
+        tile_data_length = 0
+        for tile_id, data_offset, length in entries:
+            offset = layout.get(data_offset)
+            if offset is None:
+                offset = tile_data_length
+                layout[data_offset] = offset
+                ordered_contents.append((data_offset, length))
+                tile_data_length += length
+            last = directory[-1] if directory else None
+            if last and last[1] == offset and last[0] + last[3] == tile_id:
+                directory[-1] = (last[0], last[1], last[2], last[3] + 1)
+            else:
+                directory.append((tile_id, offset, length, 1))
+
+        root, leaves = build_directories(directory)
+        metadata = gzip.compress(json.dumps(self.metadata).encode("utf-8"), mtime=0)
+
+        header = self._header_fields([tile_id for tile_id, _, _ in entries])
+        header.update({
+            "root_offset": HEADER_SIZE,
+            "root_length": len(root),
+            "metadata_offset": HEADER_SIZE + len(root),
+            "metadata_length": len(metadata),
+            "leaf_directory_offset": HEADER_SIZE + len(root) + len(metadata),
+            "leaf_directory_length": len(leaves),
+            "tile_data_offset": HEADER_SIZE + len(root) + len(metadata) + len(leaves),
+            "tile_data_length": tile_data_length,
+            "addressed_tiles_count": len(entries),
+            "tile_entries_count": len(directory),
+            "tile_contents_count": len(ordered_contents),
+        })
+
+        self._data.flush()
+        temp_file = f"{self.pmtiles_file}.tmp"
+        with open(temp_file, "wb") as output, open(self._data.name, "rb") as data:
+            output.write(write_header(header))
+            output.write(root)
+            output.write(metadata)
+            output.write(leaves)
+            for data_offset, length in ordered_contents:
+                data.seek(data_offset)
+                output.write(data.read(length))
+        os.replace(temp_file, self.pmtiles_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._data.close()
+
+
+def read_header(data):
+    names = [
+        "magic", "version", "root_offset", "root_length", "metadata_offset", "metadata_length",
+        "leaf_directory_offset", "leaf_directory_length", "tile_data_offset", "tile_data_length",
+        "addressed_tiles_count", "tile_entries_count", "tile_contents_count", "clustered",
+        "internal_compression", "tile_compression", "tile_type", "min_zoom", "max_zoom",
+        "min_lon_e7", "min_lat_e7", "max_lon_e7", "max_lat_e7", "center_zoom", "center_lon_e7", "center_lat_e7",
+    ]
+    return dict(zip(names, struct.unpack(HEADER_FORMAT, data[:HEADER_SIZE])))
+
+def read_tile(pmtiles_file, zoom, x, y):
+    """Return the contents of tile zoom/x/y from a PMTiles archive, or None if it is missing"""
+    tile_id = zxy_to_tileid(zoom, x, y)
+    with open(pmtiles_file, "rb") as archive:
+        header = read_header(archive.read(HEADER_SIZE))
+        offset, length = header["root_offset"], header["root_length"]
+        while True:
+            archive.seek(offset)
+            entries = deserialize_directory(archive.read(length))
+            # Find the last entry starting at or before the tile ID
+            match = None
+            for entry in entries:
+                if entry[0] > tile_id:
+                    break
+                match = entry
+            if match is None:
+                return None
+            entry_id, entry_offset, entry_length, run_length = match
+            if run_length == 0:
+                offset = header["leaf_directory_offset"] + entry_offset
+                length = entry_length
+                continue
+            if tile_id >= entry_id + run_length:
+                return None
+            archive.seek(header["tile_data_offset"] + entry_offset)
+            return archive.read(entry_length)
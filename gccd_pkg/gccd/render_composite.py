@@ -0,0 +1,260 @@
+import io
+import os
+import sys
+import math
+import time
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+from shapely.geometry import shape
+
+from gccd import metrics
+from gccd.geojson_reader import iter_features
+from gccd.mbtiles import MBTilesWriter, flip_y
+from gccd.tile_cover import get_tile_cover
+from gccd.utils import chunked, get_cpu_budget
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:  # Pillow is only needed for the in-process renderer
+    Image = None
+
+TILE_SIZE = 256
+# Features this many pixels outside a tile are still drawn, so that circles
+# and labels crossing a tile edge are drawn on both tiles
+TILE_MARGIN = 64
+# Number of tiles sent to a worker process at once
+RENDER_CHUNK_SIZE = 32
+JPEG_QUALITY = 90
+
+# Colors and sizes follow the layers in generate_style.py
+BACKGROUND_COLOR = (249, 249, 249)
+FEATURE_COLOR = (255, 0, 0)
+FILL_OPACITY = 0.5
+LINE_WIDTH = 2
+CIRCLE_RADIUS = 6
+FONT_SIZE = 12
+LABEL_COLOR = (255, 255, 255)
+LABEL_HALO_COLOR = (0, 0, 0)
+
+# Per-process state, set up once in each worker by init_renderer
+_features = None
+_imagery = None
+_font = None
+
+
+def lonlat_to_world(lon, lat):
+    """Project lon/lat to normalized Web Mercator coordinates (0-1, origin top left)"""
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    x = (lon + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+def project_coords(coords):
+    return [lonlat_to_world(coord[0], coord[1]) for coord in coords]
+
+def prepare_features(geojson_path):
+    """Split the GeoJSON features into projected points, lines and polygons with their labels"""
+    prepared = []
+    for feature in iter_features(geojson_path):
+        geometry = feature.get("geometry")
+        if not geometry:
+            continue
+        label = (feature.get("properties") or {}).get("alert_type")
+        geometry_type = geometry["type"]
+        coordinates = geometry["coordinates"]
+        geom = shape(geometry)
+
+        if geometry_type in ("Point", "MultiPoint"):
+            points = [coordinates] if geometry_type == "Point" else coordinates
+            parts = [("Point", [lonlat_to_world(*point[:2])]) for point in points]
+            label_points = [part[1][0] for part in parts]
+        elif geometry_type in ("LineString", "MultiLineString"):
+            lines = [coordinates] if geometry_type == "LineString" else coordinates
+            parts = [("LineString", project_coords(line)) for line in lines]
+            midpoint = geom.interpolate(0.5, normalized=True)
+            label_points = [lonlat_to_world(midpoint.x, midpoint.y)]
+        elif geometry_type in ("Polygon", "MultiPolygon"):
+            polygons = [coordinates] if geometry_type == "Polygon" else coordinates
+            parts = [("Polygon", [project_coords(ring) for ring in polygon]) for polygon in polygons]
+            anchor = geom.representative_point()
+            label_points = [lonlat_to_world(anchor.x, anchor.y)]
+        else:
+            continue
+
+        west, south, east, north = geom.bounds
+        min_x, min_y = lonlat_to_world(west, north)
+        max_x, max_y = lonlat_to_world(east, south)
+        prepared.append({
+            "parts": parts,
+            "label": str(label) if label is not None else None,
+            "label_points": label_points,
+            "bounds": (min_x, min_y, max_x, max_y),
+        })
+    return prepared
+
+def init_renderer(raster_mbtiles_path, features):
+    global _features, _imagery, _font
+    _features = features
+    _imagery = sqlite3.connect(raster_mbtiles_path) if os.path.exists(raster_mbtiles_path) else None
+    try:
+        _font = ImageFont.load_default(size=FONT_SIZE)
+    except TypeError:  # Pillow < 10.1 only has a fixed-size bitmap font
+        _font = ImageFont.load_default()
+
+def read_imagery_tile(zoom, x, y):
+    if _imagery is None:
+        return None
+    row = _imagery.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+        (zoom, x, flip_y(zoom, y)),
+    ).fetchone()
+    return bytes(row[0]) if row else None
+
+def features_in_tile(zoom, x, y):
+    scale = 2 ** zoom
+    margin = TILE_MARGIN / TILE_SIZE
+    tile_min_x, tile_min_y = (x - margin) / scale, (y - margin) / scale
+    tile_max_x, tile_max_y = (x + 1 + margin) / scale, (y + 1 + margin) / scale
+    return [
+        feature for feature in _features
+        if feature["bounds"][0] <= tile_max_x and feature["bounds"][2] >= tile_min_x
+        and feature["bounds"][1] <= tile_max_y and feature["bounds"][3] >= tile_min_y
+    ]
+
+def render_tile(zoom, x, y):
+    """Return the composite JPEG bytes of one tile, or None if there is nothing to draw"""
+    imagery_data = read_imagery_tile(zoom, x, y)
+    features = features_in_tile(zoom, x, y)
+    if not features:
+        # Nothing to draw over the imagery, so the tile can be stored as is
+        return imagery_data
+
+    if imagery_data is not None:
+        base = Image.open(io.BytesIO(imagery_data)).convert("RGBA")
+    else:
+        base = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), BACKGROUND_COLOR + (255,))
+
+    scale = TILE_SIZE * 2 ** zoom
+    offset_x, offset_y = x * TILE_SIZE, y * TILE_SIZE
+
+    def to_pixels(points):
+        return [(px * scale - offset_x, py * scale - offset_y) for px, py in points]
+
+    # Draw in the same order as the style layers: circles, fills, lines, then labels
+    overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    fill_color = FEATURE_COLOR + (int(255 * FILL_OPACITY),)
+    for feature in features:
+        for part_type, coords in feature["parts"]:
+            if part_type == "Point":
+                (cx, cy), = to_pixels(coords)
+                draw.ellipse(
+                    (cx - CIRCLE_RADIUS, cy - CIRCLE_RADIUS, cx + CIRCLE_RADIUS, cy + CIRCLE_RADIUS),
+                    fill=FEATURE_COLOR + (255,),
+                )
+    base = Image.alpha_composite(base, overlay)
+
+    for feature in features:
+        for part_type, coords in feature["parts"]:
+            if part_type == "Polygon":
+                # Fill the outer ring, then cut out any holes
+                mask = Image.new("L", base.size, 0)
+                mask_draw = ImageDraw.Draw(mask)
+                mask_draw.polygon(to_pixels(coords[0]), fill=255)
+                for hole in coords[1:]:
+                    mask_draw.polygon(to_pixels(hole), fill=0)
+                fill = Image.new("RGBA", base.size, fill_color)
+                overlay = Image.new("RGBA", base.size, (0, 0, 0, 0))
+                overlay.paste(fill, (0, 0), mask)
+                base = Image.alpha_composite(base, overlay)
+
+    draw = ImageDraw.Draw(base)
+    for feature in features:
+        for part_type, coords in feature["parts"]:
+            if part_type == "LineString":
+                draw.line(to_pixels(coords), fill=FEATURE_COLOR + (255,), width=LINE_WIDTH, joint="curve")
+
+    for feature in features:
+        if not feature["label"]:
+            continue
+        is_point = feature["parts"][0][0] == "Point"
+        left, top, right, bottom = draw.textbbox((0, 0), feature["label"], font=_font, stroke_width=1)
+        text_width, text_height = right - left, bottom - top
+        for lx, ly in to_pixels(feature["label_points"]):
+            # Point labels sit above the circle, polygon and line labels below their anchor
+            if is_point:
+                ly -= FONT_SIZE * 0.5 + text_height
+            else:
+                ly += FONT_SIZE * 0.5
+            draw.text(
+                (lx - text_width / 2 - left, ly - top), feature["label"], font=_font, fill=LABEL_COLOR,
+                stroke_width=1, stroke_fill=LABEL_HALO_COLOR,
+            )
+
+    output = io.BytesIO()
+    base.convert("RGB").save(output, format="JPEG", quality=JPEG_QUALITY)
+    return output.getvalue()
+
+def render_tiles(tiles):
+    return [(zoom, x, y, render_tile(zoom, x, y)) for zoom, x, y in tiles]
+
+def generate_mbtiles_in_process(bbox, maxzoom, raster_imagery_attribution, output_directory, output_filename, footprint=None, footprint_min_zoom=0, render_workers=None, resume=False):
+    """Render the composite raster MBTiles without tileserver-gl.
+
+    The alert features are drawn with Pillow onto the imagery tiles of the
+    raster MBTiles generated earlier in the flow, in a pool of worker
+    processes, and written straight into the output MBTiles.
+    """
+    if Image is None:
+        print("\033[1m\033[31mThe in-process renderer requires Pillow:\033[0m pip install 'gccd[render]'")
+        sys.exit(1)
+
+    minzoom = 0
+    maxzoom = int(maxzoom)
+
+    mapgl_dir = os.path.join(output_directory, "mapgl-map")
+    raster_mbtiles_path = os.path.join(mapgl_dir, "tiles", f"{output_filename}-raster.mbtiles")
+    geojson_path = os.path.join(output_directory, "resources", f"{output_filename}.geojson")
+    output_file = os.path.join(output_directory, f"{output_filename}.mbtiles")
+
+    metadata = {
+        'name': 'Composite change detection raster map',
+        'type': 'baselayer',
+        'version': '1.1',
+        'description': raster_imagery_attribution,
+        'format': 'jpg',
+    }
+
+    # The GeoJSON is parsed once here, and the prepared features handed to every worker
+    features = prepare_features(geojson_path)
+
+    # The workers come out of the process-wide CPU budget, shared with the other alerts of a batch.
+    # They are spawned rather than forked, as other threads (e.g. of a batch) may be running.
+    with metrics.stage("inprocess_render"), get_cpu_budget().reserve(render_workers) as workers, MBTilesWriter(output_file, metadata, overwrite=not resume) as writer, ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_renderer, initargs=(raster_mbtiles_path, features)
+    ) as executor:
+        print(f"Rendering composite raster tiles in-process with {workers} workers...")
+        completed_tiles = writer.existing_tiles() if resume else set()
+        if completed_tiles:
+            print(f"Resuming composite MBTiles build: {len(completed_tiles)} tiles already rendered")
+
+        for zoom, zoom_tiles in get_tile_cover(bbox, minzoom, maxzoom, footprint, footprint_min_zoom):
+            start_time = time.perf_counter()
+            tiles = ((zoom, x, y) for x, y in zoom_tiles if (zoom, x, y) not in completed_tiles)
+            rendered = 0
+            for results in executor.map(render_tiles, chunked(tiles, RENDER_CHUNK_SIZE)):
+                for tile_zoom, x, y, tile_data in results:
+                    if tile_data is not None:
+                        writer.add_tile(tile_zoom, x, y, tile_data)
+                        rendered += 1
+            writer.flush()
+            metrics.add("tiles_total", rendered, source="rendered")
+            elapsed = time.perf_counter() - start_time
+            tiles_per_second = rendered / elapsed if elapsed > 0 else 0.0
+            print(f"Zoom level {zoom}: {rendered} tiles rendered in {elapsed:.1f}s ({tiles_per_second:.1f} tiles/sec)")
+
+    metrics.add("bytes_written_total", metrics.path_size(output_file), stage="inprocess_render")
+    print("\033[1m\033[32mComposite raster MBTiles file generated:\033[0m", f"{output_file}")
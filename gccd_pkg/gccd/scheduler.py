@@ -0,0 +1,173 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from gccd import metrics
+from gccd.utils import get_cpu_budget
+
+
+class StepResult:
+    """Placeholder in a step's arguments for the return value of another step.
+
+    Any extra keys index into that value, e.g. StepResult("bbox", "geometry")
+    resolves to results["bbox"]["geometry"].
+    """
+
+    def __init__(self, step_name, *keys):
+        self.step_name = step_name
+        self.keys = keys
+
+    def resolve(self, results):
+        value = results[self.step_name]
+        for key in self.keys:
+            value = value[key]
+        return value
+
+
+class Step:
+    """A unit of work in a pipeline run by run_steps.
+
+    `inputs` and `outputs` name the artifacts (files, directories) a step
+    reads and writes: a step runs only after every step producing one of its
+    inputs, and after every step whose result it takes as a StepResult
+    argument. Inputs no step produces are expected to exist already. Steps
+    of kind "io" (network, disk, subprocesses) run in threads; steps of
+    kind "cpu" run in worker processes, so their function and arguments must
+    be picklable, once `cpu_jobs` of the process-wide CPU budget (see
+    get_cpu_budget) are free for the processes they use.
+
+    With a BuildManifest, a step is skipped when its `fingerprint` (the
+    JSON-serializable settings its outputs depend on), its input files and
+    its dependencies are unchanged since its outputs were last built. Steps
+    with no fingerprint always run. `cache_if`, if given, is called with the
+    step's return value to decide whether the run may be reused.
+    """
+
+    def __init__(self, name, func, args=(), kwargs=None, inputs=(), outputs=(), kind="io", fingerprint=None, cache_if=None, cpu_jobs=1):
+        if kind not in ("io", "cpu"):
+            raise ValueError(f"Unknown kind of step {name}: {kind}")
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.kwargs = kwargs or {}
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.kind = kind
+        self.fingerprint = fingerprint
+        self.cache_if = cache_if
+        self.cpu_jobs = cpu_jobs
+
+    def dependencies(self, producers):
+        dependencies = {producers[name] for name in self.inputs if name in producers}
+        for value in self.args + tuple(self.kwargs.values()):
+            if isinstance(value, StepResult):
+                dependencies.add(value.step_name)
+        return dependencies
+
+    def resolve_arguments(self, results):
+        def resolve(value):
+            return value.resolve(results) if isinstance(value, StepResult) else value
+        args = [resolve(value) for value in self.args]
+        kwargs = {key: resolve(value) for key, value in self.kwargs.items()}
+        return args, kwargs
+
+
+def run_step(name, func, args, kwargs):
+    with metrics.stage(name):
+        return func(*args, **kwargs)
+
+def run_step_in_worker(name, func, args, kwargs):
+    """Run a step in a worker process, returning its result along with the
+    metrics it recorded, which would otherwise stay in the worker."""
+    metrics.finish_run()
+    result = run_step(name, func, args, kwargs)
+    return result, metrics.finish_run()
+
+
+def run_step_in_pool(process_pool, cpu_jobs, name, func, args, kwargs):
+    """Wait for cpu_jobs of the CPU budget, then run a step in a worker process"""
+    with get_cpu_budget().reserve(cpu_jobs, wait_for_all=True):
+        return process_pool.submit(run_step_in_worker, name, func, args, kwargs).result()
+
+def run_steps(steps, io_workers=None, cpu_workers=None, manifest=None):
+    """Run steps concurrently, each as soon as the steps it depends on are done.
+
+    Returns a {step name: return value} dict. If a step fails, no further
+    steps are started, the running ones are waited for, and the error is
+    re-raised. Steps the manifest finds up to date are not run again.
+    """
+    steps = {step.name: step for step in steps}
+    producers = {}
+    for step in steps.values():
+        for output in step.outputs:
+            if output in producers:
+                raise ValueError(f"Both {producers[output]} and {step.name} produce {output}")
+            producers[output] = step.name
+    dependencies = {name: step.dependencies(producers) for name, step in steps.items()}
+    for name, step_dependencies in dependencies.items():
+        unknown = step_dependencies - steps.keys()
+        if unknown:
+            raise ValueError(f"Step {name} depends on unknown steps: {', '.join(sorted(unknown))}")
+
+    cpu_steps = sum(1 for step in steps.values() if step.kind == "cpu")
+    # CPU steps also hold a thread while they wait for the CPU budget
+    io_workers = io_workers or max(1, len(steps))
+    cpu_workers = cpu_workers or max(1, min(cpu_steps, get_cpu_budget().jobs))
+
+    results = {}
+    fingerprints = {}
+    running = {}
+    pending = dict(dependencies)
+    thread_pool = ThreadPoolExecutor(max_workers=io_workers)
+    # Only start worker processes if some step needs them. They are spawned
+    # rather than forked, as the threads of I/O steps may already be running
+    process_pool = None
+    if cpu_steps:
+        process_pool = ProcessPoolExecutor(max_workers=cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        while pending or running:
+            ready = [name for name, step_dependencies in pending.items() if step_dependencies <= results.keys()]
+            while ready:
+                for name in ready:
+                    step_dependencies = pending.pop(name)
+                    step = steps[name]
+                    if manifest is not None:
+                        fingerprints[name] = manifest.fingerprint(step, [fingerprints[dependency] for dependency in step_dependencies])
+                        if manifest.is_up_to_date(step, fingerprints[name]):
+                            results[name] = manifest.result(name)
+                            print(f"Step {name} is up to date, skipping")
+                            metrics.add("stage_skipped_total", stage=name)
+                            continue
+                    args, kwargs = step.resolve_arguments(results)
+                    if step.kind == "cpu":
+                        future = thread_pool.submit(run_step_in_pool, process_pool, step.cpu_jobs, name, step.func, args, kwargs)
+                    else:
+                        future = thread_pool.submit(run_step, name, step.func, args, kwargs)
+                    running[future] = (name, time.perf_counter())
+                # Skipped steps may have made more steps ready
+                ready = [name for name, step_dependencies in pending.items() if step_dependencies <= results.keys()]
+
+            if not running:
+                if pending:
+                    raise ValueError(f"Steps with circular dependencies: {', '.join(sorted(pending))}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, start_time = running.pop(future)
+                results[name] = future.result()
+                if steps[name].kind == "cpu":
+                    results[name], report = results[name]
+                    metrics.merge_run(report)
+                written = sum(metrics.path_size(path) for path in steps[name].outputs if os.path.exists(path))
+                metrics.add("bytes_written_total", written, stage=name)
+                print(f"Step {name} finished in {time.perf_counter() - start_time:.1f}s")
+                if manifest is not None:
+                    manifest.record(steps[name], fingerprints[name], results[name])
+    finally:
+        # Let the steps already running finish before handing back control
+        thread_pool.shutdown(wait=True, cancel_futures=True)
+        if process_pool is not None:
+            process_pool.shutdown(wait=True, cancel_futures=True)
+    return results
@@ -4,7 +4,22 @@ import subprocess
 import json
 import socket
 
-def generate_tileserver_config(output_directory, output_filename):
+from gccd import metrics
+from gccd.asset_store import get_asset_store
+
+# Where the asset store is mounted in the tileserver-gl container
+TILESERVER_ASSETS_DIRECTORY = "/assets"
+# Directory of a batch's shared fonts, sprites and styles, inside the batch directory
+BATCH_SHARED_DIRECTORY = ".shared"
+
+def asset_paths(assets_directory, fonts, sprites):
+    """The fonts and sprites paths of a tileserver-gl config: those in the
+    asset store mounted at assets_directory if given, else fonts and sprites"""
+    if assets_directory is None:
+        return {"fonts": fonts, "sprites": sprites}
+    return {"fonts": f"{assets_directory}/fonts", "sprites": f"{assets_directory}/sprites"}
+
+def generate_tileserver_config(output_directory, output_filename, assets_directory=None):
     map_directory = os.path.join(output_directory, 'mapgl-map')
     
     # Check if config already exists
@@ -35,8 +50,7 @@ def generate_tileserver_config(output_directory, output_filename):
     config = {
         "options": {
             "paths": {
-                "fonts": "fonts",
-                "sprites": "sprites",
+                **asset_paths(assets_directory, "fonts", "sprites"),
                 "mbtiles": "tiles",
                 "styles": "./",
             },
@@ -86,9 +100,102 @@ def serve_tileserver_gl(output_directory, output_filename, env_port):
     config_path = os.path.join(map_directory, "config.json")
     if os.path.exists(config_path):
         os.remove(config_path)
-    generate_tileserver_config(output_directory, output_filename)
+    # Fonts and sprites are served straight from the shared asset store
+    assets_directory = get_installed_assets_path()
+    generate_tileserver_config(output_directory, output_filename, assets_directory and TILESERVER_ASSETS_DIRECTORY)
+
+    run_tileserver_gl(map_directory, env_port, assets_directory)
+
+
+def generate_batch_tileserver_config(batch_directory, output_filenames, assets_directory=None):
+    """Write a tileserver-gl config.json in batch_directory serving the map of
+    each output in it (batch_directory/<output_filename>), so one tileserver-gl
+    can serve a whole batch. Fonts and sprites are served from the asset store
+    mounted at assets_directory if given, else from batch_directory/.shared."""
+    shared_directory = os.path.join(batch_directory, BATCH_SHARED_DIRECTORY)
+    styles_directory = os.path.join(shared_directory, "styles")
+    os.makedirs(styles_directory, exist_ok=True)
+
+    styles = {}
+    data = {}
+    for output_filename in output_filenames:
+        map_directory = os.path.join(batch_directory, output_filename, "mapgl-map")
+        style_path = os.path.join(map_directory, "style.json")
+        if not os.path.exists(style_path):
+            print(f"style.json not found in the map directory of {output_filename}.")
+            sys.exit(1)
+
+        with open(style_path, 'r') as style_file:
+            style_data = json.load(style_file)
+
+        # The style refers to its MBTiles by filename, relative to its own
+        # tiles directory; here they are referred to by data id instead
+        for source_data in style_data["sources"].values():
+            url = source_data.get("url", "")
+            if not url.startswith("mbtiles://"):
+                continue
+            mbtiles_filename = url[len("mbtiles://"):]
+            data_id = os.path.splitext(mbtiles_filename)[0]
+            source_data["url"] = f"mbtiles://{{{data_id}}}"
+            data[data_id] = {"mbtiles": f"{output_filename}/mapgl-map/tiles/{mbtiles_filename}"}
+
+        with open(os.path.join(styles_directory, f"{output_filename}.json"), "w") as style_file:
+            json.dump(style_data, style_file, indent=4)
+
+        styles[output_filename] = {
+            "style": f"{output_filename}.json",
+            "tilejson": {"format": "png"},
+            "serve_rendered": "true",
+            "serve_data": "true",
+        }
+
+    config = {
+        "options": {
+            "paths": {
+                **asset_paths(assets_directory, f"{BATCH_SHARED_DIRECTORY}/mapgl-map/fonts", f"{BATCH_SHARED_DIRECTORY}/mapgl-map/sprites"),
+                "mbtiles": "./",
+                "styles": f"{BATCH_SHARED_DIRECTORY}/styles",
+            },
+            "serveAllFonts": "true",
+        },
+        "styles": styles,
+        "data": data,
+    }
+
+    config_path = os.path.join(batch_directory, "config.json")
+    try:
+        with open(config_path, "w") as config_file:
+            json.dump(config, config_file, indent=4)
+        print(f"\033[1m\033[32mBatch config.json file generated:\033[0m {config_path}")
+    except Exception as e:
+        print(f"\033[31mError generating config.json: {e}")
+        sys.exit(1)
+
+
+def serve_batch_tileserver_gl(batch_directory, output_filenames, env_port):
+    """Serve the maps of a batch of outputs with a single tileserver-gl (see
+    generate_batch_tileserver_config)"""
+    if not os.path.isabs(batch_directory):
+        raise ValueError(
+            f"Expected batch_directory to be absolute, got [{batch_directory}]"
+        )
+    assets_directory = get_installed_assets_path()
+    generate_batch_tileserver_config(batch_directory, output_filenames, assets_directory and TILESERVER_ASSETS_DIRECTORY)
+    run_tileserver_gl(batch_directory, env_port, assets_directory)
+
 
-    volume_mapping = f"{map_directory}:/data"
+def get_installed_assets_path():
+    """The path of the shared asset store's fonts and sprites, or None if
+    they have not been downloaded"""
+    store = get_asset_store()
+    return store.path if store.installed() else None
+
+def run_tileserver_gl(data_directory, env_port, assets_directory=None):
+    """Start tileserver-gl in Docker serving the config.json in data_directory,
+    returning once it is ready to serve tiles. The asset store in
+    assets_directory, if given, is mounted read-only at /assets."""
+    volume_mapping = f"{data_directory}:/data"
+    asset_volumes = [] if assets_directory is None else ["-v", f"{assets_directory}:{TILESERVER_ASSETS_DIRECTORY}:ro"]
 
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.connect(("8.8.8.8", 80))
@@ -100,32 +207,35 @@ def serve_tileserver_gl(output_directory, output_filename, env_port):
     command = [
         "docker", "run", "--rm", "-it",
         "-v", volume_mapping,
+        *asset_volumes,
         "-p", f"{port}:8080",
         "maptiler/tileserver-gl"
     ]
 
-    try:
-        print("Starting up TileServer-GL...")
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-        while True:
-            if proc.poll() is not None:
-                subprocess.run("stty sane", shell=True)
-                print(
-                    "\033[1m\033[31mTileServer-GL process terminated, check docker logs\033[0m"
-                )
-                sys.exit(1)
-
-            line = proc.stdout.readline()
-            if "Startup complete" in line:
-                subprocess.run('stty sane', shell=True)
-                print(f"\033[0m\033[1m\033[32mTileServer-GL is serving the map at http://{local_ip}:{port}!\033[0m")
-                break
-    except subprocess.CalledProcessError:
-        subprocess.run('stty sane', shell=True)
-        print("\033[1m\033[31mError in serving tiles using TileServer-GL.\033[0m")
-        sys.exit(1)
-    except FileNotFoundError:
-        subprocess.run('stty sane', shell=True)
-        print("\033[1m\033[31mTileServer-GL command not found. Ensure it's installed and in your PATH.\033[0m")
-        sys.exit(1)
+    # Timed until the tileserver reports it is ready to serve tiles
+    with metrics.stage("serve_tileserver_gl"):
+        try:
+            print("Starting up TileServer-GL...")
+            proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+            while True:
+                if proc.poll() is not None:
+                    subprocess.run("stty sane", shell=True)
+                    print(
+                        "\033[1m\033[31mTileServer-GL process terminated, check docker logs\033[0m"
+                    )
+                    sys.exit(1)
+
+                line = proc.stdout.readline()
+                if "Startup complete" in line:
+                    subprocess.run('stty sane', shell=True)
+                    print(f"\033[0m\033[1m\033[32mTileServer-GL is serving the map at http://{local_ip}:{port}!\033[0m")
+                    break
+        except subprocess.CalledProcessError:
+            subprocess.run('stty sane', shell=True)
+            print("\033[1m\033[31mError in serving tiles using TileServer-GL.\033[0m")
+            sys.exit(1)
+        except FileNotFoundError:
+            subprocess.run('stty sane', shell=True)
+            print("\033[1m\033[31mTileServer-GL command not found. Ensure it's installed and in your PATH.\033[0m")
+            sys.exit(1)
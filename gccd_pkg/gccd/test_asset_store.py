@@ -0,0 +1,75 @@
+import os
+import io
+import tarfile
+
+import requests
+
+from gccd import asset_store
+from gccd.asset_store import AssetStore, SPRITE_FILES
+from gccd.generate_fonts_sprites import copy_fonts_and_sprites
+
+
+def write_assets(directory):
+    fonts_archive_path = directory / "fonts.tar.gz"
+    with tarfile.open(fonts_archive_path, "w:gz") as archive:
+        glyphs = b"glyphs"
+        member = tarfile.TarInfo("fonts/Open Sans Regular/0-255.pbf")
+        member.size = len(glyphs)
+        archive.addfile(member, io.BytesIO(glyphs))
+    sprites_directory = directory / "sprites"
+    os.makedirs(sprites_directory)
+    for sprite_file in SPRITE_FILES:
+        (sprites_directory / sprite_file).write_text(sprite_file)
+    return str(fonts_archive_path), str(sprites_directory)
+
+def test_seeded_assets_are_linked_into_outputs(tmp_path):
+    store = AssetStore(str(tmp_path / "store"))
+    store.seed(*write_assets(tmp_path))
+
+    mapgl_dir = tmp_path / "output" / "mapgl-map"
+    methods = store.link_into(str(mapgl_dir))
+
+    assert methods == {"hardlink": 1 + len(SPRITE_FILES)}
+    glyphs_path = mapgl_dir / "fonts" / "Open Sans Regular" / "0-255.pbf"
+    assert glyphs_path.read_bytes() == b"glyphs"
+    assert os.path.samefile(glyphs_path, os.path.join(store.fonts_path, "Open Sans Regular", "0-255.pbf"))
+    assert (mapgl_dir / "sprites" / "sprite.json").read_text() == "sprite.json"
+    assert not (mapgl_dir / "manifest.json").exists()
+    # Linking again leaves the existing files alone
+    assert store.link_into(str(mapgl_dir)) == {}
+
+def test_corrupt_store_is_downloaded_again(tmp_path, monkeypatch):
+    store = AssetStore(str(tmp_path / "store"))
+    fonts_archive_path, sprites_directory = write_assets(tmp_path)
+    store.seed(fonts_archive_path, sprites_directory)
+    with open(os.path.join(store.sprites_path, "sprite.png"), "w") as sprite_file:
+        sprite_file.write("truncated")
+
+    def download(staging_directory):
+        os.rename(fonts_archive_path, os.path.join(staging_directory, "fonts.tar.gz"))
+        for sprite_file in SPRITE_FILES:
+            os.rename(os.path.join(sprites_directory, sprite_file), os.path.join(staging_directory, "sprites", sprite_file))
+
+    restarted_store = AssetStore(store.directory)
+    monkeypatch.setattr(restarted_store, "_download", download)
+
+    assert restarted_store.ensure() == store.path
+    assert restarted_store.verify()
+    with open(os.path.join(store.sprites_path, "sprite.png")) as sprite_file:
+        assert sprite_file.read() == "sprite.png"
+
+def test_offline_run_does_not_fail(tmp_path, monkeypatch):
+    def offline(*args, **kwargs):
+        raise requests.ConnectionError("Network is unreachable")
+
+    monkeypatch.setattr(asset_store, "_stores", {})
+    monkeypatch.setenv("ASSET_STORE_DIRECTORY", str(tmp_path / "store"))
+    monkeypatch.setattr(asset_store.get_http_session(), "get", offline)
+
+    assert copy_fonts_and_sprites(str(tmp_path / "output")) is False
+    assert not os.listdir(tmp_path / "store")
+
+    # Once seeded, the store is used without the network
+    asset_store.get_asset_store().seed(*write_assets(tmp_path))
+    assert copy_fonts_and_sprites(str(tmp_path / "output")) is True
+    assert (tmp_path / "output" / "mapgl-map" / "sprites" / "sprite@2x.png").exists()
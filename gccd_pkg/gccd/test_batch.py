@@ -0,0 +1,91 @@
+import os
+import sys
+import json
+
+import pytest
+
+from gccd.batch import BatchResults, find_alerts, FAILED, SUCCEEDED
+from gccd.serve_maps import generate_batch_tileserver_config
+
+
+def touch(path):
+    with open(path, "w") as touched_file:
+        touched_file.write("{}")
+
+def test_find_alerts_pairs_geotiffs_with_their_geojson(tmp_path):
+    for name in ("a.geojson", "a_t0.tif", "a_t1.tif", "b.geojson", "b_t0.tif", "notes.txt"):
+        touch(tmp_path / name)
+
+    alerts = find_alerts(str(tmp_path))
+
+    assert [alert.name for alert in alerts] == ["a", "b"]
+    assert alerts[0].t0_path == str(tmp_path / "a_t0.tif")
+    assert alerts[0].t1_path == str(tmp_path / "a_t1.tif")
+    # Only one of b's GeoTIFFs exists, so it has neither
+    assert alerts[1].t0_path is None and alerts[1].t1_path is None
+    assert [alert.name for alert in find_alerts(str(tmp_path / "b*.geojson"))] == ["b"]
+
+def test_find_alerts_rejects_alerts_with_the_same_name(tmp_path):
+    for directory in ("one", "two"):
+        os.makedirs(tmp_path / directory)
+        touch(tmp_path / directory / "alert.geojson")
+
+    with pytest.raises(ValueError, match="alert"):
+        find_alerts(str(tmp_path / "*" / "*.geojson"))
+
+def test_batch_results_record_failures_without_stopping_other_alerts(tmp_path):
+    for name in ("ok", "error", "exit"):
+        touch(tmp_path / f"{name}.geojson")
+    alerts = find_alerts(str(tmp_path))
+    processed = []
+
+    def process(alert):
+        if alert.name == "error":
+            raise RuntimeError("download failed")
+        if alert.name == "exit":
+            sys.exit(1)
+        processed.append(alert.name)
+
+    results = BatchResults(alerts, str(tmp_path / "outputs"), workers=2)
+    results.run_stage("flow", alerts, process)
+    results.run_stage("composite", alerts, process)
+    summary = results.write_summary(str(tmp_path / "batch-summary.json"))
+
+    # Failed alerts are not carried on to the next stage
+    assert processed == ["ok", "ok"]
+    assert (summary["succeeded"], summary["failed"]) == (1, 2)
+    by_name = {alert["name"]: alert for alert in summary["alerts"]}
+    assert by_name["ok"]["status"] == SUCCEEDED
+    assert set(by_name["ok"]["stages"]) == {"flow", "composite"}
+    assert by_name["error"]["status"] == FAILED
+    assert by_name["error"]["error"] == "flow: RuntimeError: download failed"
+    assert set(by_name["error"]["stages"]) == {"flow"}
+    assert by_name["exit"]["status"] == FAILED
+    with open(tmp_path / "batch-summary.json") as summary_file:
+        assert json.load(summary_file)["failed"] == 2
+
+def test_generate_batch_tileserver_config_serves_every_output(tmp_path):
+    for name in ("a", "b"):
+        map_directory = tmp_path / name / "mapgl-map"
+        os.makedirs(map_directory)
+        style = {
+            "version": 8,
+            "sprite": "sprite",
+            "sources": {
+                "vector_source": {"type": "vector", "url": f"mbtiles://{name}-vector.mbtiles"},
+                "raster_source": {"type": "raster", "url": f"mbtiles://{name}-raster.mbtiles"},
+            },
+            "layers": [],
+        }
+        with open(map_directory / "style.json", "w") as style_file:
+            json.dump(style, style_file)
+
+    generate_batch_tileserver_config(str(tmp_path), ["a", "b"])
+
+    with open(tmp_path / "config.json") as config_file:
+        config = json.load(config_file)
+    assert set(config["styles"]) == {"a", "b"}
+    assert config["data"]["b-raster"] == {"mbtiles": "b/mapgl-map/tiles/b-raster.mbtiles"}
+    with open(tmp_path / config["options"]["paths"]["styles"] / config["styles"]["b"]["style"]) as style_file:
+        style = json.load(style_file)
+    assert style["sources"]["raster_source"]["url"] == "mbtiles://{b-raster}"
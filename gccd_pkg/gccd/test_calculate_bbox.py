@@ -1,4 +1,22 @@
-from gccd.calculate_bbox import calculate_bounding_box
+import json
+
+import numpy as np
+import pytest
+from shapely.geometry import shape
+from shapely.ops import transform
+
+from gccd.calculate_bbox import (
+    buffer_geometries,
+    calculate_alert_extents,
+    calculate_bounding_box,
+    calculate_extents,
+    get_bounding_box,
+    get_extents,
+    get_footprint,
+    get_utm_transformer_pair,
+    get_utm_transformers,
+    utm_zone_codes,
+)
 
 
 def test_calculate_bounding_box__point():
@@ -37,3 +55,61 @@ def test_calculate_bounding_box__line():
         ],
     }
     assert calculate_bounding_box(fcoll["features"]) == (-123.23, 45.22, -122.68, 45.62)
+
+
+ALERT_FEATURES = [
+    {"type": "Feature", "geometry": {"type": "Point", "coordinates": [-54.1, 3.3]}},
+    {"type": "Feature", "geometry": {"type": "LineString", "coordinates": [[-54.2, 3.1], [-54.0, 3.2]]}},
+    # In another UTM zone, and the southern hemisphere
+    {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[[-60.5, -2.0], [-60.4, -2.0], [-60.4, -1.9], [-60.5, -2.0]]]}},
+    {"type": "Feature", "geometry": None},
+]
+
+
+def test_buffer_geometries__matches_per_zone_buffering():
+    buffered = buffer_geometries(ALERT_FEATURES, 2)
+
+    for feature, buffered_geometry in zip(ALERT_FEATURES[:3], buffered):
+        geometry = shape(feature["geometry"])
+        project, inverse = get_utm_transformers(geometry.centroid.x, geometry.centroid.y)
+        expected = transform(inverse, transform(project, geometry).buffer(2000))
+        assert buffered_geometry.bounds == pytest.approx(expected.bounds)
+    assert buffered[3].is_empty
+
+def test_calculate_extents__per_feature_and_combined():
+    extents = calculate_extents(ALERT_FEATURES)
+
+    assert extents.features[0].tolist() == [-54.1, 3.3, -54.1, 3.3]
+    assert np.isnan(extents.features[3]).all()
+    assert extents.bounds == (-60.5, -2.0, -54.0, 3.3)
+
+def test_calculate_alert_extents__per_file(tmp_path):
+    paths = []
+    for name, features in (("a", ALERT_FEATURES[:2]), ("b", ALERT_FEATURES[2:])):
+        paths.append(tmp_path / f"{name}.geojson")
+        with open(paths[-1], "w") as geojson_file:
+            json.dump({"type": "FeatureCollection", "features": features}, geojson_file)
+
+    a, b = calculate_alert_extents(paths, 1)
+
+    assert a.features.shape == (2, 4)
+    assert a.bounds == pytest.approx(calculate_extents(ALERT_FEATURES[:2], 1).bounds)
+    assert b.bounds == pytest.approx(calculate_extents(ALERT_FEATURES[2:3], 1).bounds)
+    assert b.bounds[0] < -60.5 and b.bounds[3] > -1.9
+
+def test_get_extents__bounding_box_and_footprint_from_one_parse(tmp_path):
+    geojson_path = tmp_path / "alert.geojson"
+    with open(geojson_path, "w") as geojson_file:
+        json.dump({"type": "FeatureCollection", "features": ALERT_FEATURES}, geojson_file)
+
+    extents = get_extents(geojson_path, 1, footprint=True)
+
+    assert extents["bounding_box"] == get_bounding_box(geojson_path, 1)
+    assert shape(extents["footprint"]).equals(get_footprint(geojson_path, 1))
+    # The result can be recorded in the build manifest
+    assert shape(json.loads(json.dumps(extents["footprint"]))).equals(shape(extents["footprint"]))
+    assert get_extents(geojson_path, 1)["footprint"] is None
+
+def test_get_utm_transformer_pair__created_once_per_zone():
+    assert get_utm_transformer_pair(32621) is get_utm_transformer_pair(32621)
+    assert utm_zone_codes([-54.1, -60.5, 180.0], [3.3, -2.0, 10.0]).tolist() == [32621, 32720, 32660]
@@ -0,0 +1,147 @@
+import time
+
+import pytest
+
+from gccd import download_tiles, generate_tiles
+from gccd.download_tiles import AdaptiveConcurrency, HostLimiter, TileFetchError, fetch_tiles, parse_retry_after
+from gccd.generate_tiles import download_tile
+from gccd.mbtiles import MBTilesWriter, read_metadata
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(download_tiles, "BACKOFF_BASE", 0.01)
+
+
+def test_fetch_tiles_retries_failed_tiles():
+    attempts = {}
+
+    def flaky_fetch(tile):
+        attempts[tile] = attempts.get(tile, 0) + 1
+        if tile == (1, 0, 0) and attempts[tile] < 3:
+            raise TileFetchError("Status code: 500", "http://tiles/0", 500)
+        if tile == (1, 0, 1):
+            raise TileFetchError("Status code: 404", "http://tiles/1", 404, retryable=False)
+        return "downloaded"
+
+    failures = []
+    tiles = [(1, 0, 0), (1, 0, 1), (1, 1, 0)]
+    results = dict(fetch_tiles(tiles, flaky_fetch, workers=2, retries=3, failures=failures))
+
+    assert results == {(1, 0, 0): "downloaded", (1, 0, 1): None, (1, 1, 0): "downloaded"}
+    assert attempts == {(1, 0, 0): 3, (1, 0, 1): 1, (1, 1, 0): 1}
+    # Only tiles that failed for good are reported
+    assert failures == [{"tile": [1, 0, 1], "url": "http://tiles/1", "reason": "Status code: 404", "attempts": 1}]
+
+def test_fetch_tiles_reports_tiles_failing_every_retry():
+    def failing_fetch(tile):
+        raise TileFetchError("ConnectionError: refused", "http://tiles/0")
+
+    failures = []
+    results = list(fetch_tiles([(2, 1, 1)], failing_fetch, workers=1, retries=2, failures=failures))
+
+    assert results == [((2, 1, 1), None)]
+    assert failures[0]["attempts"] == 3
+
+def test_fetch_tiles_honors_retry_after():
+    calls = []
+
+    def throttled_fetch(tile):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise TileFetchError("Status code: 429", throttled=True, retry_after=0.2)
+        return "downloaded"
+
+    limiter = HostLimiter()
+    concurrency = AdaptiveConcurrency(4)
+    results = list(fetch_tiles([(1, 0, 0)], throttled_fetch, workers=4, retries=1, host_limiter=limiter, concurrency=concurrency))
+
+    assert results == [((1, 0, 0), "downloaded")]
+    assert calls[1] - calls[0] >= 0.2
+    assert concurrency.limit == 2
+
+def test_parse_retry_after():
+    assert parse_retry_after("7") == 7.0
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+    assert parse_retry_after("100000") == download_tiles.MAX_RETRY_AFTER
+    assert parse_retry_after("soon") is None
+
+def test_adaptive_concurrency_halves_on_failure_and_grows_back():
+    concurrency = AdaptiveConcurrency(8)
+    concurrency.record_failure()
+    # A burst of failures from the same overload only halves the limit once
+    concurrency.record_failure()
+    assert concurrency.limit == 4
+
+    for _ in range(4):
+        concurrency.record_success(0.01)
+    assert concurrency.limit == 5
+
+def test_host_limiter_rate_limits_requests():
+    limiter = HostLimiter(rate=50, burst=1)
+    start_time = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start_time >= 0.09
+
+def test_download_tile_raises_retryable_errors():
+    class Response:
+        def __init__(self, status_code):
+            self.status_code = status_code
+            self.headers = {}
+            self.content = b"tile"
+
+    class Session:
+        def __init__(self, status_code):
+            self.status_code = status_code
+
+        def get(self, url, timeout):
+            return Response(self.status_code)
+
+    assert download_tile(1, 0, 1, "http://tiles/{z}/{x}/{y}.jpg", Session(200)) == b"tile"
+    with pytest.raises(TileFetchError) as error:
+        download_tile(1, 0, 1, "http://tiles/{z}/{x}/{y}.jpg", Session(503))
+    assert error.value.retryable and error.value.url == "http://tiles/1/0/1.jpg"
+    with pytest.raises(TileFetchError) as error:
+        download_tile(1, 0, 1, "http://tiles/{z}/{x}/{y}.jpg", Session(404))
+    assert not error.value.retryable
+
+def test_generate_raster_tiles_only_resumes_with_the_same_settings(tmp_path, monkeypatch):
+    class Response:
+        status_code = 200
+        headers = {}
+
+        def __init__(self, url):
+            self.content = url.encode("utf-8")
+
+    class Session:
+        def __init__(self):
+            self.requested = []
+
+        def get(self, url, headers=None, timeout=None):
+            self.requested.append(url)
+            return Response(url)
+
+    bbox = [[-54.2, 3.2], [-54.0, 3.2], [-54.0, 3.4], [-54.2, 3.4], [-54.2, 3.2]]
+    mbtiles_file = str(tmp_path / "mapgl-map" / "tiles" / "alert-raster.mbtiles")
+
+    def generate(url, max_zoom):
+        session = Session()
+        monkeypatch.setattr(generate_tiles, "get_http_session", lambda workers: session)
+        assert generate_tiles.generate_raster_tiles(url, "", max_zoom, bbox, str(tmp_path), "alert", download_workers=1) == 0
+        return session.requested
+
+    requested = generate("http://imagery.test/{q}", 4)
+    assert len(requested) == 4
+    # An interrupted download is resumed
+    with MBTilesWriter(mbtiles_file) as writer:
+        writer._conn.execute("DELETE FROM map WHERE zoom_level = 4")
+        writer._conn.commit()
+    assert generate("http://imagery.test/{q}", 4) == requested[-1:]
+
+    # Tiles of other zoom levels or imagery are not kept
+    assert len(generate("http://imagery.test/{q}", 3)) == 3
+    assert read_metadata(mbtiles_file)["maxzoom"] == "3"
+    assert len(generate("http://other-imagery.test/{q}", 3)) == 3
+    with MBTilesWriter(mbtiles_file) as writer:
+        assert sorted(zoom for zoom, _, _ in writer.existing_tiles()) == [1, 2, 3]
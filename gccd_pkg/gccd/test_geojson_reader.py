@@ -0,0 +1,69 @@
+import json
+
+import numpy as np
+import pytest
+
+from gccd import geojson_reader
+from gccd.geojson_reader import feature_bounds, iter_features
+
+
+FEATURES = [
+    {"type": "Feature", "properties": {"id": 1}, "geometry": {"type": "Point", "coordinates": [-54.1, 3.3]}},
+    {"type": "Feature", "properties": {}, "geometry": None},
+    {
+        "type": "Feature",
+        "properties": {"name": "with a hole, and elevation"},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [
+                [[-55.0, 2.0, 10.0], [-53.0, 2.0, 10.0], [-53.0, 4.0, 10.0], [-55.0, 2.0, 10.0]],
+                [[-54.5, 2.5], [-54.0, 2.5], [-54.0, 3.0], [-54.5, 2.5]],
+            ],
+        },
+    },
+    {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {
+            "type": "GeometryCollection",
+            "geometries": [
+                {"type": "MultiPolygon", "coordinates": [[[[1, 1], [2, 1], [2, 2], [1, 1]]]]},
+                {"type": "LineString", "coordinates": [[0.5, -1], [0.75, 0]]},
+            ],
+        },
+    },
+]
+
+
+def write_geojson(path, geojson):
+    with open(path, "w") as geojson_file:
+        json.dump(geojson, geojson_file, indent=1)
+
+def test_iter_features_reads_features_across_chunk_boundaries(tmp_path, monkeypatch):
+    # Tiny chunks, so that features and numbers are split between reads
+    monkeypatch.setattr(geojson_reader, "CHUNK_SIZE", 7)
+    path = tmp_path / "alert.geojson"
+    write_geojson(path, {"type": "FeatureCollection", "crs": {"properties": {"name": "EPSG:4326"}}, "features": FEATURES, "bbox": [0, 0, 1, 1]})
+
+    assert list(iter_features(path)) == FEATURES
+
+def test_iter_features_rejects_invalid_geojson(tmp_path):
+    path = tmp_path / "alert.geojson"
+    write_geojson(path, {"type": "FeatureCollection"})
+    with pytest.raises(ValueError, match="no features"):
+        list(iter_features(path))
+
+    with open(path, "w") as geojson_file:
+        geojson_file.write('{"features": [{"type": "Feature"},')
+    with pytest.raises(ValueError, match="Invalid GeoJSON"):
+        list(iter_features(path))
+
+def test_feature_bounds(monkeypatch):
+    # Several batches of vertices
+    monkeypatch.setattr(geojson_reader, "BOUNDS_BATCH_SIZE", 3)
+    bounds = feature_bounds(FEATURES)
+
+    np.testing.assert_array_equal(bounds[0], [-54.1, 3.3, -54.1, 3.3])
+    assert np.isnan(bounds[1]).all()
+    np.testing.assert_array_equal(bounds[2], [-55.0, 2.0, -53.0, 4.0])
+    np.testing.assert_array_equal(bounds[3], [0.5, -1, 2, 2])
@@ -0,0 +1,78 @@
+import os
+
+from gccd import manifest
+from gccd.manifest import BuildManifest
+from gccd.scheduler import Step, StepResult, run_steps
+
+calls = []
+
+
+def measure(input_path):
+    calls.append("measure")
+    with open(input_path) as input_file:
+        return {"length": len(input_file.read())}
+
+def write_report(length, output_path):
+    calls.append("report")
+    with open(output_path, "w") as output_file:
+        output_file.write(f"{length}\n")
+
+def build(tmp_path, input_path, settings):
+    output_path = str(tmp_path / "report.txt")
+    steps = [
+        Step("measure", measure, (input_path,), inputs=[input_path], fingerprint=settings),
+        Step("report", write_report, (StepResult("measure", "length"), output_path), outputs=[output_path], fingerprint={}),
+    ]
+    return run_steps(steps, manifest=BuildManifest(str(tmp_path)))
+
+def test_unchanged_steps_are_skipped(tmp_path):
+    input_path = str(tmp_path / "input.txt")
+    with open(input_path, "w") as input_file:
+        input_file.write("alert")
+    calls.clear()
+
+    build(tmp_path, input_path, {"buffer": 5})
+    assert calls == ["measure", "report"]
+
+    # Same input and settings: nothing runs, results come from the manifest
+    calls.clear()
+    results = build(tmp_path, input_path, {"buffer": 5})
+    assert calls == []
+    assert results["measure"] == {"length": 5}
+
+    # A changed setting reruns the step and everything depending on it
+    calls.clear()
+    build(tmp_path, input_path, {"buffer": 10})
+    assert calls == ["measure", "report"]
+
+    # A deleted output is rebuilt
+    calls.clear()
+    os.remove(tmp_path / "report.txt")
+    build(tmp_path, input_path, {"buffer": 10})
+    assert calls == ["report"]
+
+    # Changed input contents rerun the steps
+    calls.clear()
+    with open(input_path, "w") as input_file:
+        input_file.write("alerts")
+    build(tmp_path, input_path, {"buffer": 10})
+    assert calls == ["measure", "report"]
+
+def test_file_hash__only_hashes_inputs_that_changed(tmp_path, monkeypatch):
+    input_path = str(tmp_path / "input.tif")
+    with open(input_path, "w") as input_file:
+        input_file.write("scene")
+    hashed = []
+    monkeypatch.setattr(manifest, "hash_file", lambda path: hashed.append(path) or "digest")
+
+    # A new output directory identifies its inputs without reading them
+    build_manifest = BuildManifest(str(tmp_path))
+    assert build_manifest.file_hash(input_path).startswith("stat:")
+    assert hashed == []
+
+    # A changed input is hashed, and then a touch alone doesn't change it
+    os.utime(input_path, ns=(1, 1))
+    assert build_manifest.file_hash(input_path) == "sha256:digest"
+    os.utime(input_path, ns=(2, 2))
+    assert build_manifest.file_hash(input_path) == "sha256:digest"
+    assert hashed == [input_path, input_path]
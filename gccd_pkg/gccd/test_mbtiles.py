@@ -0,0 +1,57 @@
+import os
+import sqlite3
+
+from gccd.mbtiles import MBTilesWriter, import_xyz_directory
+
+
+def test_mbtiles_writer__flips_rows_and_lists_existing_tiles(tmp_path):
+    mbtiles_file = str(tmp_path / "tiles.mbtiles")
+    with MBTilesWriter(mbtiles_file, {"format": "jpg"}, batch_size=2) as writer:
+        writer.add_tile(1, 0, 0, b"a")
+        writer.add_tile(1, 1, 0, b"b")
+        writer.add_tile(2, 3, 1, b"c")
+
+    conn = sqlite3.connect(mbtiles_file)
+    rows = conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles ORDER BY zoom_level, tile_column").fetchall()
+    assert rows == [(1, 0, 1), (1, 1, 1), (2, 3, 2)]
+    assert conn.execute("SELECT value FROM metadata WHERE name = 'format'").fetchone() == ("jpg",)
+    conn.close()
+
+    with MBTilesWriter(mbtiles_file) as writer:
+        assert writer.existing_tiles() == {(1, 0, 0), (1, 1, 0), (2, 3, 1)}
+
+
+def test_import_xyz_directory(tmp_path):
+    tile_dir = tmp_path / "xyz" / "3" / "2"
+    tile_dir.mkdir(parents=True)
+    (tile_dir / "5.png").write_bytes(b"tile")
+    (tile_dir / "5.png.aux.xml").write_bytes(b"ignored")
+
+    mbtiles_file = str(tmp_path / "tiles.mbtiles")
+    with MBTilesWriter(mbtiles_file) as writer:
+        assert import_xyz_directory(str(tmp_path / "xyz"), "png", writer) == 1
+        assert writer.existing_tiles() == {(3, 2, 5)}
+    assert os.path.getsize(mbtiles_file) > 0
+
+
+def test_mbtiles_writer__deduplicates_tiles_and_fills_metadata(tmp_path):
+    mbtiles_file = str(tmp_path / "tiles.mbtiles")
+    with MBTilesWriter(mbtiles_file, {"format": "jpg"}) as writer:
+        for x in range(4):
+            for y in range(4):
+                writer.add_tile(2, x, y, b"water")
+        writer.add_tile(2, 0, 0, b"land")
+
+    conn = sqlite3.connect(mbtiles_file)
+    assert conn.execute("SELECT COUNT(*) FROM tiles").fetchone() == (16,)
+    assert conn.execute("SELECT COUNT(*) FROM images").fetchone() == (2,)
+    assert conn.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = 2 AND tile_column = 0 AND tile_row = 3"
+    ).fetchone() == (b"land",)
+    metadata = dict(conn.execute("SELECT name, value FROM metadata"))
+    assert metadata["minzoom"] == "2"
+    assert metadata["maxzoom"] == "2"
+    assert metadata["bounds"] == "-180.000000,-85.051129,180.000000,85.051129"
+    assert conn.execute("PRAGMA journal_mode").fetchone() == ("delete",)
+    conn.close()
+    assert not os.path.exists(mbtiles_file + "-wal")
@@ -0,0 +1,23 @@
+from gccd import metrics
+from gccd.scheduler import Step, run_steps
+
+
+def write_tiles(output_path):
+    metrics.add("tiles_total", 3, source="downloaded")
+    with open(output_path, "wb") as output_file:
+        output_file.write(b"\0" * 100)
+
+def test_steps_record_stages_and_counters(tmp_path):
+    metrics.finish_run()
+    output_path = str(tmp_path / "tiles.mbtiles")
+    run_steps([Step("raster_mbtiles", write_tiles, (output_path,), outputs=[output_path], kind="cpu")])
+    report = metrics.finish_run()
+
+    # The stage and counters recorded in the worker process are merged into this run
+    assert [stage["name"] for stage in report["stages"]] == ["raster_mbtiles"]
+    assert report["counters"]["tiles_total"] == [{"labels": {"source": "downloaded"}, "value": 3}]
+    assert report["counters"]["bytes_written_total"] == [{"labels": {"stage": "raster_mbtiles"}, "value": 100}]
+
+    text = metrics.prometheus_text()
+    assert "# TYPE gccd_tiles_total counter" in text
+    assert 'gccd_bytes_written_total{stage="raster_mbtiles"} ' in text
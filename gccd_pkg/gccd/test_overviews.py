@@ -0,0 +1,38 @@
+import io
+import sqlite3
+
+import pytest
+
+from gccd.mbtiles import MBTilesWriter, flip_y
+from gccd.overviews import build_overviews
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def solid_jpeg(color):
+    output = io.BytesIO()
+    Image.new("RGB", (256, 256), color).save(output, format="JPEG", quality=95)
+    return output.getvalue()
+
+def test_build_overviews_downsamples_children(tmp_path):
+    mbtiles_file = str(tmp_path / "overviews.mbtiles")
+    colors = {(0, 0): (255, 0, 0), (1, 0): (0, 255, 0), (0, 1): (0, 0, 255), (1, 1): (255, 255, 255)}
+
+    with MBTilesWriter(mbtiles_file, {"format": "jpg"}) as writer:
+        for (x, y), color in colors.items():
+            writer.add_tile(2, x, y, solid_jpeg(color))
+        build_overviews(writer, 2, 0, overview_workers=1)
+
+    conn = sqlite3.connect(mbtiles_file)
+    stored = {(z, x, flip_y(z, row)) for z, x, row in conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles")}
+    assert stored == {(2, 0, 0), (2, 1, 0), (2, 0, 1), (2, 1, 1), (1, 0, 0), (0, 0, 0)}
+
+    tile_data = conn.execute(
+        "SELECT tile_data FROM tiles WHERE zoom_level = 1 AND tile_column = 0 AND tile_row = ?", (flip_y(1, 0),)
+    ).fetchone()[0]
+    parent = Image.open(io.BytesIO(tile_data)).convert("RGB")
+    # Each quadrant of the parent holds one of the children
+    for (x, y), color in colors.items():
+        pixel = parent.getpixel((x * 128 + 64, y * 128 + 64))
+        assert all(abs(a - b) < 8 for a, b in zip(pixel, color))
+    conn.close()
@@ -0,0 +1,52 @@
+import random
+
+from gccd import pmtiles
+from gccd.pmtiles import PMTilesWriter, read_header, read_tile, tileid_to_zxy, zxy_to_tileid
+
+
+def test_tile_ids_follow_hilbert_order():
+    assert zxy_to_tileid(0, 0, 0) == 0
+    assert [zxy_to_tileid(1, x, y) for x, y in [(0, 0), (0, 1), (1, 1), (1, 0)]] == [1, 2, 3, 4]
+    assert zxy_to_tileid(12, 3423, 1763) == 19078479
+    assert tileid_to_zxy(19078479) == (12, 3423, 1763)
+
+def write_tiles(pmtiles_file, tiles):
+    items = list(tiles.items())
+    random.Random(0).shuffle(items)
+    with PMTilesWriter(pmtiles_file, {"format": "png", "name": "test"}) as writer:
+        for (zoom, x, y), tile_data in items:
+            writer.add_tile(zoom, x, y, tile_data)
+
+def test_writer_round_trip_with_deduplication(tmp_path):
+    pmtiles_file = str(tmp_path / "test.pmtiles")
+    tiles = {
+        (zoom, x, y): b"blank" if x == 0 else f"{zoom}/{x}/{y}".encode()
+        for zoom in range(0, 5)
+        for x in range(2**zoom)
+        for y in range(2**zoom)
+    }
+    write_tiles(pmtiles_file, tiles)
+
+    with open(pmtiles_file, "rb") as archive:
+        header = read_header(archive.read(pmtiles.HEADER_SIZE))
+    assert header["magic"] == b"PMTiles" and header["version"] == 3
+    assert header["clustered"] == 1
+    assert (header["min_zoom"], header["max_zoom"]) == (0, 4)
+    assert header["addressed_tiles_count"] == len(tiles)
+    assert header["tile_contents_count"] == len(set(tiles.values()))
+    for (zoom, x, y), tile_data in tiles.items():
+        assert read_tile(pmtiles_file, zoom, x, y) == tile_data
+    assert read_tile(pmtiles_file, 5, 0, 0) is None
+
+def test_writer_spills_into_leaf_directories(tmp_path, monkeypatch):
+    monkeypatch.setattr(pmtiles, "ROOT_DIRECTORY_MAX_SIZE", 64)
+    monkeypatch.setattr(pmtiles, "LEAF_DIRECTORY_MIN_ENTRIES", 50)
+    pmtiles_file = str(tmp_path / "leaves.pmtiles")
+    tiles = {(8, x, y): f"{x}/{y}".encode() for x in range(40) for y in range(40)}
+    write_tiles(pmtiles_file, tiles)
+
+    with open(pmtiles_file, "rb") as archive:
+        header = read_header(archive.read(pmtiles.HEADER_SIZE))
+    assert header["leaf_directory_length"] > 0
+    for (zoom, x, y), tile_data in tiles.items():
+        assert read_tile(pmtiles_file, zoom, x, y) == tile_data
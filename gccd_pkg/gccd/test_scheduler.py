@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from gccd.scheduler import Step, StepResult, run_steps
+
+
+def test_run_steps_respects_dependencies():
+    order = []
+
+    def record(name, value=None):
+        order.append(name)
+        return value
+
+    steps = [
+        Step("style", record, ("style",), inputs=["tiles"]),
+        Step("tiles", record, ("tiles", StepResult("bbox", "coordinates", 0)), outputs=["tiles"]),
+        Step("bbox", record, ("bbox", {"coordinates": [[1, 2]]})),
+    ]
+    results = run_steps(steps)
+
+    assert order == ["bbox", "tiles", "style"]
+    assert results["tiles"] == [1, 2]
+
+def test_run_steps_runs_independent_steps_concurrently():
+    steps = [Step(f"sleep_{i}", time.sleep, (0.2,)) for i in range(4)]
+    steps.append(Step("power", pow, (2, 10), kind="cpu"))
+
+    start_time = time.perf_counter()
+    results = run_steps(steps)
+
+    assert time.perf_counter() - start_time < 0.7
+    assert results["power"] == 1024
+
+def test_run_steps_stops_after_a_failure():
+    def fail():
+        raise RuntimeError("download failed")
+
+    ran = []
+    steps = [
+        Step("download", fail, outputs=["tiles"]),
+        Step("style", ran.append, ("style",), inputs=["tiles"]),
+    ]
+    with pytest.raises(RuntimeError):
+        run_steps(steps)
+    assert ran == []
+
+def test_run_steps_rejects_circular_dependencies():
+    steps = [
+        Step("a", print, inputs=["b"], outputs=["a"]),
+        Step("b", print, inputs=["a"], outputs=["b"]),
+    ]
+    with pytest.raises(ValueError):
+        run_steps(steps)
@@ -0,0 +1,47 @@
+import time
+
+from gccd.tile_cache import TileCache
+
+
+def test_tile_cache__hits_and_misses(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"))
+    assert cache.get("http://example.com/{q}", 1, 0, 0) is None
+    cache.put("http://example.com/{q}", 1, 0, 0, b"tile", etag='"abc"')
+
+    cached = cache.get("http://example.com/{q}", 1, 0, 0)
+    assert cached.data == b"tile"
+    assert cached.etag == '"abc"'
+    assert cached.fresh
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_tile_cache__evicts_least_recently_used(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"), max_bytes=25)
+    cache.put("t", 1, 0, 0, b"0" * 10)
+    cache.put("t", 1, 0, 1, b"1" * 10)
+    cache.get("t", 1, 0, 0)
+    cache.put("t", 1, 1, 0, b"2" * 10)
+
+    assert cache.get("t", 1, 0, 1) is None
+    assert cache.get("t", 1, 0, 0) is not None
+    assert cache.get("t", 1, 1, 0) is not None
+    assert cache.stats()["evicted"] == 1
+
+
+def test_tile_cache__expired_tiles_are_not_fresh(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"), ttl=0.01)
+    cache.put("t", 1, 0, 0, b"tile")
+    time.sleep(0.02)
+    assert not cache.get("t", 1, 0, 0).fresh
+
+
+def test_tile_cache__replaced_tiles_are_counted_once(tmp_path):
+    cache = TileCache(str(tmp_path / "tiles.sqlite"), max_bytes=25)
+    cache.put("t", 1, 0, 0, b"0" * 10)
+    cache.put("t", 1, 0, 1, b"1" * 10)
+    cache.put("t", 1, 0, 0, b"2" * 12)
+
+    assert cache.stats()["bytes"] == 22
+    assert cache.stats()["evicted"] == 0
+    assert cache.get("t", 1, 0, 1) is not None
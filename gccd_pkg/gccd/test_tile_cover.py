@@ -0,0 +1,25 @@
+import mercantile
+from shapely.geometry import MultiPoint, box
+
+from gccd.tile_cover import bbox_tiles, footprint_tiles, get_tile_cover
+
+
+def test_footprint_tiles__matches_brute_force_cover():
+    footprint = box(-54.12, 3.30, -54.01, 3.43)
+    covers = footprint_tiles(footprint, 10, 13)
+    for zoom, tiles in covers.items():
+        expected = sorted(
+            (tile.x, tile.y)
+            for tile in mercantile.tiles(*footprint.bounds, zoom)
+        )
+        assert tiles == expected
+
+
+def test_get_tile_cover__footprint_skips_tiles_between_features():
+    points = MultiPoint([(-54.5, 3.0), (-53.5, 4.0)])
+    bbox = [[-54.5, 3.0], [-53.5, 3.0], [-53.5, 4.0], [-54.5, 4.0], [-54.5, 3.0]]
+    covers = dict(get_tile_cover(bbox, 1, 14, points, footprint_min_zoom=8))
+
+    assert len(covers[14]) == 2
+    assert list(covers[7]) == list(bbox_tiles(bbox, 7))
+    assert len(list(bbox_tiles(bbox, 14))) > 1000
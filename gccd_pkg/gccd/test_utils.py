@@ -0,0 +1,68 @@
+import os
+import errno
+
+import pytest
+
+from gccd import utils
+from gccd.utils import link_file
+
+
+def cross_device_link(source_path, destination_path):
+    raise OSError(errno.EXDEV, "Invalid cross-device link")
+
+def unsupported(source_path, destination_path):
+    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+def test_link_file_replaces_rather_than_writes_through_earlier_links(tmp_path):
+    first_input = tmp_path / "first.tif"
+    first_input.write_bytes(b"first")
+    second_input = tmp_path / "second.tif"
+    second_input.write_bytes(b"second")
+    staged_path = tmp_path / "staged.tif"
+
+    assert link_file(str(first_input), str(staged_path), allow_symlink=False) == "hardlink"
+    assert os.path.samefile(first_input, staged_path)
+    assert link_file(str(first_input), str(staged_path), allow_symlink=False) == "hardlink"
+
+    link_file(str(second_input), str(staged_path), allow_symlink=False)
+    assert staged_path.read_bytes() == b"second"
+    assert first_input.read_bytes() == b"first"
+
+@pytest.mark.parametrize("unavailable, allow_symlink, method", [
+    (["link"], False, "reflink"),
+    (["link", "reflink_file"], True, "symlink"),
+    (["link", "reflink_file"], False, "copy_file_range"),
+    (["link", "reflink_file", "copy_file_range_file"], False, "copy"),
+])
+def test_link_file_falls_back_to_cheapest_available_copy(tmp_path, monkeypatch, unavailable, allow_symlink, method):
+    monkeypatch.setattr(utils.os, "link", cross_device_link)
+    for name in unavailable[1:]:
+        monkeypatch.setattr(utils, name, unsupported)
+    # Reflinks need a filesystem that supports them
+    if "reflink_file" not in unavailable:
+        monkeypatch.setattr(utils, "reflink_file", utils.stream_copy_file)
+    if method == "copy_file_range" and not hasattr(os, "copy_file_range"):
+        pytest.skip("copy_file_range is not available")
+    input_path = tmp_path / "input.tif"
+    input_path.write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    linked_path = tmp_path / "linked.tif"
+
+    assert link_file(str(input_path), str(linked_path), allow_symlink) == method
+    assert linked_path.read_bytes() == input_path.read_bytes()
+    if method == "symlink":
+        assert os.path.islink(linked_path)
+    else:
+        assert not os.path.samefile(input_path, linked_path)
+
+def test_cpu_budget__shared_between_reservations():
+    budget = utils.CpuBudget(4)
+
+    with budget.reserve(3) as first:
+        # Only what is left of the budget is handed out
+        with budget.reserve() as second:
+            assert (first, second) == (3, 1)
+            assert budget.available == 0
+    assert budget.available == 4
+
+    with budget.reserve(10) as jobs:
+        assert jobs == 4
@@ -0,0 +1,175 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "gccd", "tiles.sqlite")
+DEFAULT_MAX_SIZE_MB = 2048
+
+CachedTile = namedtuple("CachedTile", ["data", "etag", "fresh"])
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class TileCache:
+    """Persistent, size-bounded cache of imagery tiles shared across runs.
+
+    Tiles are keyed by imagery URL template plus z/x/y and stored in a SQLite
+    database. When the cache grows beyond `max_bytes`, the least recently
+    used tiles are evicted. Tiles older than `ttl` seconds are returned as
+    not fresh so the caller can revalidate them (using the stored ETag).
+    """
+
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_SIZE_MB * 1024 * 1024, ttl=None):
+        os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        # Several processes (e.g. HTTP service workers) may share the cache
+        self._conn = sqlite3.connect(cache_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS tiles (
+                url_template text,
+                zoom_level integer,
+                tile_column integer,
+                tile_row integer,
+                tile_data blob,
+                size integer,
+                etag text,
+                fetched_at real,
+                last_access real,
+                PRIMARY KEY (url_template, zoom_level, tile_column, tile_row)
+            )
+            ''')
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tiles_last_access ON tiles (last_access)")
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+    def get(self, url_template, zoom, x, y):
+        """Return a CachedTile, or None if the tile is not cached."""
+        key = (url_template, zoom, x, y)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tile_data, etag, fetched_at FROM tiles "
+                "WHERE url_template = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                key,
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE tiles SET last_access = ? "
+                    "WHERE url_template = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    (time.time(),) + key,
+                )
+            tile_data, etag, fetched_at = row
+            fresh = self.ttl is None or time.time() - fetched_at < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale += 1
+            return CachedTile(bytes(tile_data), etag, fresh)
+
+    def put(self, url_template, zoom, x, y, tile_data, etag=None):
+        now = time.time()
+        key = (url_template, zoom, x, y)
+        with self._lock:
+            with self._conn:
+                # A refetched tile replaces its old row, which no longer counts
+                row = self._conn.execute(
+                    "SELECT size FROM tiles "
+                    "WHERE url_template = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    key,
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tiles "
+                    "(url_template, zoom_level, tile_column, tile_row, tile_data, size, etag, fetched_at, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    key + (sqlite3.Binary(tile_data), len(tile_data), etag, now, now),
+                )
+            self._total_bytes += len(tile_data) - (row[0] if row else 0)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def mark_revalidated(self, url_template, zoom, x, y):
+        """Record that a stale tile was confirmed unchanged by the server."""
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE tiles SET fetched_at = ? "
+                    "WHERE url_template = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                    (time.time(), url_template, zoom, x, y),
+                )
+            self.revalidated += 1
+            self.hits += 1
+
+    def _evict(self):
+        # Other processes may have written to the cache, so recount before evicting
+        self._total_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        # Evict down to 90% of the budget so we don't evict on every insert
+        target = self.max_bytes * 0.9
+        if self._total_bytes <= self.max_bytes:
+            return
+        cursor = self._conn.execute(
+            "SELECT url_template, zoom_level, tile_column, tile_row, size FROM tiles ORDER BY last_access"
+        )
+        victims = []
+        for url_template, zoom, x, y, size in cursor:
+            if self._total_bytes <= target:
+                break
+            victims.append((url_template, zoom, x, y))
+            self._total_bytes -= size
+        with self._conn:
+            self._conn.executemany(
+                "DELETE FROM tiles WHERE url_template = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                victims,
+            )
+        self.evicted += len(victims)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "revalidated": self.revalidated,
+                "evicted": self.evicted,
+                "bytes": self._total_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def get_tile_cache(cache_path=None, max_size_mb=None, ttl_hours=None):
+    """Return the process-wide TileCache for cache_path, or None if caching
+    is disabled (a max size of 0)."""
+    cache_path = cache_path or DEFAULT_CACHE_PATH
+    try:
+        max_size_mb = float(max_size_mb)
+    except (TypeError, ValueError):
+        max_size_mb = DEFAULT_MAX_SIZE_MB
+    try:
+        ttl = float(ttl_hours) * 3600
+    except (TypeError, ValueError):
+        ttl = None
+    if max_size_mb <= 0:
+        return None
+
+    with _caches_lock:
+        cache = _caches.get(cache_path)
+        if cache is None:
+            cache = TileCache(cache_path, int(max_size_mb * 1024 * 1024), ttl or None)
+            _caches[cache_path] = cache
+        return cache
@@ -0,0 +1,74 @@
+import mercantile
+import numpy as np
+import shapely
+import shapely.geometry
+
+
+def bbox_tiles(bbox, zoom):
+    """Yield the (x, y) tiles of the rectangle spanned by the bbox coordinates at zoom"""
+    longitudes = [coord[0] for coord in bbox]
+    latitudes = [coord[1] for coord in bbox]
+    west, south, east, north = min(longitudes), min(latitudes), max(longitudes), max(latitudes)
+
+    top_left = mercantile.tile(west, north, zoom)
+    bottom_right = mercantile.tile(east, south, zoom)
+    return (
+        (x, y)
+        for x in range(top_left.x, bottom_right.x + 1)
+        for y in range(top_left.y, bottom_right.y + 1)
+    )
+
+def tile_boxes(xs, ys, zoom):
+    """Return shapely boxes (in WGS84) for arrays of tile columns and rows at zoom"""
+    n = 2.0 ** zoom
+    west = xs / n * 360.0 - 180.0
+    east = (xs + 1) / n * 360.0 - 180.0
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ys / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (ys + 1) / n))))
+    return shapely.box(west, south, east, north)
+
+def footprint_tiles(footprint, min_zoom, max_zoom):
+    """Return {zoom: [(x, y), ...]} with only the tiles intersecting the footprint geometry.
+
+    The cover is built top-down: the candidates at each zoom are the children
+    of the tiles that intersected at the zoom above, so tiles far away from
+    any feature are never tested at high zooms.
+    """
+    shapely.prepare(footprint)
+    xs = np.array([0], dtype=np.int64)
+    ys = np.array([0], dtype=np.int64)
+    covers = {}
+    for zoom in range(0, max_zoom + 1):
+        if zoom > 0:
+            xs = np.repeat(xs * 2, 4) + np.tile([0, 1, 0, 1], len(xs))
+            ys = np.repeat(ys * 2, 4) + np.tile([0, 0, 1, 1], len(ys))
+        mask = shapely.intersects(tile_boxes(xs, ys, zoom), footprint)
+        xs, ys = xs[mask], ys[mask]
+        if zoom >= min_zoom:
+            order = np.lexsort((ys, xs))
+            covers[zoom] = list(zip(xs[order].tolist(), ys[order].tolist()))
+    return covers
+
+def as_footprint(footprint):
+    """Return the footprint as a shapely geometry, if given as a GeoJSON geometry"""
+    if isinstance(footprint, dict):
+        return shapely.geometry.shape(footprint)
+    return footprint
+
+def get_tile_cover(bbox, min_zoom, max_zoom, footprint=None, footprint_min_zoom=0):
+    """Yield (zoom, tiles) pairs with the (x, y) tiles to fetch for each zoom level.
+
+    Without a footprint every tile in the bbox rectangle is fetched. With a
+    footprint (a shapely or GeoJSON geometry), zoom levels from
+    footprint_min_zoom upwards only include the tiles intersecting it; lower
+    zoom levels still use the bbox rectangle.
+    """
+    footprint_covers = {}
+    footprint_zoom = max(min_zoom, int(footprint_min_zoom or 0))
+    if footprint is not None and footprint_zoom <= max_zoom:
+        footprint_covers = footprint_tiles(as_footprint(footprint), footprint_zoom, max_zoom)
+    for zoom in range(min_zoom, max_zoom + 1):
+        if zoom in footprint_covers:
+            yield zoom, footprint_covers[zoom]
+        else:
+            yield zoom, bbox_tiles(bbox, zoom)
@@ -1,7 +1,86 @@
 import os
 import sys
+import errno
+import threading
 import subprocess
-from shutil import copyfile
+from contextlib import contextmanager
+from shutil import copyfileobj
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+from gccd import metrics
+
+# ioctl request cloning a file on Linux (FICLONE from linux/fs.h)
+FICLONE = 0x40049409
+# Bytes copied per copy_file_range call when staging inputs
+STAGING_CHUNK_SIZE = 64 * 1024 * 1024
+# Bytes read at a time by the streaming copy, when nothing cheaper works
+STREAM_BUFFER_SIZE = 1024 * 1024
+
+def get_cpu_jobs(max_cpu_jobs=None):
+    """Return the number of CPU-bound processes the pipeline may run at once.
+
+    Defaults to the number of cores available to this process.
+    """
+    try:
+        return max(1, int(max_cpu_jobs))
+    except (TypeError, ValueError):
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        return max(1, len(os.sched_getaffinity(0)))
+    return os.cpu_count() or 1
+
+
+class CpuBudget:
+    """The CPU-bound processes that may run at once, shared by every process
+    pool (and gdal2tiles.py) started by the flows in this process"""
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.available = jobs
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, jobs=None, wait_for_all=False):
+        """Reserve up to `jobs` of the budget (all of it by default) for as
+        long as the block runs, yielding how many were reserved. Waits until
+        at least one is free, or with wait_for_all until all of them are."""
+        jobs = min(get_cpu_jobs(jobs or self.jobs), self.jobs)
+        with self.condition:
+            if wait_for_all:
+                self.condition.wait_for(lambda: self.available >= jobs)
+            else:
+                self.condition.wait_for(lambda: self.available > 0)
+                jobs = min(jobs, self.available)
+            self.available -= jobs
+        try:
+            yield jobs
+        finally:
+            with self.condition:
+                self.available += jobs
+                self.condition.notify_all()
+
+
+_cpu_budget = None
+_cpu_budget_lock = threading.Lock()
+
+def get_cpu_budget():
+    """Return the process-wide CpuBudget, of MAX_CPU_JOBS processes (see get_cpu_jobs)"""
+    global _cpu_budget
+    with _cpu_budget_lock:
+        if _cpu_budget is None:
+            _cpu_budget = CpuBudget(get_cpu_jobs(os.getenv("MAX_CPU_JOBS")))
+        return _cpu_budget
+
+def set_cpu_jobs(max_cpu_jobs):
+    """Size the process-wide CpuBudget, e.g. to a share of MAX_CPU_JOBS in
+    one of several processes running flows at once"""
+    global _cpu_budget
+    with _cpu_budget_lock:
+        _cpu_budget = CpuBudget(get_cpu_jobs(max_cpu_jobs))
 
 def load_html_template(template_path):
     try:
@@ -15,20 +94,20 @@ def copy_input_files(input_geojson_path, input_t0_path, input_t1_path, output_di
     resources_dir = os.path.join(output_directory, "resources")
     os.makedirs(resources_dir, exist_ok=True)
 
-    # Copy GeoJSON file
+    # Stage GeoJSON file
     try:
         # Determine the GeoJSON filename
         geojson_output_filename = os.path.basename(f'{output_filename}.geojson')
         # Determine the full path to the GeoJSON output file
         geojson_output_path = os.path.join(resources_dir, geojson_output_filename)
-        # Copy the GeoJSON file to the outputs directory
-        copyfile(input_geojson_path, geojson_output_path)
+        # Link (or else copy) the GeoJSON file to the outputs directory
+        stage_input_file(input_geojson_path, geojson_output_path)
         print(f"\033[1m\033[32mGeoJSON file copied to:\033[0m {geojson_output_path}")
     except Exception as e:
         print(f"\033[1m\033[31mError copying GeoJSON file:\033[0m {e}")
         sys.exit(1)
     
-    # Copy t0 / t1 GeoTIFF files
+    # Stage t0 / t1 GeoTIFF files
     if input_t0_path is not None and input_t1_path is not None:
         try:
             # Determine the GeoTIFF output filenames
@@ -37,14 +116,83 @@ def copy_input_files(input_geojson_path, input_t0_path, input_t1_path, output_di
             # Determine the full path to the GeoTIFF output files
             t0_output_path = os.path.join(resources_dir, t0_output_filename)
             t1_output_path = os.path.join(resources_dir, t1_output_filename)
-            # Copy the GeoTIFF files to the outputs directory
-            copyfile(input_t0_path, t0_output_path)
-            copyfile(input_t1_path, t1_output_path)
-            print(f"\033[1m\033[32mT0 and T2 GeoTIFF files copied to:\033[0m {resources_dir}")
+            # Link (or else copy) the GeoTIFF files to the outputs directory
+            t0_method = stage_input_file(input_t0_path, t0_output_path)
+            t1_method = stage_input_file(input_t1_path, t1_output_path)
+            print(f"\033[1m\033[32mT0 and T1 GeoTIFF files staged ({t0_method}, {t1_method}) to:\033[0m {resources_dir}")
         except Exception as e:
             print(f"\033[1m\033[31mError copying GeoTIFF files:\033[0m {e}")
             sys.exit(1)
 
+def stage_input_file(input_path, staged_path):
+    """Link an input file into an output directory (see link_file). Staged
+    inputs are not symlinked, as the original may be a temporary file."""
+    method = link_file(input_path, staged_path, allow_symlink=False)
+    metrics.add("bytes_staged_total", os.path.getsize(staged_path), method=method)
+    return method
+
+def reflink_file(source_path, destination_path):
+    """Create destination_path as a copy-on-write clone of source_path, on
+    filesystems that support it (btrfs, XFS, ...). Raises OSError otherwise."""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        raise OSError(errno.EOPNOTSUPP, "Reflinks are not supported on this platform")
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        try:
+            fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+        except OSError:
+            destination_file.close()
+            os.remove(destination_path)
+            raise
+
+def copy_file_range_file(source_path, destination_path):
+    """Copy source_path to destination_path with copy_file_range, which
+    copies within the kernel (and server-side on NFS/SMB, or as a clone on
+    some filesystems). Raises OSError where it is not supported."""
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not supported on this platform")
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        try:
+            while os.copy_file_range(source_file.fileno(), destination_file.fileno(), STAGING_CHUNK_SIZE):
+                pass
+        except OSError:
+            destination_file.close()
+            os.remove(destination_path)
+            raise
+
+def stream_copy_file(source_path, destination_path):
+    with open(source_path, "rb") as source_file, open(destination_path, "wb") as destination_file:
+        copyfileobj(source_file, destination_file, STREAM_BUFFER_SIZE)
+
+def symlink_file(source_path, destination_path):
+    os.symlink(os.path.abspath(source_path), destination_path)
+
+def link_file(source_path, destination_path, allow_symlink=True):
+    """Give destination_path the contents of source_path as cheaply as
+    possible: as a hardlink, else a reflink, else (if allowed) a symlink,
+    else with copy_file_range, and only else with a streaming copy. Returns
+    which of these was made.
+
+    A hardlinked file shares its data with the original, so linked files
+    must only ever be read. Any existing destination_path is removed first,
+    so that a file hardlinked by an earlier run is replaced, not written to.
+    """
+    if os.path.lexists(destination_path):
+        if os.path.exists(destination_path) and os.path.samefile(source_path, destination_path):
+            return "hardlink"
+        os.remove(destination_path)
+    methods = [("hardlink", os.link), ("reflink", reflink_file)]
+    if allow_symlink:
+        methods.append(("symlink", symlink_file))
+    methods.append(("copy_file_range", copy_file_range_file))
+    for method, link in methods:
+        try:
+            link(source_path, destination_path)
+        except OSError:
+            continue
+        return method
+    stream_copy_file(source_path, destination_path)
+    return "copy"
+
 def generate_jpgs_from_geotiffs(input_t0_path, input_t1_path, output_directory, output_filename):
     resources_dir = os.path.join(output_directory, "resources")
     os.makedirs(resources_dir, exist_ok=True)
@@ -58,8 +206,10 @@ def generate_jpgs_from_geotiffs(input_t0_path, input_t1_path, output_directory,
         t0_output_path = os.path.join(resources_dir, t0_output_filename)
         t1_output_path = os.path.join(resources_dir, t1_output_filename)
         # Generate the JPG files
-        subprocess.check_output(['gdal_translate', '-of', 'JPEG', input_t0_path, t0_output_path])
-        subprocess.check_output(['gdal_translate', '-of', 'JPEG', input_t1_path, t1_output_path])
+        with metrics.subprocess_timer("gdal_translate"):
+            subprocess.check_output(['gdal_translate', '-of', 'JPEG', input_t0_path, t0_output_path])
+        with metrics.subprocess_timer("gdal_translate"):
+            subprocess.check_output(['gdal_translate', '-of', 'JPEG', input_t1_path, t1_output_path])
         # Delete the xml artifacts that gdal_translate generates
         os.remove(f'{t0_output_path}.aux.xml')
         os.remove(f'{t1_output_path}.aux.xml')
@@ -95,3 +245,14 @@ def kill_container_by_image(image_name):
     except subprocess.CalledProcessError as e:
         print(f"\033[1m\033[31mAn error occurred trying to kill the Docker container:\033[0m {e}")
         return
+
+def chunked(iterable, size):
+    """Yield lists of up to size items from iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
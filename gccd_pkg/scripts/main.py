@@ -6,25 +6,107 @@ import argparse
 import traceback
 
 import gccd
+from gccd import metrics
+from gccd.batch import BatchResults, find_alerts, get_batch_workers
 from gccd.utils import kill_container_by_image
+from gccd.generate_fonts_sprites import copy_fonts_and_sprites
 from gccd.generate_tiles import generate_mbtiles_from_tileserver
-from gccd.serve_maps import serve_tileserver_gl
+from gccd.render_composite import generate_mbtiles_in_process
+from gccd.serve_maps import BATCH_SHARED_DIRECTORY, serve_batch_tileserver_gl, serve_tileserver_gl
 
 
 port = os.getenv("PORT", 8080)
 raster_imagery_attribution = os.getenv("RASTER_IMAGERY_ATTRIBUTION", "")
 raster_max_zoom = os.getenv("RASTER_MBTILES_MAX_ZOOM", 14)
+raster_footprint_min_zoom = os.getenv("RASTER_FOOTPRINT_MIN_ZOOM", 0)
+tileserver_render_workers = os.getenv("TILESERVER_RENDER_WORKERS")
+composite_mbtiles_resume = os.getenv("COMPOSITE_MBTILES_RESUME", "false").lower() in ("1", "true", "yes")
+composite_renderer = os.getenv("COMPOSITE_RENDERER", "tileserver")
+batch_workers = os.getenv("BATCH_WORKERS")
+
+
+def run_batch(pattern, output, workers):
+    """Generate the map assets of every alert GeoJSON in a directory or
+    matching a glob, into outputs/[output/]<alert name>, sharing one
+    tileserver-gl, HTTP session pool and fonts/sprites download between them"""
+    try:
+        alerts = find_alerts(pattern)
+    except ValueError as e:
+        sys.exit(f"\033[1m\033[31mError: {e}\033[0m")
+    if not alerts:
+        sys.exit(f"\033[1m\033[31mError: no GeoJSON files found for {pattern}\033[0m")
+
+    batch_directory = os.path.abspath(os.path.join('outputs', output) if output else 'outputs')
+    shared_directory = os.path.join(batch_directory, BATCH_SHARED_DIRECTORY)
+    os.makedirs(shared_directory, exist_ok=True)
+
+    workers = get_batch_workers(workers)
+    results = BatchResults(alerts, batch_directory, workers)
+    use_tileserver = composite_renderer != "inprocess"
+    print(f"\033[95mStarting batch of {len(alerts)} alerts, {workers} at a time...\033[0m")
+
+    try:
+        # Fonts and sprites are downloaded into the asset store once, and linked into each output
+        copy_fonts_and_sprites(shared_directory)
+
+        def generate_assets(alert):
+            output_directory = os.path.join(batch_directory, alert.name)
+            os.makedirs(output_directory, exist_ok=True)
+            # The bounding box and footprint computed by the flow are reused for the composite
+            extents[alert.name] = gccd.flow(alert.geojson_path, alert.t0_path, alert.t1_path, output_directory, alert.name)["extents"]
+
+        def generate_composite(alert):
+            output_directory = os.path.join(batch_directory, alert.name)
+            bbox = extents[alert.name]["bounding_box"]["geometry"]["coordinates"][0]
+            footprint = extents[alert.name]["footprint"]
+            if use_tileserver:
+                generate_mbtiles_from_tileserver(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, alert.name, port, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
+            else:
+                generate_mbtiles_in_process(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, alert.name, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
+
+        # STEPS 1-9 for every alert
+        extents = {}
+        results.run_stage("flow", alerts, generate_assets)
+
+        succeeded = results.succeeded(alerts)
+        if succeeded:
+            if use_tileserver:
+                # STEP 10: Serve the maps of all alerts from a single tileserver-gl
+                kill_container_by_image('maptiler/tileserver-gl')
+                serve_batch_tileserver_gl(batch_directory, [alert.name for alert in succeeded], port)
+            try:
+                # STEP 11 for every alert
+                results.run_stage("composite", succeeded, generate_composite)
+            finally:
+                if use_tileserver:
+                    kill_container_by_image('maptiler/tileserver-gl')
+    finally:
+        # The alerts run in this one process, so their stages are reported together
+        metrics.write_run_report(os.path.join(batch_directory, "batch-run-metrics.json"))
+        summary = results.write_summary(os.path.join(batch_directory, "batch-summary.json"))
+
+    if summary["failed"]:
+        sys.exit(1)
 
 
 def main():
     # Get arguments from command line
     parser = argparse.ArgumentParser(description='Generate HTML and MBTiles files with GeoJSON and GeoTIFF data.')
-    parser.add_argument('--geojson', required=True, help='Path to the input GeoJSON file')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--geojson', help='Path to the input GeoJSON file')
+    inputs.add_argument('--batch', help='Directory of input GeoJSON files, or a glob matching them, to process in one run. GeoTIFFs named <name>_t0.tif and <name>_t1.tif next to a GeoJSON file are used as its T0 and T1 files')
     parser.add_argument('--t0', help='Path to the input T0 (before) GeoTIFF file')
     parser.add_argument('--t1', help='Path to the input T1 (after) GeoTIFF file')
-    parser.add_argument('--output', help='Path to the output files')
+    parser.add_argument('--output', help='Path to the output files (with --batch, of the directory of the outputs of each alert)')
+    parser.add_argument('--batch-workers', default=batch_workers, help='Number of alerts processed at once with --batch')
     args = parser.parse_args()
 
+    if args.batch:
+        if args.t0 or args.t1:
+            sys.exit("\033[1m\033[31mError: --t0 and --t1 cannot be used with --batch\033[0m")
+        run_batch(args.batch, args.output, args.batch_workers)
+        return
+
     input_geojson_path = args.geojson
     input_t0_path = args.t0
     input_t1_path = args.t1
@@ -52,19 +134,31 @@ def main():
     # Call the modularized functions to perform different steps
     try:    
         print("\033[95mStarting script to generate map assets...\033[0m")
-        # PRELIMINARY: Make sure the tileserver-gl Docker container is taken down if running
-        kill_container_by_image('maptiler/tileserver-gl')
+        # The in-process renderer draws the composite tiles itself, without tileserver-gl
+        use_tileserver = composite_renderer != "inprocess"
 
-        bounding_box = gccd.flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename)
-
-        # STEP 11: Serve map using tileserver-gl
-        serve_tileserver_gl(output_directory, output_filename, port)
-                        
-        # STEP 12: Generate composite MBTiles from tileserver-gl map
-        generate_mbtiles_from_tileserver(bounding_box['geometry']['coordinates'][0], raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, port)
-
-        # POSTSCRIPT: Kill docker container now that we are done
-        kill_container_by_image('maptiler/tileserver-gl')
+        # PRELIMINARY: Make sure the tileserver-gl Docker container is taken down if running
+        if use_tileserver:
+            kill_container_by_image('maptiler/tileserver-gl')
+
+        # The bounding box and footprint computed by the flow are reused for the composite
+        extents = gccd.flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, output_filename)["extents"]
+        bbox = extents["bounding_box"]["geometry"]["coordinates"][0]
+        footprint = extents["footprint"]
+
+        if use_tileserver:
+            # STEP 10: Serve map using tileserver-gl
+            serve_tileserver_gl(output_directory, output_filename, port)
+                            
+            try:
+                # STEP 11: Generate composite MBTiles from tileserver-gl map
+                generate_mbtiles_from_tileserver(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, port, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
+            finally:
+                # POSTSCRIPT: Kill docker container now that we are done (or the build failed)
+                kill_container_by_image('maptiler/tileserver-gl')
+        else:
+            # STEPS 10-11: Render composite MBTiles in-process from the raster MBTiles and GeoJSON
+            generate_mbtiles_in_process(bbox, raster_max_zoom, raster_imagery_attribution, output_directory, output_filename, footprint, raster_footprint_min_zoom, tileserver_render_workers, composite_mbtiles_resume)
 
         print("\033[95mScript complete! Raster MBTiles overlaying your GeoJSON input on satellite imagery successfully generated.")
     except Exception as e:
@@ -74,6 +168,8 @@ def main():
         traceback_message = traceback.format_exc()
         print(f"\033[1m\033[31m{error_message}\n{traceback_message}\033[0m")
         sys.exit(1)
+    finally:
+        metrics.write_run_report(os.path.join(output_directory, "run-metrics.json"))
 
 
 if __name__ == "__main__":
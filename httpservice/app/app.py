@@ -1,18 +1,49 @@
 import json
 import os
-import tarfile
-import tempfile
 import base64
-from typing import Any, Optional
+import inspect
+from typing import Optional
 from pydantic import BaseModel, Field
 
 import fastapi
-import gccd
+import starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from gccd import metrics
+from multipart.multipart import MultipartParser, parse_options_header
 
+from .archive import ARCHIVE_FORMATS, archive_filename, check_compression, file_download_response, iter_archive
+from .jobs import JobQueue, QueueFull, SUCCEEDED
+from .result_cache import get_result_cache, result_key
 from .security import check_apikey_header
 
 
 app = fastapi.FastAPI()
+result_cache = get_result_cache()
+job_queue = JobQueue(result_cache=result_cache)
+
+# The file of each multipart/form-data field, in the job directory
+UPLOAD_FILENAMES = {"input_geojson": "input.geojson", "t0": "t0.tif", "t1": "t1.tif"}
+# The upload endpoints parse their body themselves, so its fields are described here for the docs
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["input_geojson"],
+                    "properties": {name: {"type": "string", "format": "binary"} for name in UPLOAD_FILENAMES},
+                },
+            },
+        },
+    },
+}
+
+
+@app.on_event("shutdown")
+def stop_jobs():
+    job_queue.shutdown()
 
 
 @app.get("/")
@@ -20,85 +51,252 @@ def redirect_to_docs():
     return fastapi.responses.RedirectResponse("/docs")
 
 
-async def sendable_tempfile():
-    """Dependency injection to FastAPI to inject a temporary output file
-    that won't be deleted until the FastAPI request is completely returned.
+@app.get("/metrics")
+def get_metrics():
+    """Counters of all requests served, in the Prometheus text format"""
+    return fastapi.responses.PlainTextResponse(metrics.prometheus_text(), media_type="text/plain; version=0.0.4")
 
-    Inspired by: https://stackoverflow.com/a/72535413
-    """
-    dir = tempfile.NamedTemporaryFile()
+
+class ChangemapRequestData(BaseModel):
+    input_geojson: dict
+    images: dict = Field(default_factory=dict)
+
+
+def write_base64_file(base64_str, path):
+    with open(path, "wb") as output_file:
+        output_file.write(base64.b64decode(base64_str))
+
+def write_job_inputs(job, data):
+    """Write a request's GeoJSON and base64 GeoTIFFs into the job directory,
+    returning the input paths for gccd.flow"""
+    input_geojson_path = os.path.join(job.directory, "input.geojson")
+    with open(input_geojson_path, "w") as input_fp:
+        json.dump(data.input_geojson, input_fp)
+
+    t0 = data.images.get("t0")
+    t1 = data.images.get("t1")
+    # With GeoTIFF inputs:
+    if t0 and t1:
+        input_t0_path = os.path.join(job.directory, "t0.tif")
+        input_t1_path = os.path.join(job.directory, "t1.tif")
+        write_base64_file(t0, input_t0_path)
+        write_base64_file(t1, input_t1_path)
+        return input_geojson_path, input_t0_path, input_t1_path
+    # Without GeoTIFF inputs:
+    return input_geojson_path, None, None
+
+class UploadReceiver:
+    """Writes the files of a multipart/form-data body into a job directory
+    while the body is parsed, chunk by chunk. Unlike fastapi.UploadFile,
+    which spools each file to a temporary file first, every file is written
+    to disk only once: the one remaining copy is from the request body into
+    the job directory (gccd.flow then links the files into its outputs)."""
+
+    def __init__(self, directory, boundary):
+        self.directory = directory
+        self.paths = {}
+        self.file = None
+        self.headers = {}
+        self.header_field = b""
+        self.header_value = b""
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b""
+        self.header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self.headers.get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        # Other fields, and repeated ones, are skipped
+        if name in UPLOAD_FILENAMES and name not in self.paths:
+            self.paths[name] = os.path.join(self.directory, UPLOAD_FILENAMES[name])
+            self.file = open(self.paths[name], "wb")
+
+    def on_part_data(self, data, start, end):
+        if self.file is not None:
+            self.file.write(data[start:end])
+
+    def on_part_end(self):
+        self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+async def receive_job_uploads(job, request):
+    """Write a multipart request's GeoJSON and GeoTIFF files into the job
+    directory as they are received, returning the input paths for gccd.flow"""
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in options:
+        raise ValueError("the files must be uploaded as multipart/form-data")
+    receiver = UploadReceiver(job.directory, options[b"boundary"])
     try:
-        yield dir.name
+        async for chunk in request.stream():
+            # Written from a thread, so that the disk doesn't block the event loop
+            await run_in_threadpool(receiver.parser.write, chunk)
+        receiver.parser.finalize()
     finally:
-        del dir
+        receiver.close()
 
+    paths = receiver.paths
+    if "input_geojson" not in paths:
+        raise ValueError("an input_geojson file is required")
+    if ("t0" in paths) != ("t1" in paths):
+        raise ValueError("both t0 and t1 GeoTIFFs must be provided, or neither should be provided")
+    return paths["input_geojson"], paths.get("t0"), paths.get("t1")
 
-def create_tarfile(directory, tar_filename):
-    with tarfile.open(tar_filename, "w") as tar:
-        for root, _, files in os.walk(directory):
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.relpath(full_path, directory)
-                tar.add(full_path, arcname=relative_path)
+def create_job(archive, compression):
+    check_compression(compression)
+    try:
+        return job_queue.create(archive, compression)
+    except QueueFull as e:
+        raise fastapi.HTTPException(
+            status_code=starlette.status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Too many change map jobs, try again later ({e})",
+            headers={"Retry-After": "60"},
+        )
 
-class ChangemapRequestData(BaseModel):
-    input_geojson: dict
-    images: dict = Field(default_factory=dict)
+async def submit_job(write_inputs, *args, archive=True, compression=None, hold=False):
+    job = create_job(archive, compression)
+    try:
+        if inspect.iscoroutinefunction(write_inputs):
+            inputs = await write_inputs(job, *args)
+        else:
+            # Writing the GeoTIFFs to disk would otherwise block the event loop
+            inputs = await run_in_threadpool(write_inputs, job, *args)
+        key = await run_in_threadpool(result_key, *inputs, compression)
+    except ValueError as e:
+        job_queue.discard(job)
+        raise fastapi.HTTPException(status_code=starlette.status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f"Invalid input: {e}")
+    except Exception:
+        job_queue.discard(job)
+        raise
+    # Identical requests are served from the result cache, or follow the job
+    # already running for them
+    if await run_in_threadpool(job_queue.complete_from_cache, job, key):
+        if hold:
+            job_queue.hold(job)
+        return job
+    return job_queue.enqueue(job, *inputs, key=key, hold=hold)
+
+def get_job(job_id):
+    try:
+        return job_queue.get(job_id)
+    except KeyError:
+        raise fastapi.HTTPException(status_code=starlette.status.HTTP_404_NOT_FOUND, detail="Unknown job")
+
+def job_response(job, queue_position=None):
+    response = job.to_dict(queue_position)
+    if job.status == SUCCEEDED:
+        response["result_url"] = app.url_path_for("get_job_result", job_id=job.id)
+    return response
 
 @app.post("/changemaps/", dependencies=[fastapi.Security(check_apikey_header)])
-async def make_changemaps(
-    data: ChangemapRequestData,
-    output_tar=fastapi.Depends(sendable_tempfile)
-):
-    input_geojson = data.input_geojson
-    images = data.images
-
-    with tempfile.NamedTemporaryFile(
-        "w+", prefix="input-", suffix=".json"
-    ) as input_fp, tempfile.TemporaryDirectory() as outdir:
-
-        # Dump input geojson to temp file
-        json.dump(input_geojson, input_fp)
-        input_fp.flush()
-        input_fp.seek(0)
-
-        t0 = images.get("t0")
-        t1 = images.get("t1")
-
-        # Run GCCD.flow()
-        # With GeoTIFF inputs:
-        if t0 and t1:
-            with WriteToTempFile(images["t0"], suffix=".tif") as t0_fp, \
-            WriteToTempFile(images["t1"], suffix=".tif") as t1_fp: \
-            gccd.flow(input_fp.name, t0_fp, t1_fp, outdir, "output")
-        # Without GeoTIFF inputs:
-        else:
-            gccd.flow(input_fp.name, None, None, outdir, "output")
+async def make_changemaps(data: ChangemapRequestData, request: fastapi.Request, compression: Optional[str] = None):
+    """Generate change maps and return them once done, as a tar archive
+    (compressed if `compression` is gzip or zstd).
+
+    The flow runs as a job like those of /changemaps/jobs/, so waiting for
+    it does not hold up other requests.
+    """
+    job = await submit_job(write_job_inputs, data, archive=False, compression=compression, hold=True)
+    return await changemap_response(request, job)
+
+def iter_archive_into_cache(job):
+    """Stream the job's archive, adding it to the result cache along the way"""
+    writer = result_cache.writer(job.key, ARCHIVE_FORMATS[job.compression][0]) if result_cache and job.key else None
+    completed = False
+    try:
+        for output in iter_archive(job.output_directory, job.compression):
+            if writer is not None:
+                writer.write(output)
+            yield output
+        completed = True
+    finally:
+        if writer is not None:
+            writer.commit() if completed else writer.abort()
+
+async def changemap_response(request, job):
+    """Send the result of a job submitted with hold, once it is done. The job
+    may be shared with identical requests, so it is only deleted once each
+    has been sent its result."""
+    job = await job_queue.wait(job)
+    if job.status != SUCCEEDED:
+        job_queue.release(job)
+        raise fastapi.HTTPException(status_code=500, detail=job.error or "Change map job was cancelled")
 
-        create_tarfile(outdir, output_tar)
+    if job.archive:
+        response = file_download_response(request, job.archive_path, ARCHIVE_FORMATS[job.compression][1], archive_filename(job.compression))
+        response.background = BackgroundTask(job_queue.release, job)
+        return response
 
-    return fastapi.responses.FileResponse(
-        output_tar,
-        headers={"Content-Disposition": "attachment; filename=changemap.tar"},
+    # The archive is streamed as it is built, rather than written out first
+    return fastapi.responses.StreamingResponse(
+        iter_archive_into_cache(job),
+        media_type=ARCHIVE_FORMATS[job.compression][1],
+        headers={"Content-Disposition": f"attachment; filename={archive_filename(job.compression)}"},
+        background=BackgroundTask(job_queue.release, job),
     )
 
-class WriteToTempFile:
-    def __init__(self, base64_str, suffix=""):
-        self.base64_str = base64_str
-        self.suffix = suffix
+@app.post("/changemaps/jobs/", status_code=202, dependencies=[fastapi.Security(check_apikey_header)])
+async def submit_changemap_job(data: ChangemapRequestData, compression: Optional[str] = None):
+    """Queue a change map job, returning its id straight away"""
+    return job_response(*get_job((await submit_job(write_job_inputs, data, compression=compression)).id))
 
-    def __enter__(self):
-        # Create a temporary file with the specified suffix
-        self.temp_file = tempfile.NamedTemporaryFile(suffix=self.suffix, delete=False)
+@app.post("/changemaps/upload/", dependencies=[fastapi.Security(check_apikey_header)], openapi_extra=UPLOAD_OPENAPI)
+async def make_changemaps_from_upload(request: fastapi.Request, compression: Optional[str] = None):
+    """Like /changemaps/, with the GeoJSON and GeoTIFFs uploaded as
+    multipart/form-data files (input_geojson, and t0 and t1 or neither)
+    rather than inside a JSON body"""
+    job = await submit_job(receive_job_uploads, request, archive=False, compression=compression, hold=True)
+    return await changemap_response(request, job)
 
-        # Decode the base64 string and write to the temporary file
-        decoded_data = base64.b64decode(self.base64_str)
-        self.temp_file.write(decoded_data)
-        self.temp_file.close()
+@app.post("/changemaps/jobs/upload/", status_code=202, dependencies=[fastapi.Security(check_apikey_header)], openapi_extra=UPLOAD_OPENAPI)
+async def submit_changemap_upload_job(request: fastapi.Request, compression: Optional[str] = None):
+    """Like /changemaps/jobs/, with the inputs uploaded as multipart/form-data files"""
+    job = await submit_job(receive_job_uploads, request, compression=compression)
+    return job_response(*get_job(job.id))
 
-        # Return the temporary file name
-        return self.temp_file.name
+@app.get("/changemaps/jobs/{job_id}", dependencies=[fastapi.Security(check_apikey_header)])
+def get_job_status(job_id: str):
+    return job_response(*get_job(job_id))
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        # Delete the temporary file when the context exits
-        os.remove(self.temp_file.name)
+@app.get("/changemaps/jobs/{job_id}/result", dependencies=[fastapi.Security(check_apikey_header)])
+def get_job_result(job_id: str, request: fastapi.Request):
+    """The job's archive. Interrupted downloads can be resumed with a Range header"""
+    job, _ = get_job(job_id)
+    if job.status != SUCCEEDED:
+        raise fastapi.HTTPException(
+            status_code=starlette.status.HTTP_409_CONFLICT,
+            detail=f"Job is {job.status}, it has no result",
+        )
+    return file_download_response(request, job.archive_path, ARCHIVE_FORMATS[job.compression][1], archive_filename(job.compression))
+
+@app.delete("/changemaps/jobs/{job_id}", dependencies=[fastapi.Security(check_apikey_header)])
+def cancel_job(job_id: str):
+    """Cancel a queued or running job, or delete the result of a finished one"""
+    try:
+        job = job_queue.cancel(job_id)
+    except KeyError:
+        raise fastapi.HTTPException(status_code=starlette.status.HTTP_404_NOT_FOUND, detail="Unknown job")
+    return job_response(job)
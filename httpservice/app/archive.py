@@ -0,0 +1,192 @@
+import os
+import re
+import zlib
+import tarfile
+
+import fastapi
+import starlette
+
+try:
+    import zstandard
+except ImportError:  # zstandard is only needed for zstd compressed archives
+    zstandard = None
+
+
+CHUNK_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# The fastest zstd level, for data that is already compressed
+ZSTD_FAST_LEVEL = -5
+
+# Artifacts that are compressed already, so not worth compressing again
+COMPRESSED_EXTENSIONS = (".mbtiles", ".pmtiles", ".jpg", ".jpeg", ".png", ".webp", ".gz", ".zip", ".zst")
+
+# Compression: (file extension, media type)
+ARCHIVE_FORMATS = {
+    None: (".tar", "application/x-tar"),
+    "gzip": (".tar.gz", "application/gzip"),
+    "zstd": (".tar.zst", "application/zstd"),
+}
+
+RANGE_HEADER = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def check_compression(compression):
+    if compression not in ARCHIVE_FORMATS:
+        raise fastapi.HTTPException(
+            status_code=starlette.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Unknown compression {compression}, expected gzip or zstd",
+        )
+    if compression == "zstd" and zstandard is None:
+        raise fastapi.HTTPException(
+            status_code=starlette.status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="zstd compression is not available, install zstandard",
+        )
+
+def archive_filename(compression):
+    return "changemap" + ARCHIVE_FORMATS[compression][0]
+
+
+class MemberCompressor:
+    """Compresses a stream as a series of gzip members or zstd frames.
+
+    Every time the stream switches between compressible and already
+    compressed data a new member starts, with the compression level
+    suited to it. Decompressors read the concatenated members as one
+    stream.
+    """
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.compressor = None
+        self.compressible = None
+
+    def _new_compressor(self, compressible):
+        if self.compression == "gzip":
+            # Level 0 stores the data in uncompressed deflate blocks
+            return zlib.compressobj(GZIP_LEVEL if compressible else 0, zlib.DEFLATED, 31)
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL if compressible else ZSTD_FAST_LEVEL).compressobj()
+
+    def compress(self, data, compressible=True):
+        if self.compression is None:
+            return data
+        output = b""
+        if compressible != self.compressible:
+            output = self.flush()
+            self.compressor = self._new_compressor(compressible)
+            self.compressible = compressible
+        return output + self.compressor.compress(data)
+
+    def flush(self):
+        if self.compressor is None:
+            return b""
+        output = self.compressor.flush()
+        self.compressor = None
+        self.compressible = None
+        return output
+
+
+def iter_tar_blocks(directory, chunk_size=CHUNK_SIZE):
+    """Yield (data, compressible) pieces of an uncompressed tar archive of directory"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            full_path = os.path.join(root, file)
+            stat = os.stat(full_path)
+            info = tarfile.TarInfo(os.path.relpath(full_path, directory))
+            info.size = stat.st_size
+            info.mtime = int(stat.st_mtime)
+            info.mode = stat.st_mode & 0o7777
+            yield info.tobuf(tarfile.GNU_FORMAT), True
+
+            compressible = not file.lower().endswith(COMPRESSED_EXTENSIONS)
+            with open(full_path, "rb") as input_file:
+                for chunk in iter(lambda: input_file.read(chunk_size), b""):
+                    yield chunk, compressible
+            # File data is padded to a whole number of blocks
+            remainder = info.size % tarfile.BLOCKSIZE
+            if remainder:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder), True
+
+    # Two empty blocks mark the end of the archive
+    yield tarfile.NUL * tarfile.BLOCKSIZE * 2, True
+
+def iter_archive(directory, compression=None, chunk_size=CHUNK_SIZE):
+    """Yield a tar archive of directory, optionally compressed, as it is built.
+
+    Files are read in chunks, so memory use does not grow with their size.
+    """
+    compressor = MemberCompressor(compression)
+    for data, compressible in iter_tar_blocks(directory, chunk_size):
+        output = compressor.compress(data, compressible)
+        if output:
+            yield output
+    output = compressor.flush()
+    if output:
+        yield output
+
+def write_archive(directory, archive_path, compression=None):
+    with open(archive_path, "wb") as archive_file:
+        for output in iter_archive(directory, compression):
+            archive_file.write(output)
+
+def iter_file_range(path, start, length, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as input_file:
+        input_file.seek(start)
+        while length > 0:
+            chunk = input_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def parse_range(range_header, size):
+    """Return the (start, end) byte range requested, None to send the whole
+    file, or raise 416 if the range lies beyond its end"""
+    match = RANGE_HEADER.match(range_header.strip())
+    # Multiple ranges and other units are not supported; the whole file is sent
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            start = size
+    else:
+        # A suffix range: the last `last` bytes
+        start = max(0, size - int(last))
+        end = size - 1
+    if start >= size:
+        raise fastapi.HTTPException(
+            status_code=starlette.status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return start, end
+
+def file_download_response(request, path, media_type, filename):
+    """Send a file, or the byte range of it requested, so that interrupted
+    downloads can be resumed"""
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f"attachment; filename={filename}",
+    }
+    range_header = request.headers.get("range")
+    # A range only applies to the version of the file the client started downloading
+    if_range = request.headers.get("if-range")
+    byte_range = parse_range(range_header, stat.st_size) if range_header and if_range in (None, etag) else None
+    if byte_range is None:
+        return fastapi.responses.FileResponse(path, media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return fastapi.responses.StreamingResponse(
+        iter_file_range(path, start, end - start + 1),
+        status_code=starlette.status.HTTP_206_PARTIAL_CONTENT,
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import signal
+import asyncio
+import tempfile
+import threading
+import traceback
+import collections
+import multiprocessing
+
+import gccd
+from gccd import metrics
+from gccd.utils import get_cpu_jobs, set_cpu_jobs
+
+from .archive import ARCHIVE_FORMATS, archive_filename, write_archive
+
+
+# Get environment variables
+job_workers = os.getenv("JOB_WORKERS", 2)
+max_cpu_jobs = os.getenv("MAX_CPU_JOBS")
+job_queue_max_depth = os.getenv("JOB_QUEUE_MAX_DEPTH", 10)
+job_retention_seconds = os.getenv("JOB_RETENTION_SECONDS", 3600)
+jobs_directory = os.getenv("JOBS_DIRECTORY") or os.path.join(tempfile.gettempdir(), "gccd-jobs")
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+
+OUTPUT_FILENAME = "output"
+
+
+class QueueFull(Exception):
+    pass
+
+
+def run_job(job_directory, input_geojson_path, input_t0_path, input_t1_path, archive=True, compression=None, cpu_jobs=None):
+    """Run gccd.flow for a job in a worker process, and pack its outputs
+    into an archive unless they are to be streamed straight from the output
+    directory. The flow's process pools share cpu_jobs processes, the job's
+    share of MAX_CPU_JOBS."""
+    # Start a process group of our own, so that cancelling the job also
+    # stops the processes the flow starts (gdal2tiles.py, tippecanoe, ...)
+    if hasattr(os, "setpgrp"):
+        os.setpgrp()
+    if cpu_jobs is not None:
+        set_cpu_jobs(cpu_jobs)
+    output_directory = os.path.join(job_directory, OUTPUT_FILENAME)
+    os.makedirs(output_directory, exist_ok=True)
+    try:
+        with metrics.stage("flow"):
+            gccd.flow(input_geojson_path, input_t0_path, input_t1_path, output_directory, OUTPUT_FILENAME)
+
+        if archive:
+            archive_path = os.path.join(job_directory, archive_filename(compression))
+            with metrics.stage("create_tarfile"):
+                write_archive(output_directory, archive_path, compression)
+            metrics.add("bytes_written_total", os.path.getsize(archive_path), stage="create_tarfile")
+            shutil.rmtree(output_directory)
+    except BaseException as e:
+        if isinstance(e, SystemExit):
+            # gccd prints the cause of most errors before exiting
+            message = f"gccd exited with status {e.code}, see the service logs"
+        else:
+            message = f"{type(e).__name__}: {e}"
+        with open(os.path.join(job_directory, "error.txt"), "w") as error_file:
+            error_file.write(f"{message}\n{traceback.format_exc()}")
+        raise
+    finally:
+        metrics.write_run_report(os.path.join(job_directory, "run-metrics.json"))
+
+
+def stop_process(process):
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        # No process group yet (or not on POSIX): stop the job process alone
+        process.terminate()
+
+
+class Job:
+    def __init__(self, job_id, directory, archive=True, compression=None):
+        self.id = job_id
+        self.directory = directory
+        self.archive = archive
+        self.compression = compression
+        self.status = QUEUED
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.args = None
+        self.process = None
+        self.cancel_requested = False
+        # The result_key of the job's inputs, if known
+        self.key = None
+        # Number of responses still sending the job's outputs
+        self.holds = 0
+
+    @property
+    def archive_path(self):
+        return os.path.join(self.directory, archive_filename(self.compression))
+
+    @property
+    def output_directory(self):
+        return os.path.join(self.directory, OUTPUT_FILENAME)
+
+    def to_dict(self, queue_position=None):
+        job = {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+        if queue_position is not None:
+            job["queue_position"] = queue_position
+        return job
+
+
+class JobQueue:
+    """Runs change map jobs in worker processes, at most `workers` at a time.
+
+    A job is created (reserving a place in the queue) before its inputs are
+    written to its directory, then enqueued to run. At most `max_depth` jobs
+    may be queued or running; finished jobs and their results are kept for
+    `retention_seconds`.
+
+    With a ResultCache, the archives of successful jobs are added to it, and
+    jobs with the same result_key as one already queued or running are
+    coalesced onto that job.
+    """
+
+    def __init__(self, directory=jobs_directory, workers=job_workers, max_depth=job_queue_max_depth, retention_seconds=job_retention_seconds, result_cache=None):
+        self.directory = directory
+        self.result_cache = result_cache
+        self.max_depth = max(1, int(max_depth))
+        self.retention_seconds = float(retention_seconds)
+        self.jobs = {}
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        # Spawned rather than forked, as the server's threads are already running
+        self.context = multiprocessing.get_context("spawn")
+        os.makedirs(directory, exist_ok=True)
+        workers = max(1, int(workers))
+        # Jobs run at once split the CPU budget, rather than each using all of it
+        self.cpu_jobs = max(1, get_cpu_jobs(max_cpu_jobs) // workers)
+        self.threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def create(self, archive=True, compression=None):
+        """Create a job, whose outputs are packed into an archive (compressed
+        with compression, if given) unless archive is false"""
+        with self.condition:
+            self._prune()
+            active = sum(1 for job in self.jobs.values() if job.status in ACTIVE_STATUSES)
+            if active >= self.max_depth:
+                raise QueueFull(f"{active} jobs are already queued or running")
+            job_id = uuid.uuid4().hex
+            job = Job(job_id, os.path.join(self.directory, job_id), archive, compression)
+            os.makedirs(job.directory)
+            self.jobs[job_id] = job
+            return job
+
+    def enqueue(self, job, input_geojson_path, input_t0_path=None, input_t1_path=None, key=None, hold=False):
+        """Queue the job to run, returning the job to follow for its result:
+        a job for the same key that is already queued or running, if any,
+        in which case this one is discarded. With hold, the returned job is
+        kept until release is called (see hold)."""
+        with self.condition:
+            if key is not None:
+                for other in self.jobs.values():
+                    if other.key == key and other.archive == job.archive and other.status in ACTIVE_STATUSES:
+                        self._delete(job)
+                        job = other
+                        break
+            if hold:
+                job.holds += 1
+            if job.status != QUEUED or job in self.queue:
+                return job
+            job.key = key
+            job.args = (job.directory, input_geojson_path, input_t0_path, input_t1_path, job.archive, job.compression, self.cpu_jobs)
+            self.queue.append(job)
+            self.condition.notify()
+            return job
+
+    def complete_from_cache(self, job, key):
+        """Finish the job with the cached result for key, returning whether there was one"""
+        if self.result_cache is None or key is None:
+            return False
+        if not self.result_cache.fetch(key, ARCHIVE_FORMATS[job.compression][0], job.archive_path):
+            return False
+        with self.condition:
+            job.key = key
+            job.archive = True
+            job.status = SUCCEEDED
+            job.started_at = job.finished_at = time.time()
+        metrics.add("jobs_total", status="cached")
+        return True
+
+    def hold(self, job):
+        """Keep the job's outputs until release is called"""
+        with self.condition:
+            job.holds += 1
+
+    def release(self, job):
+        """Release a hold on the job, deleting it once finished and no longer held"""
+        with self.condition:
+            job.holds -= 1
+            if job.holds <= 0 and job.status not in ACTIVE_STATUSES:
+                self._delete(job)
+
+    def get(self, job_id):
+        """Return the job and its position in the queue, or raise KeyError"""
+        with self.condition:
+            self._prune()
+            job = self.jobs[job_id]
+            position = self.queue.index(job) if job in self.queue else None
+            return job, position
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job, or delete a finished job's results"""
+        with self.condition:
+            job = self.jobs[job_id]
+            if job.status == QUEUED:
+                if job in self.queue:
+                    self.queue.remove(job)
+                job.status = CANCELLED
+                job.finished_at = time.time()
+            elif job.status == RUNNING:
+                job.cancel_requested = True
+                stop_process(job.process)
+            else:
+                self._delete(job)
+            return job
+
+    def discard(self, job):
+        with self.condition:
+            self._delete(job)
+
+    async def wait(self, job, poll_interval=0.5):
+        while job.status in ACTIVE_STATUSES:
+            await asyncio.sleep(poll_interval)
+        return job
+
+    def shutdown(self):
+        with self.condition:
+            self.closed = True
+            for job in self.jobs.values():
+                if job.status == RUNNING:
+                    job.cancel_requested = True
+                    stop_process(job.process)
+            self.condition.notify_all()
+
+    def _delete(self, job):
+        self.jobs.pop(job.id, None)
+        if job in self.queue:
+            self.queue.remove(job)
+        shutil.rmtree(job.directory, ignore_errors=True)
+
+    def _prune(self):
+        now = time.time()
+        for job in list(self.jobs.values()):
+            if job.finished_at is not None and not job.holds and now - job.finished_at > self.retention_seconds:
+                self._delete(job)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                job = self.queue.popleft()
+                job.status = RUNNING
+                job.started_at = time.time()
+                job.process = self.context.Process(target=run_job, args=job.args, name=f"gccd-job-{job.id}")
+                job.process.start()
+
+            job.process.join()
+            self._finish(job)
+
+    def _finish(self, job):
+        report = None
+        report_path = os.path.join(job.directory, "run-metrics.json")
+        if os.path.exists(report_path):
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+
+        with self.condition:
+            job.finished_at = time.time()
+            if job.cancel_requested:
+                job.status = CANCELLED
+            elif job.process.exitcode == 0:
+                job.status = SUCCEEDED
+                if job.archive and job.key is not None and self.result_cache is not None:
+                    self.result_cache.put(job.key, ARCHIVE_FORMATS[job.compression][0], job.archive_path)
+            else:
+                job.status = FAILED
+                error_path = os.path.join(job.directory, "error.txt")
+                if os.path.exists(error_path):
+                    with open(error_path) as error_file:
+                        job.error = error_file.readline().strip()
+                else:
+                    job.error = f"Job process exited with code {job.process.exitcode}"
+            job.process = None
+
+            # One JSON line per job, alongside the service logs. The run is
+            # recorded by the worker process, so its counters are merged
+            # into this process's totals for /metrics
+            if report is not None:
+                metrics.merge_run(report)
+                metrics.finish_run()
+            metrics.add("jobs_total", status=job.status)
+        print(json.dumps({"job_id": job.id, "status": job.status, "run_metrics": report}))
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+import gccd
+from gccd.manifest import hash_file
+
+
+# Get environment variables
+result_cache_directory = os.getenv("RESULT_CACHE_DIRECTORY") or os.path.join(tempfile.gettempdir(), "gccd-results")
+result_cache_max_size_mb = os.getenv("RESULT_CACHE_MAX_SIZE_MB", 2048)
+
+ACCESS_SUFFIX = ".access"
+
+
+def get_gccd_version():
+    try:
+        from importlib.metadata import version
+        return version("gccd")
+    except Exception:
+        return "unknown"
+
+def result_key(input_geojson_path, input_t0_path, input_t1_path, compression=None):
+    """Return a key identifying the result of a change map request: a hash of
+    the GeoJSON (ignoring formatting and key order), the GeoTIFF contents,
+    the settings of the flow and the archive format.
+
+    Raises ValueError if the GeoJSON is not valid JSON.
+    """
+    with open(input_geojson_path, "r") as input_file:
+        geojson = json.load(input_file)
+    canonical_geojson = json.dumps(geojson, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    parts = {
+        "geojson": hashlib.sha256(canonical_geojson.encode("utf-8")).hexdigest(),
+        "t0": hash_file(input_t0_path) if input_t0_path else None,
+        "t1": hash_file(input_t1_path) if input_t1_path else None,
+        "settings": gccd.flow_settings(),
+        "gccd_version": get_gccd_version(),
+        "compression": compression,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def link_or_copy(source_path, destination_path):
+    """Hardlink source_path to destination_path (replacing it), copying if
+    they are on different filesystems"""
+    temp_path = f"{destination_path}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        with open(source_path, "rb") as source_file, open(temp_path, "wb") as destination_file:
+            while True:
+                chunk = source_file.read(1024 * 1024)
+                if not chunk:
+                    break
+                destination_file.write(chunk)
+    os.replace(temp_path, destination_path)
+
+
+class ResultWriter:
+    """Writes a result into the cache as it is produced, e.g. while it is streamed"""
+
+    def __init__(self, cache, key, suffix):
+        self.cache = cache
+        self.key = key
+        self.suffix = suffix
+        self.temp_path = f"{cache.path(key, suffix)}.{threading.get_ident()}.tmp"
+        self.file = open(self.temp_path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.temp_path, self.cache.path(self.key, self.suffix))
+        self.cache._finish_write(self.key, self.suffix)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.temp_path)
+        self.cache._finish_write(self.key, None)
+
+
+class ResultCache:
+    """Size-bounded on-disk cache of change map archives by result_key.
+
+    The least recently used results are evicted once the cache grows
+    beyond max_size_mb. When a result was last used is recorded by the
+    modification time of an empty <result>.access file next to it, since
+    the result itself is hardlinked into job directories and its own
+    modification time is part of their download ETag.
+    """
+
+    def __init__(self, directory=result_cache_directory, max_size_mb=result_cache_max_size_mb):
+        self.directory = directory
+        self.max_size = float(max_size_mb) * 1024 * 1024
+        self.lock = threading.Lock()
+        self.writing = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, f"{key}{suffix}")
+
+    def _touch(self, path):
+        with open(f"{path}{ACCESS_SUFFIX}", "a"):
+            pass
+        os.utime(f"{path}{ACCESS_SUFFIX}")
+
+    def fetch(self, key, suffix, destination_path):
+        """Link the cached result to destination_path, returning whether it was cached"""
+        path = self.path(key, suffix)
+        with self.lock:
+            if not os.path.isfile(path):
+                return False
+            link_or_copy(path, destination_path)
+            self._touch(path)
+        return True
+
+    def put(self, key, suffix, source_path):
+        with self.lock:
+            link_or_copy(source_path, self.path(key, suffix))
+            self._touch(self.path(key, suffix))
+            self._evict(keep=self.path(key, suffix))
+
+    def writer(self, key, suffix):
+        """Return a ResultWriter for the result, or None if it is cached or
+        already being written"""
+        with self.lock:
+            if key in self.writing or os.path.exists(self.path(key, suffix)):
+                return None
+            self.writing.add(key)
+        return ResultWriter(self, key, suffix)
+
+    def _finish_write(self, key, suffix):
+        with self.lock:
+            self.writing.discard(key)
+            if suffix is not None:
+                self._touch(self.path(key, suffix))
+                self._evict(keep=self.path(key, suffix))
+
+    def _evict(self, keep):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith((".tmp", ACCESS_SUFFIX)) or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            try:
+                last_access = os.path.getmtime(f"{path}{ACCESS_SUFFIX}")
+            except FileNotFoundError:
+                last_access = os.path.getmtime(path)
+            entries.append((last_access, path, size))
+            total_size += size
+        # Evict the least recently used results first, and the one just added
+        # only if it doesn't fit on its own
+        entries.sort(key=lambda entry: (entry[1] == keep, entry[0]))
+        for _, path, size in entries:
+            if total_size <= self.max_size:
+                break
+            os.remove(path)
+            try:
+                os.remove(f"{path}{ACCESS_SUFFIX}")
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+def get_result_cache():
+    if float(result_cache_max_size_mb) <= 0:
+        return None
+    return ResultCache()